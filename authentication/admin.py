@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
 from .forms import UserRegisterForm
-from .models import User, Profile
+from .models import User, Profile, OutgoingEmail
 
 class UserAdmin(BaseUserAdmin):
 	# The forms to add and change user instances
@@ -60,6 +60,13 @@ class ProfileAdmin(admin.ModelAdmin):
 		})
 	)
 
+class OutgoingEmailAdmin(admin.ModelAdmin):
+	list_display=('recipient', 'subject', 'status', 'attempts', 'next_attempt', 'created',)
+	list_filter=('status',)
+	search_fields=['recipient', 'subject']
+
 admin.site.register(User, UserAdmin)
 
-admin.site.register(Profile, ProfileAdmin)
\ No newline at end of file
+admin.site.register(Profile, ProfileAdmin)
+
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
@@ -0,0 +1,7 @@
+from xcrowmeapi.asyncviews import AsyncReadView
+
+from . import views
+
+
+class UserAPIView(AsyncReadView):
+    view_class = views.UserAPIView
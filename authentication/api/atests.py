@@ -1,13 +1,31 @@
 import json
+import warnings
+from unittest import mock
 
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
 from rest_framework import status
 from rest_framework.reverse import reverse
+from django.core import mail
+from django.core.cache import caches
+from django.core.cache.backends.base import CacheKeyWarning
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase
 
 from project_api_key.models import ProjectUserAPIKey, ProjectUser
 
-from authentication.models import User
-from authentication.api.utils import url_with_params
+from authentication import otp
+from authentication.cache import access_claims_cache
+from authentication.models import OutgoingEmail, User
+from authentication.api.utils import url_with_params, get_tokens_for_user
+from xcrowmeapi.throttling import SharedTokenBuckets, TokenBuckets, local_buckets
+
+
+class CheapPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    # Same algorithm with a lower cost, as before tuning the hasher
+    iterations = 1000
 
 
 """
@@ -36,6 +54,10 @@ class AuthenticationAppTest(APITestCase):
         # Globalize key
         self.user_key = key
 
+        # Throttle buckets and otps are kept between tests
+        local_buckets.clear()
+        otp.local_store.clear()
+
     # Utility functions
     def login_user(self):
         url = reverse('auth:login')
@@ -67,7 +89,104 @@ class AuthenticationAppTest(APITestCase):
         # Login with api key
         response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_user_login_single_pass(self):
+        """
+        Test login fetches the user with its profile once and checks the
+        password once, and rehashes passwords of an older hasher cost
+        """
+        url = reverse('auth:login')
+        data = {
+            'email': 'netrobeweb@gmail.com',
+            'password': 'randopass'
+        }
+        self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+
+        with mock.patch.object(User, 'check_password', autospec=True, side_effect=User.check_password) as check:
+            with self.assertNumQueries(1):
+                response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(check.call_count, 1)
+        self.assertEqual(response.data['user']['email'], 'netrobeweb@gmail.com')
+        self.assertIn('username', response.data['user']['profile'])
+
+        # Unknown emails and wrong passwords
+        response = self.client.post(url, dict(data, email='nobody@gmail.com'), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, dict(data, password='wrongpass'), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Hashed with a lower cost, rehashed with the current one on login
+        user = User.objects.get(email='netrobeweb@gmail.com')
+        with override_settings(PASSWORD_HASHERS=['authentication.api.atests.CheapPBKDF2PasswordHasher']):
+            user.set_password('randopass')
+        user.save()
+        self.assertIn('$1000$', user.password)
+        response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertIn(f'${PBKDF2PasswordHasher.iterations}$', user.password)
+        self.assertTrue(user.check_password('randopass'))
     
+    def test_throttling(self):
+        """
+        Test logins are throttled by email and by client address before any
+        query or password check, in process or in a shared cache. Only
+        requests with a valid key count for the email
+        """
+        url = reverse('auth:login')
+        data = {
+            'email': 'netrobeweb@gmail.com',
+            'password': 'wrongpass'
+        }
+        for _ in range(20):
+            response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':'wrong.key'})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        for _ in range(10):
+            response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with mock.patch.object(User, 'check_password') as check, self.assertNumQueries(0):
+            response = self.client.post(url, dict(data, email='NetroBeWeb@gmail.com'), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertFalse(check.called)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+        # Bodies that aren't objects have no target
+        for name in ['auth:login', 'auth:validate_token']:
+            response = self.client.post(reverse(name), [1, 2], format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Other emails are still let in
+        response = self.client.post(url, dict(data, email='sketcherslodge@gmail.com'), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # By client address, shared between workers through a cache
+        rates = {'project': None, 'ip': '2/min', 'target': None}
+        with override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates), THROTTLE_CACHE='default'):
+            codes = [
+                self.client.get(reverse('auth:gen_otp'), REMOTE_ADDR='10.0.0.1', **{'HTTP_BEARER_API_KEY':self.user_key}).status_code
+                for _ in range(3)
+            ]
+            self.assertEqual(codes, [200, 200, 429])
+            response = self.client.get(reverse('auth:gen_otp'), REMOTE_ADDR='10.0.0.2', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Buckets refill over time
+        buckets = TokenBuckets()
+        with mock.patch('xcrowmeapi.throttling.time.monotonic', side_effect=[0, 0, 0, 30]):
+            self.assertEqual(buckets.consume('key', 1 / 60, 2), 0)
+            self.assertEqual(buckets.consume('key', 1 / 60, 2), 0)
+            self.assertAlmostEqual(buckets.consume('key', 1 / 60, 2), 60)
+            self.assertAlmostEqual(buckets.consume('key', 1 / 60, 2), 30)
+
+        # Shared buckets are kept by a digest, any email makes a valid cache key
+        buckets = SharedTokenBuckets(caches['default'])
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            self.assertEqual(buckets.consume('target:' + 'net robe\n@email.com' * 20, 1 / 60, 1), 0)
+            self.assertGreater(buckets.consume('target:' + 'net robe\n@email.com' * 20, 1 / 60, 1), 0)
+
     def test_user_registration(self):
         """
         Test to register user with and without api key
@@ -155,6 +274,66 @@ class AuthenticationAppTest(APITestCase):
         response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
     
+    def test_otp_verification(self):
+        """
+        Test otps generated for a key are verified once, with a limited
+        number of wrong guesses, and expire
+        """
+        gen_url = reverse('auth:gen_otp')
+        url = reverse('auth:verify_otp')
+        headers = {'HTTP_BEARER_API_KEY':self.user_key}
+
+        response = self.client.post(gen_url, {'key': 'NetroBeWeb@gmail.com'}, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        code = response.data['otp']
+        self.assertRegex(code, r'^[0-9]{6}$')
+        self.assertEqual(response.data['expires_in'], settings.OTP_TTL)
+
+        # Without api key
+        response = self.client.post(url, {'key': 'netrobeweb@gmail.com', 'otp': code}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        wrong = str((int(code) + 1) % 10 ** 6).zfill(6)
+        response = self.client.post(url, {'key': 'netrobeweb@gmail.com', 'otp': wrong}, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['attempts_left'], settings.OTP_MAX_ATTEMPTS - 1)
+
+        # The key is case insensitive, a verified otp is used up
+        response = self.client.post(url, {'key': ' netrobeweb@gmail.com', 'otp': code}, format='json', **headers)
+        self.assertEqual(response.data, {'valid': True})
+        response = self.client.post(url, {'key': 'netrobeweb@gmail.com', 'otp': code}, format='json', **headers)
+        self.assertEqual(response.data, {'error': 'Otp expired or not found'})
+
+        # Too many wrong guesses
+        with override_settings(OTP_MAX_ATTEMPTS=2):
+            code = self.client.post(gen_url, {'key': 'phone:+2348000000000'}, format='json', **headers).data['otp']
+            wrong = str((int(code) + 1) % 10 ** 6).zfill(6)
+            for left in (1, 0):
+                response = self.client.post(url, {'key': 'phone:+2348000000000', 'otp': wrong}, format='json', **headers)
+                self.assertEqual(response.data.get('attempts_left', 0), left)
+            response = self.client.post(url, {'key': 'phone:+2348000000000', 'otp': code}, format='json', **headers)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Expired
+        code = otp.generate('user:1')[0]
+        with mock.patch('authentication.otp.time.time', return_value=otp.time.time() + settings.OTP_TTL + 1):
+            self.assertEqual(otp.verify('user:1', code), (False, 0))
+        self.assertEqual(otp.verify('user:1', code), (False, 0))
+
+        # Shared between workers through a cache
+        with override_settings(OTP_CACHE='default'):
+            code = self.client.post(gen_url, {'key': 'user:2'}, format='json', **headers).data['otp']
+            self.assertEqual(len(otp.local_store), 0)
+            response = self.client.post(url, {'key': 'user:2', 'otp': code}, format='json', **headers)
+            self.assertEqual(response.data, {'valid': True})
+
+        # Missing fields, bodies that aren't objects
+        response = self.client.post(url, {'key': 'user:1', 'otp': 'abc'}, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for name in [gen_url, url]:
+            response = self.client.post(name, [1, 2], format='json', **headers)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_email_token(self):
         """
         1. Test email token generation and validation with and without api key,
@@ -307,6 +486,68 @@ class AuthenticationAppTest(APITestCase):
         response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
     
+    def test_user_batch(self):
+        """
+        Test looking up users by ids and by emails in one request, in the
+        order asked with the missing ones reported
+        """
+        url = reverse('auth:user_batch')
+        headers = {'HTTP_BEARER_API_KEY':self.user_key}
+        users = [
+            User.objects.create_user(email=f'batch{i}@email.com', first_name='batch', last_name='user', password='randopass')
+            for i in range(5)
+        ]
+
+        # Without api key
+        response = self.client.post(url, {'ids': [users[0].pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        ids = [users[3].pk, 999, users[0].pk, users[3].pk]
+        with self.assertNumQueries(2):
+            response = self.client.post(url, {'ids': ids}, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [user and user['email'] for user in response.data['users']],
+            ['batch3@email.com', None, 'batch0@email.com', 'batch3@email.com'])
+        self.assertEqual(response.data['missing'], [999])
+        self.assertIn('username', response.data['users'][0]['profile'])
+
+        response = self.client.post(url, {'emails': ['batch4@email.com', 'nobody@email.com']}, format='json', **headers)
+        self.assertEqual([user and user['email'] for user in response.data['users']], ['batch4@email.com', None])
+        self.assertEqual(response.data['missing'], ['nobody@email.com'])
+
+        # One list, within the limit
+        response = self.client.post(url, {'ids': [1], 'emails': ['batch4@email.com']}, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(USER_BATCH_LIMIT=2):
+            response = self.client.post(url, {'ids': ids}, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_user_sparse_fields(self):
+        """
+        Test ?fields= on the user endpoints, the profile is only joined when
+        it is shown
+        """
+        headers = {'HTTP_BEARER_API_KEY':self.user_key}
+        user = User.objects.get(email='netrobeweb@gmail.com')
+        url = reverse('auth:user_list')
+        self.client.get(url, format='json', **headers)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'fields': 'email,first_name'}, format='json', **headers)
+        self.assertEqual(response.data['results'], [{'email': user.email, 'first_name': 'netro'}])
+        self.assertNotIn('authentication_profile', queries[-1]['sql'])
+        self.assertNotIn('"password"', queries[-1]['sql'])
+
+        response = self.client.get(url, {'fields': 'email,profile.username,profile.gender'}, format='json', **headers)
+        self.assertEqual(response.data['results'][0]['profile'], {'username': user.profile.username, 'gender': '0'})
+
+        response = self.client.get(reverse('auth:user_data', kwargs={'id': user.pk}), {'fields': 'last_name'}, format='json', **headers)
+        self.assertEqual(response.data, {'last_name': 'webby'})
+
+        response = self.client.post(url_with_params(reverse('auth:user_batch'), {'fields': 'email'}), {'ids': [user.pk]}, format='json', **headers)
+        self.assertEqual(response.data['users'], [{'email': user.email}])
+
     def test_sendmail(self):
         """
         Test for sending mail to user with and without api key
@@ -322,6 +563,73 @@ class AuthenticationAppTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
         # With api key (correct data)
-        response = self.client.get(url, {'id': 1}, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        response = self.client.get(url, {'id': 1, 'subject': 'Hello'}, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-    
\ No newline at end of file
+
+        # Queued for the deliver_emails worker
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.objects.filter(user_id=1, subject='Hello').count(), 1)
+
+    def test_admin_access_claims(self):
+        """
+        Test that admin tokens are authorized from their claims alone and
+        non staff tokens are rejected
+        """
+        url = reverse('auth:gen_otp')
+        user = User.objects.get(email='netrobeweb@gmail.com')
+
+        # Non staff token without api key
+        self.client.credentials(HTTP_AUTHORIZATION = 'Bearer '+get_tokens_for_user(user)['access'])
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # Staff token without api key, no query is made for the user
+        user.staff = True
+        user.save()
+        self.client.credentials(HTTP_AUTHORIZATION = 'Bearer '+get_tokens_for_user(user)['access'])
+        with self.assertNumQueries(0):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(ACCESS_CLAIMS_REVALIDATE_SECONDS=60)
+    def test_admin_access_claims_revalidation(self):
+        """
+        Test that revalidated claims are read once per period and follow
+        changes made to the user
+        """
+        access_claims_cache.clear()
+        url = reverse('auth:gen_otp')
+        user = User.objects.get(email='netrobeweb@gmail.com')
+        user.staff = True
+        user.save()
+        self.client.credentials(HTTP_AUTHORIZATION = 'Bearer '+get_tokens_for_user(user)['access'])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Removing staff access takes effect with the same token
+        user.staff = False
+        user.save()
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_user_list_keyset_pagination(self):
+        """
+        Test the cursor pages of the user list ordered by first name
+        """
+        for name in ['alan', 'zara', 'mike']:
+            User.objects.create_user(email=f'{name}@email.com', first_name=name, last_name='webby', password='randopass')
+
+        url = url_with_params(reverse('auth:user_list'), {'cursor': '', 'page_size': 2})
+        names = []
+        while url:
+            response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            names += [i['first_name'] for i in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(names, ['alan', 'mike', 'netro', 'zara'])
+
@@ -2,6 +2,7 @@ from django.contrib.auth.password_validation import validate_password
 from rest_framework import serializers
 
 from authentication.models import User, Profile
+from xcrowmeapi.fieldsets import SparseFieldsMixin
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -38,26 +39,41 @@ class LoginSerializer(serializers.Serializer):
         password = attrs['password']
 
         """
-        Check that the email is available in the User table
+        Check that the email is available in the User table, the user is
+        loaded with its profile for the response and kept in <user>
         """
         try:
-            user = User.objects.get(email=email)
+            user = User.objects.select_related('profile').get(email=email)
         except User.DoesNotExist:
+            # Hash anyway so unknown emails take as long as wrong passwords
+            User().set_password(password)
             raise serializers.ValidationError({"email": 'Details do not match an active account'})
         
+        # Passwords hashed with older hasher settings are rehashed here
         if not user.check_password(password):
             raise serializers.ValidationError({"password": 'Your password is incorrect'})
 
+        attrs['user'] = user
         return attrs
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class OtpSerializer(serializers.Serializer):
+    # The email, phone number or id the otp is for
+    key = serializers.CharField(required=True, max_length=254)
+
+
+class VerifyOtpSerializer(OtpSerializer):
+    otp = serializers.RegexField(r'^[0-9]+$', required=True, max_length=12)
+
+
+class ProfileSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Profile
         fields = '__all__'
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    # ?fields=email,profile.username drops the rest of the profile
     profile = ProfileSerializer(read_only=True)
     class Meta:
         model = User
@@ -71,6 +87,24 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 
+class UserBatchSerializer(serializers.Serializer):
+    # Users by id or by email, one of the two lists
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False)
+    emails = serializers.ListField(child=serializers.EmailField(), required=False)
+
+    def validate(self, attrs):
+        lookups = [field for field in ('ids', 'emails') if attrs.get(field)]
+        if len(lookups) != 1:
+            raise serializers.ValidationError('Send a list of ids or a list of emails')
+
+        limit = self.context['limit']
+        if len(attrs[lookups[0]]) > limit:
+            raise serializers.ValidationError(f'You can only look up {limit} users at a time')
+        attrs['field'] = {'ids': 'id', 'emails': 'email'}[lookups[0]]
+        attrs['values'] = attrs[lookups[0]]
+        return attrs
+
+
 class ForgetChangePasswordSerializer(serializers.ModelSerializer):
     profile = ProfileSerializer(read_only=True)
     new_password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
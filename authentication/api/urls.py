@@ -1,6 +1,6 @@
 from django.urls import path
 # from rest_framework_simplejwt.views import TokenRefreshView
-from . import views
+from . import async_views, views
 
 app_name = 'auth'
 urlpatterns = [
@@ -16,12 +16,14 @@ urlpatterns = [
 	path('token/generate/', views.GenerateTokenView.as_view(), name='gen_token'),
 	path('token/validate/', views.ValidateTokenView.as_view(), name='validate_token'),
 
-	# Path for generating otp
+	# Path for generating otp, and verifying the ones generated with a key
 	path('generate_otp/', views.GenerateOtpView.as_view(), name='gen_otp'),
+	path('verify_otp/', views.VerifyOtpView.as_view(), name='verify_otp'),
 
 	# Paths for getting and finding user informations
 	path('users/', views.UserListView.as_view(), name='user_list'),
-	path('users/detail/<int:id>/', views.UserAPIView.as_view(), name='user_data'),
+	path('users/detail/<int:id>/', async_views.UserAPIView.as_view(), name='user_data'),
+	path('users/batch/', views.UserBatchView.as_view(), name='user_batch'),
 
 	# Extra utility paths
 	path('user/send-mail/', views.SendMailView.as_view(), name='send_mail'),
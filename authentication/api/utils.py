@@ -2,6 +2,11 @@ from rest_framework_simplejwt.tokens import RefreshToken
 
 def get_tokens_for_user(user):
 	refresh = RefreshToken.for_user(user)
+
+	# Access claims, copied to the access token and read by IsAuthenticatedAdmin
+	refresh['staff'] = user.staff
+	refresh['admin'] = user.admin
+	refresh['active'] = user.active
 	return {
 		'refresh': str(refresh),
 		'access': str(refresh.access_token),
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.encoding import force_text, force_bytes
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
@@ -14,18 +15,25 @@ from rest_framework_simplejwt.views import TokenRefreshView
 from project_api_key.permissions import HasStaffProjectAPIKey
 
 from authentication.tokens import acount_confirm_token
+from authentication import otp as otp_store
 from authentication.models import User
 from authentication.utils import random_otp
 from authentication.permissions import IsAuthenticatedAdmin
+from xcrowmeapi.fieldsets import SparseFieldsViewMixin, parse_tree
+from xcrowmeapi.profiling import ProfiledViewMixin
+from xcrowmeapi.throttling import ThrottleFirstMixin
 
 from . import serializers
 from .utils import get_tokens_for_user
 
 
 # Views below
-class GenerateTokenView(APIView):
+class GenerateTokenView(ThrottleFirstMixin, APIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
 
+    def get_throttle_target(self, request):
+        return f'user:{request.query_params.get("id", "")}'
+
     def get(self, request, format=None):
         # Get required info from the request handler
         pk = request.query_params.get('id', '')
@@ -45,13 +53,21 @@ class GenerateTokenView(APIView):
         }, status=status.HTTP_200_OK)
 
 
-class ValidateTokenView(APIView):
+class ValidateTokenView(ThrottleFirstMixin, APIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
 
+    def get_throttle_target(self, request):
+        # Guesses of the token of one user, bodies that aren't objects are
+        # rejected by the view
+        if not isinstance(request.data, dict):
+            return None
+        return f'uid:{request.data.get("uidb64", "")}'
+
     def post(self, request, format=None):
         # Get the uid and token from the data passed
-        uidb64 = request.data.get('uidb64', '')
-        token = request.data.get('token', '')
+        data = request.data if isinstance(request.data, dict) else {}
+        uidb64 = data.get('uidb64', '')
+        token = data.get('token', '')
         try:
             uidb64=force_text(urlsafe_base64_decode(uidb64))
             user=User.objects.get(id=uidb64)
@@ -71,9 +87,15 @@ class ValidateTokenView(APIView):
             raise ParseError(detail='Invalid token')
 
 
-class GenerateOtpView(APIView):
+class GenerateOtpView(ThrottleFirstMixin, APIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
 
+    def get_throttle_target(self, request):
+        if request.method != 'POST' or not isinstance(request.data, dict):
+            return None
+        key = request.data.get('key')
+        return f'otp:{key}' if key else None
+
     def get(self, request, format=None):
         # Generate a random otp
         otp = random_otp()
@@ -82,21 +104,66 @@ class GenerateOtpView(APIView):
             'otp': otp
         }, status=status.HTTP_200_OK)
 
+    def post(self, request, format=None):
+        # Generate an otp kept by the server for <key>, see VerifyOtpView
+        serializer = serializers.OtpSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        otp, ttl = otp_store.generate(serializer.validated_data['key'])
+
+        return Response({
+            'otp': otp,
+            'expires_in': ttl
+        }, status=status.HTTP_200_OK)
+
+
+class VerifyOtpView(ThrottleFirstMixin, APIView):
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'POST': 1}
+
+    def get_throttle_target(self, request):
+        # Same bucket as the generation, a new otp doesn't bring new guesses
+        if not isinstance(request.data, dict):
+            return None
+        key = request.data.get('key')
+        return f'otp:{key}' if key else None
+
+    def post(self, request, format=None):
+        serializer = serializers.VerifyOtpSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        valid, attempts_left = otp_store.verify(
+            serializer.validated_data['key'], serializer.validated_data['otp'])
+
+        if valid:
+            return Response({'valid': True}, status=status.HTTP_200_OK)
+        if attempts_left:
+            return Response({
+                'error': 'Invalid otp',
+                'attempts_left': attempts_left
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'error': 'Otp expired or not found'}, status=status.HTTP_400_BAD_REQUEST)
+
 
 class TokenRefreshView(TokenRefreshView):
     permission_classes = (HasStaffProjectAPIKey,)
     # serializer_class = TokenRefreshLifetimeSerializer
 
-class LoginAPIView(APIView):
+class LoginAPIView(ThrottleFirstMixin, APIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
     serializer_class = serializers.LoginSerializer
+    # The user and its profile in one query, and the api key when it is
+    # not cached
+    query_budget = {'POST': 2}
+
+    def get_throttle_target(self, request):
+        # Bodies that aren't objects are rejected by the serializer
+        if not isinstance(request.data, dict):
+            return None
+        return request.data.get('email')
 
     def post(self, request, format=None):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
-            email = serializer.validated_data.get('email')
-
-            user = User.objects.get(email=email)
+            user = serializer.validated_data['user']
 
             if user.is_active:
                 if user.confirmed_email:
@@ -151,18 +218,23 @@ class ChangePasswordView(UpdateAPIView):
         return User.objects.filter(active=True)
 
 
-class UserListView(ListAPIView):
+class UserListView(SparseFieldsViewMixin, ProfiledViewMixin, ListAPIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
     serializer_class = serializers.UserSerializer
+    keyset_ordering = ('first_name', 'id')
+    # The api key, the page with the profiles and the optional count
+    query_budget = {'GET': 3}
 
     def get_queryset(self):
-        return User.objects.all().order_by('first_name')
+        # The profiles are joined by SparseFieldsViewMixin when they are shown
+        return User.objects.order_by('first_name')
 
 
-class UserAPIView(RetrieveAPIView):
+class UserAPIView(SparseFieldsViewMixin, RetrieveAPIView):
     lookup_field = 'id'
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
     serializer_class = serializers.UserSerializer
+    query_budget = {'GET': 3}
 
     def get_queryset(self):
         return User.objects.all()
@@ -170,10 +242,41 @@ class UserAPIView(RetrieveAPIView):
     def get(self, request, *args, **kwargs):
         user = self.get_object()
         if user is not None:
-            return Response(self.get_serializer_class()(user).data)
+            return Response(self.get_serializer(user).data)
         return NotFound(detail='User does not exist')
 
 
+class UserBatchView(APIView):
+    """
+    The users of a list of ids or of emails in one query, up to
+    <USER_BATCH_LIMIT> of them. <users> follows the order of the list with
+    null for the ones not found, which are also listed in <missing>
+    """
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    serializer_class = serializers.UserSerializer
+    query_budget = {'POST': 2}
+
+    def post(self, request, format=None):
+        lookup = serializers.UserBatchSerializer(
+            data=request.data, context={'limit': settings.USER_BATCH_LIMIT})
+        lookup.is_valid(raise_exception=True)
+        field, values = lookup.validated_data['field'], lookup.validated_data['values']
+
+        # One serializer for the whole list, its fields are built once. The
+        # lookup is a POST, ?fields= and ?expand= are passed on explicitly
+        params = request.query_params
+        serializer = self.serializer_class(
+            many=True, fields=parse_tree(params['fields']) if params.get('fields') else None,
+            expand=parse_tree(params.get('expand', '')))
+        users = serializer.child.sparse_queryset(User.objects.all(), ('pk', field)).in_bulk(set(values), field_name=field)
+        serializer.instance = list(users.values())
+        found = dict(zip(users, serializer.data))
+        return Response({
+            'users': [found.get(value) for value in values],
+            'missing': [value for value in values if value not in found]
+        }, status=status.HTTP_200_OK)
+
+
 class SendMailView(APIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
 
@@ -190,6 +293,7 @@ class SendMailView(APIView):
         """
         subject = request.query_params.get('subject', '')
         message = request.query_params.get('message', '')
+        # Queued in the outbox, the deliver_emails worker sends it
         sent = user.email_user(subject,message)
         
         return Response({
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from authentication.outbox import deliver
+
+
+class Command(BaseCommand):
+    help = 'Sends the queued emails of the outbox, retrying the failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Emails sent over one connection')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to wait when no email is due')
+        parser.add_argument('--once', action='store_true', help='Send the due emails and exit')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        try:
+            while True:
+                sent, failed = deliver(options['batch_size'])
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    self.stdout.write(f'Sent {sent} emails, {failed} failed')
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Sent {total_sent} emails, {total_failed} failed'))
@@ -1,12 +1,12 @@
 from django.forms import ValidationError
-from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.core.validators import RegexValidator
-from django.core.mail import send_mail
 from django.db import models
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 
+from .cache import access_claims_cache
 from .utils import get_usable_name, validate_phone
 from .validators import validate_special_char
 
@@ -97,10 +97,14 @@ class User(AbstractBaseUser):
     def has_module_perms(self, app_label):
         return True
 
-    def email_user(self, subject, message, fail=True):
-        print(message)
-        val = send_mail(subject=subject, message=message, from_email=settings.DEFAULT_FROM_EMAIL, recipient_list=[self.email], fail_silently=fail)
-        return True if val else False
+    def email_user(self, subject, message):
+        """
+        Queues the email in the outbox, it is sent by the deliver_emails
+        worker which retries failed deliveries
+        """
+        from .outbox import enqueue
+
+        return bool(enqueue(subject, message, [self.email], user=self))
 
     def convert(self, boolean):
         if boolean:
@@ -193,6 +197,37 @@ class Profile(models.Model):
     class Meta:
         verbose_name = 'Profile'
 
+class OutgoingEmail(models.Model):
+    STATUS = [
+        ('pending', 'Pending',),
+        ('sent', 'Sent',),
+        ('failed', 'Failed',),
+    ]
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    recipient = models.EmailField(max_length=255)
+    from_email = models.CharField(max_length=255)
+    subject = models.TextField(blank=True)
+    message = models.TextField(blank=True)
+
+    status = models.CharField(choices=STATUS, max_length=20, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Pending emails are sent from this time, it is pushed back on failures
+    # and while a worker holds the email
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.recipient}: {self.subject}'
+
+    class Meta:
+        verbose_name = 'Outgoing email'
+        indexes = [
+            # Due emails of the delivery worker
+            models.Index(fields=['status', 'next_attempt'], name='outbox_due_idx'),
+        ]
+
 @receiver(post_save, sender=User)
 def create_profile(sender, instance, created, **kwargs):
     if created:
@@ -203,3 +238,7 @@ def create_profile(sender, instance, created, **kwargs):
 def update_user(sender, instance, **kwargs):
     instance.update_level()
 
+@receiver(post_save, sender=User)
+def refresh_access_claims(sender, instance, **kwargs):
+    access_claims_cache.pop(instance.pk)
+
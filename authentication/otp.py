@@ -0,0 +1,218 @@
+"""
+One time passwords kept by the server, client systems generate an otp for a
+key of their choosing (an email, a phone number, a user id) and verify what
+their user typed against it.
+
+An otp is <OTP_DIGITS> digits from <secrets>, valid for <OTP_TTL> seconds
+and for <OTP_MAX_ATTEMPTS> wrong guesses, it is used up once verified. A new
+otp for a key replaces the previous one.
+
+Neither the keys nor the otps are stored, only keyed blake2b digests of
+them (12 and 8 bytes) next to the expiry and the attempts, packed in 13
+bytes. Otps are compared in constant time. The in process store holds at
+most <OTP_STORE_MAX_SIZE> otps, about 130 bytes each: expired otps are
+dropped when they are read and, every <OTP_SWEEP_INTERVAL> seconds, when
+otps are added. Every otp lives for the same ttl so the store is in expiry
+order and a sweep stops at the first live otp, once full the otps closest
+to expiring make room. With <OTP_CACHE> set to a cache alias the otps are
+kept in that cache instead so every worker can verify them.
+"""
+import hashlib
+import hmac
+import struct
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .utils import random_otp
+
+# otp digest, expiry (epoch seconds), wrong attempts
+ENTRY = struct.Struct('<8sIB')
+
+
+class OtpStore:
+    """
+    Packed otp entries by key digest, in insertion order which is their
+    expiry order
+    """
+    def __init__(self, max_size=1000000, sweep_interval=60):
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._entries = {}
+        self._swept_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and ENTRY.unpack(entry)[1] <= time.time():
+            # Lazy eviction
+            del self._entries[key]
+            return None
+        return entry
+
+    def set(self, key, entry, replace=True):
+        # <replace> moves the key to the end, use it for new otps only
+        with self._lock:
+            if replace:
+                self._entries.pop(key, None)
+            self._entries[key] = entry
+            now = time.time()
+            if now - self._swept_at >= self.sweep_interval or len(self._entries) > self.max_size:
+                self.sweep(now)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def update(self, key, change):
+        """
+        Reads the entry of <key> (None if there is none) and replaces it with
+        the entry returned by change(entry) as one step, None deletes it.
+        <change> returns (new entry, result), returns the result
+        """
+        with self._lock:
+            entry, result = change(self._get(key))
+            if entry is None:
+                self._entries.pop(key, None)
+            else:
+                # An existing key keeps its place
+                self._entries[key] = entry
+            return result
+
+    def sweep(self, now):
+        # Drops the expired otps from the front, then the oldest ones over max size
+        self._swept_at = now
+        expired = []
+        for key, entry in self._entries.items():
+            if ENTRY.unpack(entry)[1] > now:
+                break
+            expired.append(key)
+        for key in expired:
+            del self._entries[key]
+        while len(self._entries) > self.max_size:
+            del self._entries[next(iter(self._entries))]
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedOtpStore:
+    """
+    Otp entries kept in a django cache for all the workers, which expires
+    them. Updates hold a lock key taken with <cache.add> for the otp, the
+    lock expires after <lock_timeout> seconds if its worker dies
+    """
+    key_format = 'otp:{}'
+    lock_timeout = 5
+    # Tries to take a busy lock, every 10ms
+    lock_tries = 50
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(self.key_format.format(key.hex()))
+
+    def set(self, key, entry, replace=True):
+        timeout = max(1, ENTRY.unpack(entry)[1] - int(time.time()))
+        self.cache.set(self.key_format.format(key.hex()), entry, timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.key_format.format(key.hex()))
+
+    def update(self, key, change):
+        # Like OtpStore.update, an otp that stays locked counts as missing
+        cache_key = self.key_format.format(key.hex())
+        lock = f'{cache_key}:lock'
+        for _ in range(self.lock_tries):
+            if self.cache.add(lock, 1, self.lock_timeout):
+                break
+            time.sleep(0.01)
+        else:
+            return change(None)[1]
+        try:
+            entry, result = change(self.cache.get(cache_key))
+            if entry is None:
+                self.cache.delete(cache_key)
+            else:
+                self.set(key, entry)
+            return result
+        finally:
+            self.cache.delete(lock)
+
+
+local_store = OtpStore(
+    max_size=getattr(settings, 'OTP_STORE_MAX_SIZE', 1000000),
+    sweep_interval=getattr(settings, 'OTP_SWEEP_INTERVAL', 60),
+)
+
+
+def get_store():
+    alias = getattr(settings, 'OTP_CACHE', None)
+    if alias:
+        return SharedOtpStore(caches[alias])
+    return local_store
+
+
+@lru_cache(maxsize=None)
+def _digest_key(secret):
+    return hashlib.sha256(f'authentication.otp:{secret}'.encode()).digest()
+
+
+def key_digest(key):
+    key = str(key).strip().lower().encode()
+    return hashlib.blake2b(key, digest_size=12, key=_digest_key(settings.SECRET_KEY)).digest()
+
+
+def otp_digest(key, otp):
+    # Bound to the key digest, an otp of one key is no use for another
+    return hashlib.blake2b(otp.encode(), digest_size=8, key=_digest_key(settings.SECRET_KEY), salt=key[:8]).digest()
+
+
+def generate(key):
+    """
+    Creates the otp of <key>, replacing any previous one, returns the otp
+    and its ttl in seconds
+    """
+    otp = random_otp(getattr(settings, 'OTP_DIGITS', 6))
+    ttl = getattr(settings, 'OTP_TTL', 300)
+    digest = key_digest(key)
+    get_store().set(digest, ENTRY.pack(otp_digest(digest, otp), int(time.time()) + ttl, 0))
+    return otp, ttl
+
+
+def verify(key, otp):
+    """
+    Checks <otp> against the otp of <key>, returns (valid, attempts left).
+    A valid otp is used up, so is one guessed wrong too many times. The
+    check and the attempt count are one store update, concurrent guesses
+    are all counted and an otp is only valid once
+    """
+    digest = key_digest(key)
+    guess = otp_digest(digest, str(otp))
+    max_attempts = getattr(settings, 'OTP_MAX_ATTEMPTS', 5)
+
+    def check(entry):
+        if entry is None:
+            return None, (False, 0)
+        expected, expiry, attempts = ENTRY.unpack(entry)
+        if hmac.compare_digest(expected, guess):
+            return None, (True, 0)
+        attempts += 1
+        left = max_attempts - attempts
+        if left <= 0:
+            return None, (False, 0)
+        return ENTRY.pack(expected, expiry, attempts), (False, left)
+
+    return get_store().update(digest, check)
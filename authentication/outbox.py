@@ -0,0 +1,116 @@
+"""
+Outbox of the emails sent to users.
+
+Requests only queue their emails (<enqueue>), the deliver_emails worker
+sends the due ones in batches over a single connection of the email
+backend (<deliver>). A failed email is tried again after
+<EMAIL_OUTBOX_RETRY_DELAY> seconds, doubled on every attempt, and is marked
+failed after <EMAIL_OUTBOX_MAX_ATTEMPTS> attempts. A worker holds the emails
+of its batch for <EMAIL_OUTBOX_LEASE> seconds so other workers skip them,
+emails of a worker that died are sent again once the lease is over.
+"""
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+
+def enqueue(subject, message, recipients, from_email=None, user=None):
+    """Queues one email per recipient, returns the queued emails"""
+    from_email = from_email or settings.DEFAULT_FROM_EMAIL
+    return OutgoingEmail.objects.bulk_create([
+        OutgoingEmail(user=user, recipient=recipient, from_email=from_email, subject=subject, message=message)
+        for recipient in recipients
+    ])
+
+
+def retry_delay(attempts):
+    # Seconds before the next attempt after <attempts> failed ones
+    return getattr(settings, 'EMAIL_OUTBOX_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+
+
+def claim(batch_size, now):
+    """
+    Takes up to <batch_size> due emails for this worker, they are leased so
+    that other workers don't send them at the same time
+    """
+    with transaction.atomic():
+        due = OutgoingEmail.objects.filter(status='pending', next_attempt__lte=now).order_by('next_attempt', 'id')
+        if not connection.features.has_select_for_update_skip_locked:
+            return take(list(due[:batch_size]), now)
+        # Locked rows are skipped by the other workers until they are leased
+        emails = list(due.select_for_update(skip_locked=True)[:batch_size])
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(next_attempt=lease_end(now))
+    return emails
+
+
+def take(emails, now):
+    """
+    Leases the <emails> that are still due and returns them, without row
+    locks another worker may have taken some of them since they were read.
+    The lease end of every claim differs, it tells which rows this one got
+    """
+    pks = [email.pk for email in emails]
+    until = lease_end(now)
+    OutgoingEmail.objects.filter(pk__in=pks, status='pending', next_attempt__lte=now).update(next_attempt=until)
+    taken = set(OutgoingEmail.objects.filter(pk__in=pks, next_attempt=until).values_list('pk', flat=True))
+    return [email for email in emails if email.pk in taken]
+
+
+def lease_end(now):
+    lease = getattr(settings, 'EMAIL_OUTBOX_LEASE', 300)
+    return now + timedelta(seconds=lease, microseconds=secrets.randbelow(1000000))
+
+
+def record_failure(email, error, max_attempts):
+    email.attempts += 1
+    email.last_error = f'{type(error).__name__}: {error}'
+    if email.attempts >= max_attempts:
+        email.status = 'failed'
+    else:
+        email.next_attempt = timezone.now() + timedelta(seconds=retry_delay(email.attempts))
+
+
+def deliver(batch_size=100, backend=None):
+    """
+    Sends a batch of due emails, returns (sent, failed) counts. Failures are
+    recorded on the emails for a later attempt
+    """
+    emails = claim(batch_size, timezone.now())
+    if not emails:
+        return 0, 0
+
+    max_attempts = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+    sent, failed = [], []
+    # One connection (one SMTP session) for the whole batch
+    mail_connection = get_connection(backend, fail_silently=False)
+    try:
+        mail_connection.open()
+    except Exception as e:
+        for email in emails:
+            record_failure(email, e, max_attempts)
+        failed = emails
+    else:
+        try:
+            for email in emails:
+                message = EmailMessage(
+                    email.subject, email.message, email.from_email, [email.recipient], connection=mail_connection)
+                try:
+                    message.send()
+                except Exception as e:
+                    record_failure(email, e, max_attempts)
+                    failed.append(email)
+                else:
+                    email.attempts += 1
+                    email.status, email.sent, email.last_error = 'sent', timezone.now(), ''
+                    sent.append(email)
+        finally:
+            mail_connection.close()
+
+    OutgoingEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt', 'last_error', 'sent'])
+    return len(sent), len(failed)
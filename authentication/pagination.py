@@ -1,6 +1,147 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination on the view's <keyset_ordering> fields, the last field
+    must be unique (usually id). Pages are found by filtering past the cursor
+    values instead of an OFFSET, and the total count is only computed when
+    asked for with <?count=true>
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = tuple(view.keyset_ordering)
+        self.model = queryset.model
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() in ('1', 'true'):
+            self.count = queryset.count()
+
+        position, reverse = self.decode_cursor(request)
+        if reverse:
+            queryset = queryset.order_by(*[f'-{field}' for field in self.ordering])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(position, reverse))
+
+        # Fetch one extra row to know if there is another page
+        results = list(queryset[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+
+        has_next, has_previous = has_more, position is not None
+        if reverse:
+            has_next, has_previous = has_previous, has_next
+        self.next_position = self.get_position(results[-1]) if (results and has_next) else None
+        self.previous_position = self.get_position(results[0]) if (results and has_previous) else None
+        return results
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        if self.count is not None:
+            response['count'] = self.count
+            response.move_to_end('count', last=False)
+        return Response(response)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_keyset_filter(self, position, reverse):
+        # (a, b) > (x, y) is (a > x) or (a = x and b > y)
+        lookup = 'lt' if reverse else 'gt'
+        keyset = Q()
+        for index, field in enumerate(self.ordering):
+            condition = Q(**{f'{field}__{lookup}': position[index]})
+            for previous, value in zip(self.ordering[:index], position):
+                condition &= Q(**{previous: value})
+            keyset |= condition
+        return keyset
+
+    def get_position(self, obj):
+        return [getattr(obj, field) for field in self.ordering]
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(self.next_position, False))
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(self.previous_position, True))
+
+    def encode_cursor(self, position, reverse):
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in position]
+        data = json.dumps({'p': values, 'r': int(reverse)}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param, '')
+        if not cursor:
+            return None, False
+
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            values = data['p']
+            if len(values) != len(self.ordering):
+                raise ValueError
+            position = [
+                self.model._meta.get_field(field).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+            return position, bool(data.get('r'))
+        except (TypeError, ValueError, KeyError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
 
 class CustomPagination(PageNumberPagination):
     page_size = 100
     page_size_query_param = 'page_size'
-    max_page_size = 1000
\ No newline at end of file
+    max_page_size = 1000
+
+    # Views with <keyset_ordering> switch to keyset pagination with ?cursor=
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if getattr(view, 'keyset_ordering', None) and self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -1,12 +1,64 @@
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import BasePermission
+from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
 
+from .cache import access_claims_cache
 from .models import User
 
+# Access claims added to tokens by <get_tokens_for_user>
+ACCESS_CLAIMS = ('staff', 'admin', 'active')
+
+
+def get_access_claims(user, database=True):
+    """
+    Returns the staff/admin/active flags of an authenticated user, from the
+    token claims when the request was authenticated by JWT. With
+    <ACCESS_CLAIMS_REVALIDATE_SECONDS> set, or for tokens issued without the
+    claims, the flags are read from the database at most once per period
+    (with <database> False None is returned instead).
+    """
+    token = getattr(user, 'token', None)
+    if token is None:
+        # Session and basic authentication already loaded the user
+        return {'staff': user.staff, 'admin': user.admin, 'active': user.active}
+
+    revalidate = getattr(settings, 'ACCESS_CLAIMS_REVALIDATE_SECONDS', None)
+    if revalidate is None and all(claim in token for claim in ACCESS_CLAIMS):
+        return {claim: token[claim] for claim in ACCESS_CLAIMS}
+
+    claims = access_claims_cache.get(user.pk, max_age=revalidate)
+    if claims is None:
+        if not database:
+            return None
+        values = User.objects.filter(pk=user.pk).values(*ACCESS_CLAIMS).first()
+        if values is None:
+            return None
+        claims = values
+        access_claims_cache.set(user.pk, claims)
+    return claims
+
+
 class IsAuthenticatedAdmin(BasePermission):
     def has_permission(self, request, view):
-        # Get the user, if the user is staff or admin (open access)
+        # Get the user claims, if the user is staff or admin (open access)
         if request.user.is_authenticated:
-            user = User.objects.get(pk=request.user.pk)
-            if user.staff or user.admin:
+            claims = get_access_claims(request.user)
+            if claims and claims['active'] and (claims['staff'] or claims['admin']):
                 return True
-        return False
\ No newline at end of file
+        return False
+
+    def has_cached_permission(self, request):
+        """
+        True when the request carries a JWT access token whose claims grant
+        access, checked without the database (for async views). False means
+        unknown, not denied
+        """
+        try:
+            authenticated = JWTTokenUserAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        if authenticated is None:
+            return False
+        claims = get_access_claims(authenticated[0], database=False)
+        return bool(claims and claims['active'] and (claims['staff'] or claims['admin']))
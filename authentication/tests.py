@@ -1,3 +1,143 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import OutgoingEmail, User
+from .otp import ENTRY, OtpStore, SharedOtpStore
+from .outbox import claim, deliver, take
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='netrobeweb@gmail.com', first_name='netro', last_name='webby', password='randopass')
+
+    def test_emails_are_queued_and_delivered(self):
+        self.assertTrue(self.user.email_user('Welcome', 'Hello there'))
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.recipient, email.status, email.user), (self.user.email, 'pending', self.user))
+
+        call_command('deliver_emails', once=True, stdout=mock.MagicMock())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual((mail.outbox[0].subject, mail.outbox[0].to), ('Welcome', [self.user.email]))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('sent', 1))
+        self.assertIsNotNone(email.sent)
+
+        # Sent emails are not sent again
+        self.assertEqual(deliver(), (0, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_batches_use_one_connection(self):
+        for i in range(5):
+            self.user.email_user(f'Subject {i}', 'Message')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open') as open_connection:
+            self.assertEqual(deliver(batch_size=3), (3, 0))
+            self.assertEqual(deliver(batch_size=3), (2, 0))
+        self.assertEqual(open_connection.call_count, 2)
+        self.assertEqual([i.subject for i in mail.outbox], [f'Subject {i}' for i in range(5)])
+
+    @override_settings(EMAIL_OUTBOX_RETRY_DELAY=10, EMAIL_OUTBOX_MAX_ATTEMPTS=3)
+    def test_failed_emails_are_retried_with_backoff(self):
+        self.user.email_user('Welcome', 'Hello there')
+        email = OutgoingEmail.objects.get()
+
+        send = 'django.core.mail.backends.locmem.EmailBackend.send_messages'
+        with mock.patch(send, side_effect=ConnectionError('SMTP is down')):
+            start = timezone.now()
+            self.assertEqual(deliver(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), ('pending', 1))
+            self.assertIn('SMTP is down', email.last_error)
+            self.assertGreaterEqual(email.next_attempt, start + timedelta(seconds=10))
+
+            # Not due yet
+            self.assertEqual(deliver(), (0, 0))
+
+            # The delay doubles, the last attempt marks it failed
+            OutgoingEmail.objects.update(next_attempt=timezone.now())
+            deliver()
+            email.refresh_from_db()
+            self.assertGreaterEqual(email.next_attempt, timezone.now() + timedelta(seconds=19))
+            OutgoingEmail.objects.update(next_attempt=timezone.now())
+            deliver()
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), ('failed', 3))
+        self.assertEqual(deliver(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_claimed_emails_are_leased(self):
+        self.user.email_user('Welcome', 'Hello there')
+        now = timezone.now()
+        self.assertEqual(len(claim(10, now)), 1)
+
+        # Other workers skip it until the lease is over (the worker died)
+        self.assertEqual(claim(10, now), [])
+        self.assertEqual(len(claim(10, now + timedelta(seconds=301))), 1)
+
+    def test_emails_read_by_two_workers_are_taken_once(self):
+        # Without SKIP LOCKED both workers can read the same due emails
+        for i in range(2):
+            self.user.email_user(f'Subject {i}', 'Message')
+        now = timezone.now()
+        first, second = list(OutgoingEmail.objects.order_by('id')), list(OutgoingEmail.objects.order_by('id'))
+        self.assertEqual(len(take(first[:1], now)), 1)
+        self.assertEqual([email.subject for email in take(second, now)], ['Subject 1'])
+
+
+class OtpStoreTests(TestCase):
+    def entry(self, expiry):
+        return ENTRY.pack(b'\0' * 8, expiry, 0)
+
+    def test_expired_otps_are_evicted(self):
+        store = OtpStore(max_size=100, sweep_interval=60)
+        with mock.patch('authentication.otp.time.time', return_value=1000):
+            for i in range(5):
+                store.set(bytes([i]), self.entry(1010 + i))
+
+        # Read after expiry
+        with mock.patch('authentication.otp.time.time', return_value=1012):
+            self.assertIsNone(store.get(bytes([0])))
+            self.assertIsNotNone(store.get(bytes([3])))
+            store.set(b'new', self.entry(1400))
+        self.assertEqual(len(store), 5)
+
+        # Swept when otps are added once the interval is over
+        with mock.patch('authentication.otp.time.time', return_value=1060):
+            store.set(b'newer', self.entry(1400))
+        self.assertEqual(list(store._entries), [b'new', b'newer'])
+
+    def test_store_is_bounded(self):
+        store = OtpStore(max_size=3, sweep_interval=60)
+        with mock.patch('authentication.otp.time.time', return_value=1000):
+            for i in range(5):
+                store.set(bytes([i]), self.entry(1300))
+            # A new otp of a key moves it last, the closest to expiring go first
+            store.set(bytes([2]), self.entry(1300))
+        self.assertEqual(list(store._entries), [bytes([3]), bytes([4]), bytes([2])])
+
+    def test_updates_are_atomic(self):
+        # Concurrent read-modify-writes of one otp all count
+        def count(entry):
+            attempts = ENTRY.unpack(entry)[2]
+            time.sleep(0.01)
+            return ENTRY.pack(b'\0' * 8, int(time.time()) + 300, attempts + 1), attempts
+
+        for store in [OtpStore(), SharedOtpStore(caches['default'])]:
+            store.set(b'key', self.entry(int(time.time()) + 300))
+            threads = [threading.Thread(target=store.update, args=(b'key', count)) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(ENTRY.unpack(store.get(b'key'))[2], 5)
+            self.assertEqual(store.update(b'key', lambda entry: (None, 'deleted')), 'deleted')
+            self.assertIsNone(store.get(b'key'))
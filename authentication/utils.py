@@ -2,6 +2,7 @@ from datetime import datetime
 import hashlib
 import random
 import re
+import secrets
 import string
 
 from django.conf import settings
@@ -39,4 +40,5 @@ def get_usable_name(instance, profile, name=None):
 	return name
 
 def random_otp(p=6):
-	return ''.join(random.sample(string.digits,p))
\ No newline at end of file
+	# Any <p> digits, drawn from a cryptographically secure source
+	return str(secrets.randbelow(10 ** p)).zfill(p)
\ No newline at end of file
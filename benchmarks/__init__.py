@@ -0,0 +1,35 @@
+"""
+Benchmarks for the api, run them from the project root with
+<python -m benchmarks.<name>>. Each benchmark runs against a fresh test
+database so it never touches db.sqlite3
+"""
+import os
+import time
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'xcrowmeapi.settings')
+
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def measure(func, number=1000):
+    """Returns the average cost of <func> in microseconds"""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def report(title, rows):
+    # rows are (label, value) pairs
+    print(title)
+    width = max(len(label) for label, _ in rows)
+    for label, value in rows:
+        print(f'  {label.ljust(width)}  {value}')
@@ -0,0 +1,50 @@
+"""
+Per request cost of HasStaffProjectAPIKey before and after the verified
+key cache
+"""
+from . import setup, measure, report
+
+
+def main(number=2000):
+    setup()
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from rest_framework.test import APIRequestFactory
+    from rest_framework_api_key.permissions import BaseHasAPIKey
+
+    from project_api_key.cache import key_cache
+    from project_api_key.models import ProjectUser, ProjectUserAPIKey
+    from project_api_key.permissions import HasStaffProjectAPIKey
+
+    project_user = ProjectUser.objects.create(name='Benchmark Staff User', staff=True)
+    _, key = ProjectUserAPIKey.objects.create_key(name=project_user.name, project=project_user)
+    request = APIRequestFactory().get('/', **{'HTTP_BEARER_API_KEY': key})
+
+    class UncachedHasStaffProjectAPIKey(BaseHasAPIKey):
+        # The check as it was before the cache, two verifications per request
+        model = ProjectUserAPIKey
+
+        def has_permission(self, request, view):
+            if super().has_permission(request, view):
+                api_key = self.model.objects.get_from_key(self.get_key(request))
+                return (api_key.project.staff or api_key.project.admin)
+            return False
+
+    rows = []
+    for label, permission, before in (
+        ('before (uncached)', UncachedHasStaffProjectAPIKey(), key_cache.clear),
+        ('after (cached)', HasStaffProjectAPIKey(), lambda: None),
+    ):
+        before()
+        permission.has_permission(request, None)
+        with CaptureQueriesContext(connection) as queries:
+            permission.has_permission(request, None)
+        cost = measure(lambda: permission.has_permission(request, None), number)
+        rows.append((label, f'{cost:10.1f} us/request  {len(queries)} queries/request'))
+
+    report(f'HasStaffProjectAPIKey.has_permission ({number} requests)', rows)
+
+
+if __name__ == '__main__':
+    main()
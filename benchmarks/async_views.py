@@ -0,0 +1,309 @@
+"""
+Throughput of the read endpoints at high concurrency, served by the DRF views
+under WSGI and by the async views under ASGI.
+
+The WSGI server handles connections in a fixed pool of <--threads> threads
+(like a gthread worker), the ASGI one in a single event loop. Every client
+keeps its connection open and waits <--slow> seconds between its requests
+(think time, or a slow network), under WSGI an idle connection holds a
+thread while under ASGI it holds a coroutine. The project doesn't depend on
+an ASGI server, a minimal HTTP/1.1 one is included here. Both servers run in
+their own process on the same seeded database:
+
+    python -m benchmarks.async_views --clients 1000 --slow 0.5
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from . import report
+from .load_test import configure, percentile
+
+BACKLOG = 4096
+
+
+def serve_wsgi(port, threads):
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    class PoolWSGIServer(ThreadedWSGIServer):
+        # Keep-alive like the threaded server, in a fixed number of threads
+        request_queue_size = BACKLOG
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.pool = ThreadPoolExecutor(threads)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self.process_request_thread, request, client_address)
+
+    server = PoolWSGIServer(('127.0.0.1', port), QuietHandler, allow_reuse_address=True)
+    server.set_app(get_wsgi_application())
+    server.serve_forever()
+
+
+async def read_message(reader):
+    """
+    Returns (start line, headers, body) of the next HTTP/1.1 message, None
+    when the connection was closed. Messages without a Content-Length have
+    no body
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    lines = head.decode('latin1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers.append((name.strip().lower().encode('latin1'), value.strip().encode('latin1')))
+    length = int(dict(headers).get(b'content-length', b'0'))
+    body = await reader.readexactly(length) if length else b''
+    return lines[0], headers, body
+
+
+async def handle_asgi(application, port, reader, writer):
+    try:
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                return
+            start, headers, body = message
+            method, target, _ = start.split(' ', 2)
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': method, 'scheme': 'http', 'path': unquote(path), 'raw_path': path.encode('latin1'),
+                'query_string': query.encode('latin1'), 'root_path': '', 'headers': headers,
+                'client': writer.get_extra_info('peername')[:2], 'server': ('127.0.0.1', port),
+            }
+            keep_alive = dict(headers).get(b'connection', b'').lower() != b'close'
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+            async def receive():
+                return messages.pop() if messages else {'type': 'http.disconnect'}
+
+            async def send(message):
+                nonlocal keep_alive
+                if message['type'] == 'http.response.start':
+                    response_headers = message.get('headers', [])
+                    # Responses without a length end with the connection
+                    keep_alive = keep_alive and any(name.lower() == b'content-length' for name, _ in response_headers)
+                    lines = [f'HTTP/1.1 {message["status"]} -'.encode()]
+                    lines += [name + b': ' + value for name, value in response_headers]
+                    lines.append(b'Connection: ' + (b'keep-alive' if keep_alive else b'close'))
+                    writer.write(b'\r\n'.join(lines) + b'\r\n\r\n')
+                elif message['type'] == 'http.response.body':
+                    writer.write(message.get('body', b''))
+                    if not message.get('more_body'):
+                        await writer.drain()
+
+            await application(scope, receive, send)
+            if not keep_alive:
+                return
+    finally:
+        writer.close()
+
+
+def serve_asgi(port):
+    from xcrowmeapi.asgi import application
+
+    async def main():
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_asgi(application, port, reader, writer),
+            '127.0.0.1', port, backlog=BACKLOG,
+        )
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+class Fixtures:
+    def __init__(self, rng):
+        from authentication.models import User
+        from exchange.models import Currency, Exchange, ExchangeTransaction
+        from project_api_key.models import ProjectUser, ProjectUserAPIKey
+
+        self.rng = rng
+        project, _ = ProjectUser.objects.get_or_create(name='Async Views', defaults={'staff': True, 'admin': True})
+        _, self.api_key = ProjectUserAPIKey.objects.create_key(name=project.name, project=project)
+        self.users = list(User.objects.order_by('?').values_list('pk', flat=True)[:500])
+        self.deals = list(Exchange.objects.order_by('?').values_list('uid', flat=True)[:500])
+        self.transactions = list(ExchangeTransaction.objects.order_by('?').values_list('uid', flat=True)[:500])
+        self.currencies = list(Currency.objects.values_list('pk', flat=True))
+
+    def paths(self):
+        # The async endpoints in turn
+        choice = self.rng.choice
+        return [
+            '/api/exchange/currency/list/',
+            f'/api/exchange/currency/get/{choice(self.currencies)}/',
+            '/api/exchange/deals/?page_size=20',
+            f'/api/exchange/deals/{choice(self.deals)}/',
+            f'/api/exchange/transactions/{choice(self.transactions)}/',
+            f'/api/authentication/users/detail/{choice(self.users)}/',
+        ]
+
+
+async def client(port, api_key, paths, slow, results):
+    """
+    Sends <paths> one after the other on one connection, waiting <slow>
+    seconds between the requests
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        for index, path in enumerate(paths):
+            if index and slow:
+                await asyncio.sleep(slow)
+            connection = 'close' if index == len(paths) - 1 else 'keep-alive'
+            start = time.perf_counter()
+            writer.write((
+                f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                f'Bearer-Api-Key: {api_key}\r\nConnection: {connection}\r\n\r\n'
+            ).encode())
+            await writer.drain()
+            response = await read_message(reader)
+            if response is None:
+                results.append((None, 0))
+                return
+            results.append((time.perf_counter() - start, int(response[0].split(' ', 2)[1])))
+    except OSError:
+        results.append((None, 0))
+    finally:
+        writer.close()
+
+
+async def run_load(port, api_key, paths, clients, slow):
+    results = []
+
+    async def start(paths):
+        # Spread the connections over the slow period
+        await asyncio.sleep(random.uniform(0, slow))
+        await client(port, api_key, paths, slow, results)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[start(paths[i::clients]) for i in range(clients)])
+    return results, time.perf_counter() - begin
+
+
+def server_threads(pid):
+    # Linux only
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_server(mode, args, database, fixtures, paths):
+    port = free_port()
+    command = [
+        sys.executable, '-m', 'benchmarks.async_views', '--serve', mode,
+        '--port', str(port), '--database', database, '--threads', str(args.threads),
+    ]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    peak = [0]
+    done = threading.Event()
+
+    def sample_threads():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], server_threads(process.pid) or 0)
+
+    try:
+        wait_for_port(port, process)
+        # Warm up the process caches (api key, registry) on every endpoint
+        asyncio.run(run_load(port, fixtures.api_key, fixtures.paths(), 1, 0))
+        threading.Thread(target=sample_threads, daemon=True).start()
+
+        rows = []
+        for name, slow in (('fast clients', 0), (f'{args.slow} s clients', args.slow)):
+            results, wall = asyncio.run(run_load(port, fixtures.api_key, paths, args.clients, slow))
+            latencies = sorted(i[0] * 1000 for i in results if i[0] is not None)
+            errors = sum(1 for _, code in results if not 200 <= code < 300)
+            rows.append((f'{mode} {name}', (
+                f'{len(results) / wall:8.1f} req/s  p50 {percentile(latencies, 50):8.1f}  '
+                f'p95 {percentile(latencies, 95):8.1f}  p99 {percentile(latencies, 99):8.1f} ms  {errors} errors'
+            )))
+        done.set()
+        rows.append((f'{mode} peak threads', peak[0] or 'unknown'))
+        return rows
+    finally:
+        done.set()
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--deals', type=int, default=20000)
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--database', help='sqlite file kept between runs, seeded when empty')
+    parser.add_argument('--clients', type=int, default=1000, help='concurrent connections')
+    parser.add_argument('--requests', type=int, default=4000, help='requests per run')
+    parser.add_argument('--slow', type=float, default=0.5, help='seconds slow clients wait between requests')
+    parser.add_argument('--threads', type=int, default=16, help='threads of the WSGI server')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--serve', choices=('wsgi', 'asgi'), help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'async_views.sqlite3')
+    configure(database)
+    if args.serve == 'wsgi':
+        return serve_wsgi(args.port, args.threads)
+    if args.serve == 'asgi':
+        return serve_asgi(args.port)
+
+    from django.core.management import call_command
+    from exchange.models import Exchange
+
+    if not Exchange.objects.exists():
+        call_command('seed_data', users=args.users, deals=args.deals, transactions=args.transactions, seed=args.seed)
+    fixtures = Fixtures(random.Random(args.seed))
+    paths = [path for _ in range(args.requests // 6 + 1) for path in fixtures.paths()][:args.requests]
+
+    rows = run_server('wsgi', args, database, fixtures, paths)
+    rows += run_server('asgi', args, database, fixtures, paths)
+    report(f'{args.requests} requests from {args.clients} clients, {args.threads} WSGI threads', rows)
+
+
+if __name__ == '__main__':
+    main()
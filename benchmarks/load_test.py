@@ -0,0 +1,350 @@
+"""
+Load test of every endpoint of the exchange and authentication apis.
+
+A database is seeded with realistic volumes, the api is served by a local
+threaded WSGI server and every endpoint is called by concurrent clients.
+Latency percentiles, throughput and queries per request (X-Query-Count)
+are reported and written to a JSON file so runs can be compared:
+
+    python -m benchmarks.load_test --scale 0.1 --clients 8
+    python -m benchmarks.load_test --compare benchmarks/results/<previous>.json
+
+The seeded database is kept with <--database> to skip seeding on the next
+run, it never uses db.sqlite3. SQLite takes one writer at a time, concurrent
+writes failing with "database is locked" are counted as errors (500).
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+from . import report
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def configure(database):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'xcrowmeapi.settings')
+
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = database
+    settings.DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 30
+    # Production like request handling, with the query count headers
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
+    settings.PROFILING_HEADERS = True
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    # Every request comes from one address, with a few emails
+    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] = {}
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+class Fixtures:
+    """Ids used to build the requests, read once from the seeded database"""
+    def __init__(self, rng):
+        from authentication.api.utils import get_tokens_for_user
+        from authentication.models import User
+        from authentication.tokens import acount_confirm_token
+        from django.utils.encoding import force_bytes
+        from django.utils.http import urlsafe_base64_encode
+        from exchange.models import Currency, Exchange, ExchangeTransaction
+        from exchange.seeding import EMAIL_DOMAIN
+        from project_api_key.models import ProjectUser, ProjectUserAPIKey
+
+        self.rng = rng
+        project, _ = ProjectUser.objects.get_or_create(name='Load Test', defaults={'staff': True, 'admin': True})
+        _, self.api_key = ProjectUserAPIKey.objects.create_key(name=project.name, project=project)
+
+        # Confirmed seeded users, the ones registered by earlier runs aren't
+        seeded = User.objects.filter(email__endswith=f'@{EMAIL_DOMAIN}', confirmed_email=True)
+        self.users = list(seeded.order_by('?').values_list('pk', flat=True)[:500])
+        self.deals = list(
+            Exchange.objects.filter(active=True).order_by('?').values_list(
+                'uid', 'user_id', 'exchange_rate', 'amount',
+                'fund_account_currency__symbol', 'exchange_currency__symbol')[:500]
+        )
+        self.transactions = list(ExchangeTransaction.objects.order_by('?').values_list('uid', flat=True)[:500])
+        self.currencies = list(Currency.objects.values_list('pk', 'symbol'))
+        self.pairs = list(
+            Exchange.objects.filter(active=True).order_by()
+            .values_list('fund_account_currency__symbol', 'exchange_currency__symbol').distinct()[:200]
+        )
+
+        self.volumes = {
+            'users': User.objects.count(),
+            'deals': Exchange.objects.count(),
+            'transactions': ExchangeTransaction.objects.count(),
+        }
+        users = User.objects.in_bulk(self.users[:20])
+        self.emails = [user.email for user in users.values()]
+        self.tokens = [get_tokens_for_user(user) for user in users.values()]
+        self.confirm_tokens = [
+            (urlsafe_base64_encode(force_bytes(user.pk)), acount_confirm_token.make_token(user))
+            for user in users.values()
+        ]
+        self._counter = iter(range(10 ** 9))
+        self._lock = threading.Lock()
+
+    def unique(self):
+        with self._lock:
+            return next(self._counter)
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def deal(self):
+        return self.rng.choice(self.deals)
+
+    def deal_data(self):
+        (fund, exchange) = self.rng.choice(self.pairs)
+        return {
+            'fund_account_currency': fund, 'exchange_currency': exchange,
+            'fund_account_name': 'Bench Account', 'fund_account_bank': 'UBA',
+            'amount': 10 ** 9, 'exchange_rate': 1.0, 'user': self.user(),
+        }
+
+
+def endpoints(f):
+    """
+    (name, method, path, body, headers) builders of every endpoint, bodies
+    are sent as JSON
+    """
+    from exchange.seeding import PASSWORD
+
+    exchange, auth = '/api/exchange', '/api/authentication'
+
+    def get(path, **params):
+        return lambda: ('GET', f'{path}?{urlencode(params)}' if params else path, None, {})
+
+    def pair():
+        fund, exchange_currency = f.rng.choice(f.pairs)
+        return {'fund_account_currency': fund, 'exchange_currency': exchange_currency}
+
+    def buy():
+        uid, seller, rate = f.deal()[:3]
+        buyer = f.user()
+        buyer = buyer if buyer != seller else f.users[0] if f.users[0] != seller else f.users[1]
+        return {'exchange': uid, 'amount': rate, 'status': 'pending', 'user': buyer}
+
+    def update():
+        uid, user, rate, amount, fund, exchange_currency = f.deal()
+        return ('PUT', f'{exchange}/deals/{uid}/', {
+            'fund_account_currency': fund, 'exchange_currency': exchange_currency,
+            'fund_account_name': 'Bench Account', 'fund_account_bank': 'UBA',
+            'amount': amount, 'exchange_rate': rate, 'user': user, 'exchange_address': f'Address {f.unique()}',
+        }, {})
+
+    def route():
+        (_, source), (_, target) = f.rng.sample(f.currencies, 2)
+        return ('GET', f'{exchange}/deals/route/?{urlencode({"from": source, "to": target, "amount": 100})}', None, {})
+
+    def jwt(index):
+        return {'Authorization': f'Bearer {f.tokens[index]["access"]}'}
+
+    return [
+        ('deals list', lambda: ('GET', f'{exchange}/deals/?page_size=100', None, {})),
+        ('deals list lean', lambda: ('GET', f'{exchange}/deals/?page_size=100&fields=uid,amount,exchange_rate', None, {})),
+        ('deals by pair', lambda: ('GET', f'{exchange}/deals/?{urlencode(pair())}', None, {})),
+        ('deals by cursor', lambda: ('GET', f'{exchange}/deals/?cursor=&page_size=100', None, {})),
+        ('deal create', lambda: ('POST', f'{exchange}/deals/', f.deal_data(), {})),
+        ('deals bulk create', lambda: ('POST', f'{exchange}/deals/bulk/', [f.deal_data() for _ in range(10)], {})),
+        ('deal detail', lambda: ('GET', f'{exchange}/deals/{f.deal()[0]}/', None, {})),
+        ('deal update', update),
+        ('best deals', lambda: ('GET', f'{exchange}/deals/best/?{urlencode(dict(pair(), amount=1000))}', None, {})),
+        ('best deals fill', lambda: ('POST', f'{exchange}/deals/best/', dict(pair(), amount=1, user=f.user(), partial=True), {})),
+        ('route', route),
+        ('transactions list', lambda: ('GET', f'{exchange}/transactions/?page_size=100', None, {})),
+        ('transaction create', lambda: ('POST', f'{exchange}/transactions/', buy(), {})),
+        ('transaction detail', lambda: ('GET', f'{exchange}/transactions/{f.rng.choice(f.transactions)}/', None, {})),
+        ('currency list', get(f'{exchange}/currency/list/', name='cy')),
+        ('currency detail', lambda: ('GET', f'{exchange}/currency/get/{f.rng.choice(f.currencies)[0]}/', None, {})),
+        ('currency rates', get(f'{exchange}/currency/rates/')),
+        ('currency convert', lambda: ('POST', f'{exchange}/currency/convert/', {'conversions': [
+            {'from': f.rng.choice(f.currencies)[1], 'to': f.rng.choice(f.currencies)[1], 'amount': 100} for _ in range(100)
+        ]}, {})),
+        ('register', lambda: ('POST', f'{auth}/register/', {
+            'email': f'new{f.unique()}-{os.getpid()}@bench.com', 'first_name': 'new', 'last_name': 'user',
+            'password': PASSWORD, 'password2': PASSWORD}, {})),
+        ('login', lambda: ('POST', f'{auth}/login/', {'email': f.rng.choice(f.emails), 'password': PASSWORD}, {})),
+        ('token refresh', lambda: ('POST', f'{auth}/token/refresh/', {'refresh': f.rng.choice(f.tokens)['refresh']}, {})),
+        ('forget password', lambda: ('PUT', f'{auth}/user/forgetPassword/', {
+            'id': f.user(), 'new_password': PASSWORD, 'confirm_password': PASSWORD}, {})),
+        ('change password', lambda: (lambda i: ('PUT', f'{auth}/user/changePassword/', {
+            'old_password': PASSWORD, 'new_password': PASSWORD, 'confirm_password': PASSWORD}, jwt(i)))(f.rng.randrange(len(f.tokens)))),
+        ('token generate', lambda: ('GET', f'{auth}/token/generate/?id={f.user()}', None, {})),
+        ('token validate', lambda: (lambda t: ('POST', f'{auth}/token/validate/', {'uidb64': t[0], 'token': t[1]}, {}))(f.rng.choice(f.confirm_tokens))),
+        ('otp generate', get(f'{auth}/generate_otp/')),
+        ('users list', get(f'{auth}/users/', page_size=100)),
+        ('users list lean', get(f'{auth}/users/', page_size=100, fields='email,first_name,last_name')),
+        ('user detail', lambda: ('GET', f'{auth}/users/detail/{f.user()}/', None, {})),
+        ('users batch', lambda: ('POST', f'{auth}/users/batch/', {'ids': [f.user() for _ in range(100)]}, {})),
+        ('send mail', lambda: ('GET', f'{auth}/user/send-mail/?{urlencode({"id": f.user(), "subject": "Hi", "message": "Load test"})}', None, {})),
+    ]
+
+
+def call(port, api_key, request):
+    method, path, body, headers = request
+    headers = dict(headers, **{'Bearer-Api-Key': api_key, 'Connection': 'close'})
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers['Content-Type'] = 'application/json'
+
+    connection = HTTPConnection('127.0.0.1', port, timeout=60)
+    start = time.perf_counter()
+    try:
+        connection.request(method, path, data, headers)
+        response = connection.getresponse()
+        response.read()
+        elapsed = time.perf_counter() - start
+        return elapsed, response.status, response.getheader('X-Query-Count')
+    finally:
+        connection.close()
+
+
+def percentile(values, p):
+    # Nearest rank
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def run_endpoint(port, api_key, build, requests, clients):
+    requests_list = [build() for _ in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(lambda request: call(port, api_key, request), requests_list))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(i[0] * 1000 for i in results)
+    queries = [int(i[2]) for i in results if i[2] is not None]
+    statuses = {}
+    for _, code, _ in results:
+        statuses[str(code)] = statuses.get(str(code), 0) + 1
+    return {
+        'requests': requests,
+        'errors': sum(count for code, count in statuses.items() if not code.startswith('2')),
+        'statuses': statuses,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies),
+        'throughput_rps': requests / wall,
+        'queries_per_request': (sum(queries) / len(queries)) if queries else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    rows = []
+    for name, result in results['endpoints'].items():
+        before = previous['endpoints'].get(name)
+        if before is None:
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        rows.append((name, f'p95 {before["p95_ms"]:9.2f} -> {result["p95_ms"]:9.2f} ms ({change:+6.1f}%)'))
+    report(f'Compared with {previous.get("commit")} ({previous.get("started")})', rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--deals', type=int, default=100000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the seeded volumes')
+    parser.add_argument('--database', help='sqlite file kept between runs, seeded when empty')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--only', help='comma separated endpoint names')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help=f'results file, by default in {RESULTS_DIR}')
+    parser.add_argument('--compare', help='previous results file')
+    args = parser.parse_args()
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'load_test.sqlite3')
+    configure(database)
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+    from exchange.models import Exchange
+
+    rng = random.Random(args.seed)
+    if not Exchange.objects.exists():
+        volumes = {name: max(1, int(getattr(args, name) * args.scale)) for name in ('users', 'deals', 'transactions')}
+        call_command('seed_data', seed=args.seed, **volumes)
+    # Seeded users keep creating deals
+    settings.EXCHANGE_DEALS_LIMIT = 10 ** 6
+    fixtures = Fixtures(rng)
+    volumes = fixtures.volumes
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    only = set(args.only.split(',')) if args.only else None
+    results = {
+        'commit': git_commit(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'volumes': volumes,
+        'clients': args.clients,
+        'requests': args.requests,
+        'endpoints': {},
+    }
+    rows = []
+    try:
+        for name, build in endpoints(fixtures):
+            if only and name not in only:
+                continue
+            # One warm up call fills the process caches
+            call(port, fixtures.api_key, build())
+            result = run_endpoint(port, fixtures.api_key, build, args.requests, args.clients)
+            results['endpoints'][name] = result
+            queries = result['queries_per_request']
+            rows.append((name, (
+                f'p50 {result["p50_ms"]:8.2f}  p95 {result["p95_ms"]:8.2f}  p99 {result["p99_ms"]:8.2f} ms  '
+                f'{result["throughput_rps"]:8.1f} req/s  '
+                f'{queries if queries is None else round(queries, 1)} queries/req  {result["errors"]} errors'
+            )))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report(f'Load test, {args.clients} clients, {args.requests} requests per endpoint, {volumes}', rows)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'load_test-{results["commit"] or "unknown"}-{time.strftime("%Y%m%d%H%M%S")}.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Latency of the login endpoint under concurrent clients, before and after
+the single pass login. The login as it was (a user lookup in the
+serializer, a second one in the view and the profile loaded by the user
+serializer) is served next to the current one by a local threaded WSGI
+server:
+
+    python -m benchmarks.login --clients 8 --requests 200
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.urls import include, path
+
+from . import report
+from .load_test import call, configure, percentile
+
+PASSWORD = 'Bench-pass-2021'
+EMAIL_DOMAIN = 'login.xcrowme.com'
+
+
+def legacy_login_view():
+    from rest_framework import serializers as drf_serializers
+    from rest_framework import status
+    from rest_framework.response import Response
+    from rest_framework.views import APIView
+
+    from authentication.api import serializers
+    from authentication.api.utils import get_tokens_for_user
+    from authentication.models import User
+    from authentication.permissions import IsAuthenticatedAdmin
+    from project_api_key.permissions import HasStaffProjectAPIKey
+
+    class LegacyLoginSerializer(drf_serializers.Serializer):
+        email = drf_serializers.EmailField(required=True)
+        password = drf_serializers.CharField(write_only=True, required=True)
+
+        def validate(self, attrs):
+            try:
+                user = User.objects.get(email=attrs['email'])
+            except User.DoesNotExist:
+                raise drf_serializers.ValidationError({"email": 'Details do not match an active account'})
+            if not user.check_password(attrs['password']):
+                raise drf_serializers.ValidationError({"password": 'Your password is incorrect'})
+            return attrs
+
+    class LegacyLoginAPIView(APIView):
+        permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+
+        def post(self, request, format=None):
+            serializer = LegacyLoginSerializer(data=request.data)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            user = User.objects.get(email=serializer.validated_data['email'])
+            return Response({
+                'tokens': get_tokens_for_user(user),
+                'user': serializers.UserSerializer(user).data,
+            }, status=status.HTTP_200_OK)
+
+    return LegacyLoginAPIView.as_view()
+
+
+# The api and the legacy login, this module is the ROOT_URLCONF
+urlpatterns = []
+
+
+def main():
+    global urlpatterns
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='logins per variant')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    configure(os.path.join(tempfile.mkdtemp(), 'login.sqlite3'))
+
+    from django.conf import settings
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    from authentication.models import User
+    from project_api_key.models import ProjectUser, ProjectUserAPIKey
+
+    urlpatterns = [path('legacy/login/', legacy_login_view()), path('', include('xcrowmeapi.urls'))]
+    settings.ROOT_URLCONF = __name__
+    project = ProjectUser.objects.create(name='Login Benchmark', staff=True)
+    _, api_key = ProjectUserAPIKey.objects.create_key(name=project.name, project=project)
+    emails = []
+    for i in range(args.users):
+        user = User.objects.create_user(
+            email=f'user{i}@{EMAIL_DOMAIN}', first_name='bench', last_name='user', password=PASSWORD)
+        user.active = user.confirmed_email = True
+        user.save()
+        emails.append(user.email)
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    rng = random.Random(args.seed)
+    rows = []
+    try:
+        for label, url in (('before', '/legacy/login/'), ('after', '/api/authentication/login/')):
+            def request():
+                return ('POST', url, {'email': rng.choice(emails), 'password': PASSWORD}, {})
+
+            # Warm up the api key cache
+            call(port, api_key, request())
+
+            requests = [request() for _ in range(args.requests)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.clients) as pool:
+                results = list(pool.map(lambda r: call(port, api_key, r), requests))
+            wall = time.perf_counter() - start
+
+            latencies = sorted(i[0] * 1000 for i in results)
+            errors = sum(1 for _, code, _ in results if code != 200)
+            queries = [int(i[2]) for i in results if i[2] is not None]
+            rows.append((label, (
+                f'p50 {percentile(latencies, 50):8.1f}  p95 {percentile(latencies, 95):8.1f}  '
+                f'p99 {percentile(latencies, 99):8.1f} ms  {len(results) / wall:6.1f} req/s  '
+                f'{sum(queries) / len(queries):.1f} queries/login  {errors} errors'
+            )))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report(f'Login, {args.requests} requests from {args.clients} clients', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Best price lookups on one currency pair with many open deals, the filtered
+deals query buyers had to page through before against the order book
+"""
+import random
+
+from . import setup, measure, report
+
+
+def main(deals=50000, number=2000):
+    setup()
+
+    from exchange.models import Currency, Exchange
+    from exchange.orderbook import order_book
+    from authentication.models import User
+
+    dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+    naira = Currency.objects.create(name='Nigerian Naira', symbol='NGN', value=455)
+    users = [
+        User.objects.create_user(email=f'seller{i}@email.com', first_name='seller', last_name='user', password='randopass')
+        for i in range(20)
+    ]
+    Exchange.objects.bulk_create([
+        Exchange(
+            user=random.choice(users), fund_account_currency=dollar, exchange_currency=naira,
+            fund_account_name='My New Account', fund_account_bank='UBA',
+            amount=random.uniform(50000, 500000), exchange_rate=random.uniform(400, 500))
+        for _ in range(deals)
+    ], batch_size=1000)
+    pair = (dollar.pk, naira.pk)
+    amount = 450000
+
+    def query():
+        # Best deals covering the amount alone, straight from the database
+        return list(
+            Exchange.objects.filter(active=True, fund_account_currency=dollar, exchange_currency=naira, amount__gte=amount)
+            .order_by('exchange_rate')[:10]
+        )
+
+    order_book.best(pair)
+    rows = [
+        ('query, best 10', f'{measure(query, 50):10.1f} us'),
+        ('book, best 10', f'{measure(lambda: order_book.best(pair, amount, 10), number):10.1f} us'),
+        ('book, fill 2,000,000', f'{measure(lambda: order_book.fill(pair, 2000000), number):10.1f} us'),
+        ('book, load pair', f'{measure(lambda: order_book.load(pair), 5):10.1f} us'),
+    ]
+    report(f'Best deals of {amount} on one pair ({deals} open deals)', rows)
+
+
+if __name__ == '__main__':
+    main()
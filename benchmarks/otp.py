@@ -0,0 +1,61 @@
+"""
+Cost of generating and verifying otps and memory of the otp store when it
+is full, each otp adding a key and a packed entry:
+
+    python -m benchmarks.otp --otps 1000000
+"""
+import argparse
+import time
+import tracemalloc
+
+from . import setup, measure, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--otps', type=int, default=1000000, help='otps in the store')
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    setup()
+
+    from authentication import otp
+
+    keys = [f'user{i}@email.com' for i in range(args.number)]
+    codes = {}
+
+    def generate():
+        key = keys[len(codes) % args.number]
+        codes[key] = otp.generate(key)[0]
+
+    rows = [('generate', f'{measure(generate, args.number):8.2f} us')]
+    wrong = iter(keys)
+    rows.append(('verify, wrong otp', f'{measure(lambda: otp.verify(next(wrong), "x"), args.number):8.2f} us'))
+    right = iter(keys)
+
+    def verify():
+        key = next(right)
+        assert otp.verify(key, codes[key]) == (True, 0)
+
+    rows.append(('verify, right otp', f'{measure(verify, args.number):8.2f} us'))
+
+    # The store alone, filled with distinct keys
+    store = otp.OtpStore(max_size=args.otps)
+    entry = otp.ENTRY.pack(b'\0' * 8, int(time.time()) + 300, 0)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(args.otps):
+        store.set(otp.key_digest(i), otp.ENTRY.pack(*otp.ENTRY.unpack(entry)))
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    rows.append((f'{args.otps} otps in store', f'{size / 2 ** 20:8.1f} MB, {size / args.otps:.0f} bytes/otp'))
+
+    # Everything expired, a single sweep drops it all
+    start = time.perf_counter()
+    store.sweep(time.time() + 301)
+    rows.append(('sweep of expired otps', f'{(time.perf_counter() - start) * 1000:8.1f} ms, {len(store)} left'))
+    report(f'Otps ({args.number} generated and verified)', rows)
+
+
+if __name__ == '__main__':
+    main()
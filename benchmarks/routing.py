@@ -0,0 +1,64 @@
+"""
+Best route search on a graph of 50 currencies and 100k active deals, cold
+(first search after the graph loaded) and from the route cache
+"""
+import random
+
+from . import setup, measure, report
+
+
+def main(currencies=50, deals=100000, number=200):
+    setup()
+
+    from exchange.models import Currency, Exchange
+    from exchange.routing import route_graph
+    from authentication.models import User
+
+    random.seed(5)
+    values = [random.uniform(0.1, 1000) for _ in range(currencies)]
+    Currency.objects.bulk_create([
+        Currency(name=f'Currency {i}', symbol=f'C{i}', value=value) for i, value in enumerate(values)
+    ])
+    objs = list(Currency.objects.order_by('pk'))
+    users = [
+        User.objects.create_user(email=f'seller{i}@email.com', first_name='seller', last_name='user', password='randopass')
+        for i in range(20)
+    ]
+
+    def deal():
+        fund, exchange = random.sample(range(currencies), 2)
+        # Around the cross rate with some spread
+        rate = values[exchange] / values[fund] * random.uniform(0.95, 1.2)
+        return Exchange(
+            user=random.choice(users), fund_account_currency=objs[fund], exchange_currency=objs[exchange],
+            fund_account_name='My New Account', fund_account_bank='UBA',
+            amount=random.uniform(1, 1000) * values[fund] * 1000, exchange_rate=rate)
+    Exchange.objects.bulk_create([deal() for _ in range(deals)], batch_size=1000)
+
+    pairs = [tuple(i.pk for i in random.sample(objs, 2)) for _ in range(number)]
+    amounts = [random.uniform(1, 100000) for _ in range(number)]
+
+    def search(hops, amount=True):
+        # Every search misses the route cache
+        def run():
+            route_graph._routes.clear()
+            for (source, target), value in zip(pairs, amounts):
+                route_graph.find(source, target, value if amount else None, hops)
+        return run
+
+    rows = [('load graph', f'{measure(route_graph.load, 3) / 1000:10.1f} ms')]
+    route_graph.find(*pairs[0])
+    for hops in (1, 2, 3, 4):
+        rows.append((f'{hops} hops, rates only', f'{measure(search(hops, False), 1) / number:10.1f} us/route'))
+        rows.append((f'{hops} hops, with amount', f'{measure(search(hops), 1) / number:10.1f} us/route'))
+
+    for (source, target), value in zip(pairs, amounts):
+        route_graph.find(source, target, value, 3)
+    cached = measure(lambda: route_graph.find(pairs[0][0], pairs[0][1], amounts[0], 3), 10000)
+    rows.append(('3 hops, cached', f'{cached:10.1f} us/route'))
+
+    report(f'Routes on {currencies} currencies and {deals} deals ({number} searches)', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Cost of the throttle checks of the login endpoint, a bucket alone and the
+three throttles of a request, allowed and rejected, next to the password
+check the rejected requests don't do
+"""
+from . import setup, measure, report
+
+
+def main(number=100000):
+    setup()
+
+    from django.contrib.auth.hashers import make_password, check_password
+    from django.test import override_settings
+    from rest_framework.test import APIRequestFactory
+
+    from authentication.api.views import LoginAPIView
+    from project_api_key.models import ProjectUser, ProjectUserAPIKey
+    from xcrowmeapi.throttling import IPThrottle, ProjectThrottle, TargetThrottle, TokenBuckets, local_buckets
+
+    project_user = ProjectUser.objects.create(name='Benchmark Staff User', staff=True)
+    _, key = ProjectUserAPIKey.objects.create_key(name=project_user.name, project=project_user)
+    factory = APIRequestFactory()
+    view = LoginAPIView()
+
+    def login_request(email):
+        request = factory.post(
+            '/', {'email': email, 'password': 'benchpass'}, format='json', **{'HTTP_BEARER_API_KEY': key})
+        return view.initialize_request(request)
+
+    throttles = [ProjectThrottle(), IPThrottle(), TargetThrottle()]
+
+    def check(request):
+        return all(throttle.allow_request(request, view) for throttle in throttles)
+
+    buckets = TokenBuckets()
+    rows = [('bucket consume', f'{measure(lambda: buckets.consume("key", 1e9, 1e9), number):8.2f} us')]
+
+    generous = {'project': f'{number * 10}/s', 'ip': f'{number * 10}/s', 'target': f'{number * 10}/s'}
+    with override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': generous}):
+        request = login_request('bench@email.com')
+        request.data
+        local_buckets.clear()
+        rows.append(('3 throttles, allowed', f'{measure(lambda: check(request), number):8.2f} us'))
+
+    with override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {'target': '1/min'}}):
+        request = login_request('attacker@email.com')
+        request.data
+        check(request)
+        assert not check(request)
+        rows.append(('3 throttles, rejected', f'{measure(lambda: check(request), number):8.2f} us'))
+
+    encoded = make_password('benchpass')
+    rows.append(('password check (avoided)', f'{measure(lambda: check_password("benchpass", encoded), 10):8.2f} us'))
+    report(f'Throttle checks ({number} requests)', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Inserting 100k deals with the old random uid + existence check against the
+time ordered uid generator used with bulk_create
+"""
+import time
+
+from . import setup, report
+
+
+def main(number=100000, batch_size=5000):
+    setup()
+
+    from authentication.models import User
+    from authentication.utils import random_text
+    from exchange.models import Currency, Exchange
+    from exchange.utils import new_uid
+
+    user = User.objects.create_user(email='bench@email.com', first_name='bench', last_name='user', password='benchpass')
+    dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+
+    def legacy_uid():
+        # Random uid checked against the table until a free one is found
+        uid = random_text(10)
+        while Exchange.objects.filter(uid=uid).exists():
+            uid = random_text(10)
+        return uid
+
+    def deal(uid):
+        return Exchange(
+            user=user, fund_account_currency=dollar, exchange_currency=dollar,
+            fund_account_name='Bench Account', fund_account_bank='UBA',
+            amount=60000.0, exchange_rate=1.0, uid=uid)
+
+    rows = []
+    for label, generate in (('random + exists', legacy_uid), ('time ordered', new_uid)):
+        Exchange.objects.all().delete()
+        start = time.perf_counter()
+        for offset in range(0, number, batch_size):
+            Exchange.objects.bulk_create([deal(generate()) for _ in range(min(batch_size, number - offset))])
+        elapsed = time.perf_counter() - start
+
+        unique = Exchange.objects.values('uid').distinct().count()
+        rows.append((label, f'{elapsed:8.2f} s  {number / elapsed:10.0f} rows/s  {unique} unique uids'))
+
+    report(f'Inserting {number} deals in batches of {batch_size}', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+from exchange.registry import currency_registry
+from xcrowmeapi.asyncviews import AsyncReadView
+
+from . import views
+
+
+class CurrencyList(AsyncReadView):
+    view_class = views.CurrencyList
+
+    async def in_memory_context(self, request, *args, **kwargs):
+        # Currencies are served from the current registry state, kept for the request
+        return currency_registry.using(await currency_registry.refresh())
+
+
+class CurrencyView(AsyncReadView):
+    view_class = views.CurrencyView
+
+    async def in_memory_context(self, request, *args, **kwargs):
+        return currency_registry.using(await currency_registry.refresh())
+
+
+class ListCreateExchange(AsyncReadView):
+    view_class = views.ListCreateExchange
+
+
+class RUDExchange(AsyncReadView):
+    view_class = views.RUDExchange
+
+
+class RUDExchangeTransaction(AsyncReadView):
+    view_class = views.RUDExchangeTransaction
@@ -1,36 +1,88 @@
+import math
+
 from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
+from django.core.exceptions import ValidationError
 from rest_framework import serializers
 
-# from authentication.models import User
+from authentication.api.serializers import UserSerializer
+from authentication.models import User
 
-from exchange.models import Exchange, ExchangeTransaction, Currency
+from exchange.models import Exchange, ExchangeTransaction, Currency, DealCounter
+from exchange.registry import currency_registry
 from exchange.utils import validate_exchange_amount
+from xcrowmeapi.fieldsets import SparseFieldsMixin
+
+
+class CurrencySymbolField(serializers.SlugRelatedField):
+    """
+    Currency by symbol (case insensitive) resolved from the currency registry,
+    neither validation nor rendering queries the Currency table
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queryset', Currency.objects.all())
+        super().__init__(slug_field='symbol', **kwargs)
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            self.fail('invalid')
+        currency = currency_registry.get_by_symbol(data)
+        if currency is None:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=data)
+        return currency
+
+    def get_attribute(self, instance):
+        # Read the currency id stored on the instance instead of the relation
+        currency_id = getattr(instance, self.source_attrs[-1] + '_id', None)
+        return currency_registry.get(currency_id) or super().get_attribute(instance)
 
 
-class CurrencySerializer(serializers.ModelSerializer):
+class PrefetchedUserField(serializers.PrimaryKeyRelatedField):
+    """
+    User by pk, read from the <users> dict of the serializer context when the
+    caller prefetched them (bulk creation) instead of one query per item
+    """
+    def to_internal_value(self, data):
+        users = self.context.get('users')
+        if users is None:
+            return super().to_internal_value(data)
+
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            user = users.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if user is None:
+            self.fail('does_not_exist', pk_value=data)
+        return user
+
+
+class CurrencySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Currency
         fields = '__all__'
 
-class ExchangeSerializer(serializers.ModelSerializer):
-    fund_account_currency = serializers.SlugRelatedField(
-        slug_field='symbol',
-        queryset = Currency.objects.filter()
-    )
-    exchange_currency = serializers.SlugRelatedField(
-        slug_field='symbol',
-        queryset = Currency.objects.filter()
-    )
+class ExchangeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    fund_account_currency = CurrencySymbolField()
+    exchange_currency = CurrencySymbolField()
+    user = PrefetchedUserField(queryset=User.objects.all())
 
     class Meta:
         model = Exchange
         exclude = ['id']
         read_only_fields = ['uid']
+        expandable_fields = {'user': UserSerializer}
     
     def validate_user(self, value):
         if not self.instance:
-            if value.exchange_set.filter(active=True).count() >= settings.EXCHANGE_DEALS_LIMIT:
+            # Bulk creation passes the active deals counts of its users
+            active_counts = self.context.get('active_counts')
+            if active_counts is not None:
+                count = active_counts.get(value.pk, 0)
+            else:
+                count = DealCounter.objects.get_count(value.pk)
+            if count >= settings.EXCHANGE_DEALS_LIMIT:
                 raise serializers.ValidationError(F'You can only have {settings.EXCHANGE_DEALS_LIMIT} active deals at a time')
         
         return value
@@ -45,26 +97,146 @@ class ExchangeSerializer(serializers.ModelSerializer):
         
         return attrs
 
-class ExchangeTransactionSerializer(serializers.ModelSerializer):
+    # The deals limit is checked again by the counter reservation when saving
+    def create(self, validated_data):
+        try:
+            return super().create(validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError({'user': e.messages})
+
+    def update(self, instance, validated_data):
+        try:
+            return super().update(instance, validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError({'user': e.messages})
+
+class ExchangeTransactionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     exchange = serializers.SlugRelatedField(
         slug_field='uid',
-        queryset = Exchange.objects.filter(active=True)
+        queryset = Exchange.objects.all()
     )
     class Meta:
         model = ExchangeTransaction
         exclude = ['id']
         read_only_fields = ['uid']
+        expandable_fields = {'user': UserSerializer, 'exchange': ExchangeSerializer}
     
+    def validate_exchange(self, value):
+        # Only active deals, or the deal of a transaction deactivated since
+        if not value.active and not (self.instance and self.instance.exchange_id == value.pk):
+            self.fields['exchange'].fail('does_not_exist', slug_name='uid', value=value.uid)
+        return value
+
     def validate(self, attrs):
         user = attrs['user'] 
         exchange = attrs['exchange']
         # If the user owns the exchange, throw an error(User can't buy from himself)
-        if user == exchange.user:
+        if user.pk == exchange.user_id:
             raise serializers.ValidationError({'user': 'You can\'t buy from your deal'})
         
-        # Validate the amount if it is more than the exchange amount
+        # Finished transactions keep their status
+        previous = self.instance.status if self.instance else None
+        if previous in ('completed', 'cancelled') and attrs.get('status', previous) != previous:
+            raise serializers.ValidationError({'status': f'A {previous} transaction can\'t be changed'})
+
+        # Validate the amount if it is more than what the exchange has available,
+        # the reservation made when saving is the final check
         amount = attrs['amount']
-        if (amount / exchange.exchange_rate) > exchange.amount:
-            raise serializers.ValidationError({'amount': f'Exchanger doesn\'t have up to {amount} {exchange.exchange_currency}'})
+        available = exchange.amount - exchange.reserved
+        if previous == 'pending' and self.instance.exchange_id == exchange.pk:
+            available += self.instance.reserved
+        if (amount / exchange.exchange_rate) > available:
+            currency = currency_registry.get(exchange.exchange_currency_id) or exchange.exchange_currency
+            raise serializers.ValidationError({'amount': f'Exchanger doesn\'t have up to {amount} {currency}'})
         
         return attrs
+
+    def create(self, validated_data):
+        try:
+            return super().create(validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError({'amount': e.messages})
+
+    def update(self, instance, validated_data):
+        try:
+            return super().update(instance, validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError({'amount': e.messages})
+
+
+class OrderBookSerializer(serializers.Serializer):
+    """
+    Deals of a currency pair, <amount> is in the fund account currency (what
+    the buyer wants) and <max_rate> is the highest exchange rate accepted
+    """
+    fund_account_currency = CurrencySymbolField()
+    exchange_currency = CurrencySymbolField()
+    amount = serializers.FloatField(min_value=0, default=0)
+    max_rate = serializers.FloatField(min_value=0, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+
+class OrderFillSerializer(OrderBookSerializer):
+    # The buyer, <partial> accepts filling less than the amount
+    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    amount = serializers.FloatField(min_value=0)
+    partial = serializers.BooleanField(default=False)
+
+    def validate_amount(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Ensure this value is greater than 0.')
+        return value
+
+
+class RouteSerializer(serializers.Serializer):
+    """
+    Route from the currency the buyer has (<from>) to the one they want
+    (<to>), <amount> is in the <from> currency
+    """
+    amount = serializers.FloatField(required=False)
+    hops = serializers.IntegerField(min_value=1, required=False)
+
+    def get_fields(self):
+        # <from> can't be declared as an attribute
+        fields = super().get_fields()
+        fields['from'] = CurrencySymbolField()
+        fields['to'] = CurrencySymbolField()
+        return fields
+
+    def validate_amount(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Ensure this value is greater than 0.')
+        return value
+
+    def validate_hops(self, value):
+        if value > settings.EXCHANGE_ROUTE_MAX_HOPS:
+            raise serializers.ValidationError(f'Routes can\'t have more than {settings.EXCHANGE_ROUTE_MAX_HOPS} hops')
+        return value
+
+
+class CurrencyConversionSerializer(serializers.Serializer):
+    """
+    Bulk conversion request, a list of {'from': <symbol>, 'to': <symbol>,
+    'amount': <number>}. Currencies are checked against the cross rate matrix
+    passed in the context
+    """
+    conversions = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=10000)
+
+    def validate_conversions(self, value):
+        sources, targets, amounts = [], [], []
+        for index, item in enumerate(value):
+            try:
+                sources.append(str(item['from']))
+                targets.append(str(item['to']))
+                amounts.append(float(item['amount']))
+            except (KeyError, TypeError, ValueError):
+                raise serializers.ValidationError(f'Conversion {index} needs a from, to and numeric amount')
+            if not math.isfinite(amounts[-1]):
+                raise serializers.ValidationError(f'Conversion {index} needs a finite amount')
+
+        unknown = self.context['matrix'].unknown(sources + targets)
+        if unknown:
+            raise serializers.ValidationError(f'Currencies do not exist: {", ".join(unknown)}')
+
+        return sources, targets, amounts
+
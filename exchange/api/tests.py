@@ -1,14 +1,36 @@
+import asyncio
+import importlib
+import json
+import os
+import re
+import tempfile
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
 from django.conf import settings
+from django.db import connection
+from django.test import AsyncClient, AsyncRequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve
 from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 
+from project_api_key.cache import key_cache
 from project_api_key.models import ProjectUserAPIKey, ProjectUser
 
 from authentication.models import User
-from authentication.api.utils import url_with_params
+from authentication.api import async_views as auth_async_views
+from authentication.api.utils import get_tokens_for_user, url_with_params
 
 from exchange.models import Currency, Exchange, ExchangeTransaction
+from exchange.registry import currency_registry
+from exchange.orderbook import order_book
+from exchange.routing import route_graph
+from xcrowmeapi import urls as root_urls
+from xcrowmeapi.profiling import BudgetExceeded
+from authentication.api import urls as auth_urls
+from . import async_views, urls, views
 from .serializers import ExchangeSerializer
 
 
@@ -400,3 +422,634 @@ class ExchageTests(APITestCase):
         response = self.client.delete(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(ExchangeTransaction.objects.filter(uid__exact=test_transaction.uid).count(), 0)
+
+    def test_exchange_keyset_pagination(self):
+        """
+        Walk the deals forward and backward with the cursor and check that
+        every deal is seen once in (created, id) order without a count
+        """
+        url = reverse('exchange:lc_exchange')
+        expected = list(Exchange.objects.filter(active=True).order_by('created', 'id').values_list('uid', flat=True))
+
+        seen = []
+        next_url = url_with_params(url, {'cursor': '', 'page_size': 1})
+        while next_url:
+            response = self.client.get(next_url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            seen += [i['uid'] for i in response.data['results']]
+            last_response = response
+            next_url = response.data['next']
+        self.assertEqual(seen, expected)
+
+        # Walk back from the last page
+        seen = []
+        previous_url = last_response.data['previous']
+        while previous_url:
+            response = self.client.get(previous_url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            seen = [i['uid'] for i in response.data['results']] + seen
+            previous_url = response.data['previous']
+        self.assertEqual(seen, expected[:-1])
+
+        # Count is only computed when asked for
+        response = self.client.get(url_with_params(url, {'cursor': '', 'count': 'true'}), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.data['count'], len(expected))
+
+        # Bad cursor
+        response = self.client.get(url_with_params(url, {'cursor': 'bad-cursor'}), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(EXCHANGE_DEALS_LIMIT=100)
+    def test_list_queries_do_not_grow_with_page_size(self):
+        """
+        The deal and transaction listings must run a constant number of
+        queries whatever the page size (no query per row for related fields)
+        """
+        user = self.get_user()
+        buyer = User.objects.create_user(
+            email='sketcherslodge@gmail.com',
+            first_name='john',
+            last_name='doe',
+            password='newrandopass'
+            )
+        usd, ngn = Currency.objects.get(symbol='USD'), Currency.objects.get(symbol='NGN')
+        for i in range(30):
+            deal = Exchange.objects.create(
+                user=user, fund_account_currency=usd, exchange_currency=ngn,
+                fund_account_name='My New Account', fund_account_bank='UBA',
+                amount=60000.0, exchange_rate=456.0)
+            ExchangeTransaction.objects.create(user=buyer, exchange=deal, amount=456, status='pending')
+
+        max_queries = 3
+        for name in ['exchange:lc_exchange', 'exchange:lc_transaction']:
+            url = reverse(name)
+            # Warm up the api key cache
+            self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+
+            counts = []
+            for page_size in [1, 10, 30]:
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url_with_params(url, {'page_size': page_size}), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(len(response.data['results']), page_size)
+                counts.append(len(queries))
+            self.assertLessEqual(max(counts), max_queries, name)
+            self.assertEqual(len(set(counts)), 1, name)
+
+        # Detail views
+        deal = Exchange.objects.first()
+        transaction = ExchangeTransaction.objects.first()
+        for url in [
+            reverse('exchange:rud_exchange', kwargs={'uid': deal.uid}),
+            reverse('exchange:rud_exchangetransaction', kwargs={'uid': transaction.uid}),
+        ]:
+            with self.assertNumQueries(1):
+                response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_sparse_fieldsets_and_expansion(self):
+        """
+        Test ?fields= and ?expand= on the deal and transaction endpoints, the
+        queries only load the columns and relations shown
+        """
+        user = self.get_user()
+        buyer = User.objects.create_user(email='sketcherslodge@gmail.com', first_name='john', last_name='doe', password='newrandopass')
+        deal = Exchange.objects.get(fund_account_currency__symbol='NGN', exchange_currency__symbol='USD')
+        transaction = ExchangeTransaction.objects.create(user=buyer, exchange=deal, amount=1, status='pending')
+        headers = {'HTTP_BEARER_API_KEY':self.user_key}
+        url = reverse('exchange:lc_exchange')
+        self.client.get(url, format='json', **headers)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url_with_params(url, {'fields': 'uid,amount,nothing'}), format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'uid', 'amount'})
+        self.assertEqual(len(queries), 2)
+        columns = queries[-1]['sql'].split(' FROM ')[0]
+        self.assertIn('"amount"', columns)
+        self.assertNotIn('"fund_account_name"', columns)
+
+        # Expanded users, with a sparse profile
+        params = {'fields': 'uid,user.email,user.profile.username', 'expand': 'user', 'page_size': 10}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url_with_params(url, params), format='json', **headers)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(response.data['results'][0]['user'], {'email': user.email, 'profile': {'username': user.profile.username}})
+        self.assertNotIn('"first_name"', queries[-1]['sql'])
+
+        # Detail views, nested expansion
+        url = reverse('exchange:rud_exchangetransaction', kwargs={'uid': transaction.uid})
+        with self.assertNumQueries(1):
+            response = self.client.get(url_with_params(url, {'expand': 'exchange.user', 'fields': 'status,exchange.amount,exchange.user.email'}), format='json', **headers)
+        self.assertEqual(response.data, {'status': 'pending', 'exchange': {'amount': deal.amount, 'user': {'email': user.email}}})
+        response = self.client.get(reverse('exchange:rud_exchange', kwargs={'uid': deal.uid}), {'expand': 'user'}, format='json', **headers)
+        self.assertEqual(response.data['user']['email'], user.email)
+        self.assertEqual(response.data['amount'], deal.amount)
+
+        # Relations joined by the views themselves are kept
+        for url in [reverse('exchange:lc_transaction'), url]:
+            response = self.client.get(url, {'fields': 'amount'}, format='json', **headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.data['results'][0] if 'results' in response.data else response.data
+            self.assertEqual(data, {'amount': 1.0})
+        response = self.client.get(url, {'fields': 'amount,user', 'expand': 'user'}, format='json', **headers)
+        self.assertEqual(response.data['user']['email'], buyer.email)
+
+        # Writes see every field
+        data = dict(ExchangeSerializer(deal).data, amount=30000000.0)
+        response = self.client.put(url_with_params(reverse('exchange:rud_exchange', kwargs={'uid': deal.uid}), {'fields': 'uid'}), data, format='json', **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        deal.refresh_from_db()
+        self.assertEqual((deal.amount, deal.fund_account_name), (30000000.0, 'My New Account'))
+
+    def test_currency_rates(self):
+        """
+        Test the cross rate matrix, its cache invalidation and bulk conversions
+        """
+        url = reverse('exchange:currency_rates')
+
+        # Without api key
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['rates']), Currency.objects.count())
+
+        # Subset of the matrix, 455 NGN for a USD
+        response = self.client.get(url_with_params(url, {'symbols': 'USD,NGN'}), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.data['symbols'], ['USD', 'NGN'])
+        self.assertAlmostEqual(response.data['rates'][0][1], 455)
+        self.assertAlmostEqual(response.data['rates'][1][0], 1 / 455)
+        self.assertAlmostEqual(response.data['rates'][0][0], 1)
+
+        response = self.client.get(url_with_params(url, {'symbols': 'USD,XXX'}), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # The matrix follows currency value changes
+        naira = Currency.objects.get(symbol='NGN')
+        naira.value = 500
+        naira.save()
+        response = self.client.get(url_with_params(url, {'symbols': 'USD,NGN'}), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertAlmostEqual(response.data['rates'][0][1], 500)
+
+        # Bulk conversion
+        url = reverse('exchange:convert_currency')
+        data = {
+            'conversions': [
+                {'from': 'USD', 'to': 'NGN', 'amount': 2},
+                {'from': 'NGN', 'to': 'USD', 'amount': 1000},
+                {'from': 'ngn', 'to': 'ngn', 'amount': 5},
+            ]
+        }
+        response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        converted = [i['converted'] for i in response.data['results']]
+        for value, expected in zip(converted, [1000, 2, 5]):
+            self.assertAlmostEqual(value, expected)
+
+        for wrong_data in [
+            {'conversions': []},
+            {'conversions': [{'from': 'USD', 'to': 'XXX', 'amount': 2}]},
+            {'conversions': [{'from': 'USD', 'to': 'NGN', 'amount': 'two'}]},
+            {'conversions': [{'from': 'USD', 'to': 'NGN', 'amount': 'inf'}]},
+            {'conversions': [{'from': 'USD', 'to': 'NGN', 'amount': 'nan'}]},
+            # Finite, overflows once converted
+            {'conversions': [{'from': 'USD', 'to': 'NGN', 'amount': '1e308'}]},
+        ]:
+            response = self.client.post(url, wrong_data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_exchange(self):
+        """
+        Test bulk creation of deals, per item errors, the deals limit across
+        the batch and the number of queries
+        """
+        url = reverse('exchange:bulk_exchange')
+        user = self.get_user()
+        user2 = User.objects.create_user(
+            email='sketcherslodge@gmail.com',
+            first_name='john',
+            last_name='doe',
+            password='newrandopass'
+            )
+        deal = {
+            "fund_account_currency": "USD",
+            "exchange_currency": "NGN",
+            "fund_account_name": "My New Account",
+            "fund_account_bank": "UBA",
+            "amount": 60000,
+            "exchange_rate": 456.0,
+            "user": user2.id,
+        }
+
+        # Without api key
+        response = self.client.post(url, [deal], format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Not a list
+        response = self.client.post(url, deal, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # The first user has 4 active deals, only one more fits the limit
+        data = [deal, dict(deal, exchange_currency='fff'), dict(deal, user=user.id), dict(deal, user=user.id), dict(deal, user=1000)]
+        response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['created']), 2)
+        self.assertEqual([i['index'] for i in response.data['errors']], [1, 3, 4])
+        self.assertEqual(user.exchange_set.filter(active=True).count(), settings.EXCHANGE_DEALS_LIMIT)
+        self.assertEqual(user2.exchange_set.count(), 1)
+
+        # Nothing valid
+        response = self.client.post(url, [dict(deal, user=user.id)], format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Queries do not grow with the batch size
+        counts = []
+        for size in [1, 4]:
+            users = [
+                User.objects.create_user(email=f'user{size}{i}@email.com', first_name='bulk', last_name='user', password='randopass')
+                for i in range(size)
+            ]
+            data = [dict(deal, user=i.id) for i in users]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_best_exchange(self):
+        """
+        Test best price deals and filling an amount across several deals
+        """
+        url = reverse('exchange:best_exchange')
+        buyer = self.get_user()
+        seller = User.objects.create_user(
+            email='sketcherslodge@gmail.com',
+            first_name='john',
+            last_name='doe',
+            password='newrandopass'
+            )
+        deals = {}
+        for rate, amount in [(450.0, 60000.0), (440.0, 60000.0), (460.0, 100000.0)]:
+            deals[rate] = Exchange.objects.create(
+                user=seller, fund_account_currency=Currency.objects.get(symbol='USD'),
+                exchange_currency=Currency.objects.get(symbol='NGN'), fund_account_name='My New Account',
+                fund_account_bank='UBA', amount=amount, exchange_rate=rate)
+        order_book.reset()
+        query = {'fund_account_currency': 'USD', 'exchange_currency': 'NGN'}
+
+        # Without api key
+        response = self.client.get(url_with_params(url, query))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.get(url_with_params(url, query), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([i['exchange_rate'] for i in response.data['deals']], [440.0, 450.0, 460.0])
+        self.assertIsNone(response.data['fill'])
+
+        # Only one deal covers 70000 alone, the fill takes the cheapest ones
+        response = self.client.get(url_with_params(url, dict(query, amount=70000)), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual([i['uid'] for i in response.data['deals']], [deals[460.0].uid])
+        fill = response.data['fill']
+        self.assertEqual([(i['deal'], i['amount']) for i in fill['legs']], [(deals[440.0].uid, 60000.0), (deals[450.0].uid, 10000.0)])
+        self.assertEqual(fill['cost'], 60000 * 440 + 10000 * 450)
+
+        response = self.client.get(url_with_params(url, dict(query, amount=70000, max_rate=445)), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.data['deals'], [])
+        self.assertEqual((response.data['fill']['filled'], response.data['fill']['remaining']), (60000, 10000))
+
+        response = self.client.get(url_with_params(url, dict(query, exchange_currency='fff')), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Fill 70000 in one call
+        data = dict(query, amount=70000, user=buyer.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['transactions']), 2)
+        self.assertEqual(Exchange.objects.get(pk=deals[440.0].pk).reserved, 60000)
+        self.assertEqual(Exchange.objects.get(pk=deals[450.0].pk).reserved, 10000)
+
+        # The book follows the reservations
+        response = self.client.get(url_with_params(url, query), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual([(i['exchange_rate'], i['available']) for i in response.data['deals']], [(450.0, 50000.0), (460.0, 100000.0)])
+
+        # Sellers don't buy from themselves and amounts over the book need <partial>
+        response = self.client.post(url, dict(data, user=seller.id), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, dict(data, amount=200000), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # A deal taken behind the book's back is skipped after reloading
+        Exchange.objects.filter(pk=deals[450.0].pk).update(reserved=60000)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, dict(data, amount=50000), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([i['deal'] for i in response.data['fill']['legs']], [deals[460.0].uid])
+
+    def test_exchange_route(self):
+        """
+        Test multi hop routes, the hops and liquidity limits and the route cache
+        """
+        url = reverse('exchange:exchange_route')
+        route_graph.reset()
+
+        # Without api key
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'BUP'}))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # USD -> NGN -> BUP gets more than the direct USD -> BUP deal
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'BUP'}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(i['from'], i['to']) for i in response.data['hops']], [('USD', 'NGN'), ('NGN', 'BUP')])
+        self.assertAlmostEqual(response.data['received'], 1 / 0.34 / 500)
+
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'BUP', 'hops': 1}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual([(i['from'], i['to']) for i in response.data['hops']], [('USD', 'BUP')])
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'YEN', 'hops': 1}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'YEN', 'hops': 10}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # The NGN deal can only take 23000000 * 0.34 USD
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'BUP', 'amount': 10000000}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual([(i['from'], i['to']) for i in response.data['hops']], [('USD', 'BUP')])
+        self.assertEqual(response.data['amount'], 10000000)
+
+        # Routes are cached until a deal changes
+        usd, bup = Currency.objects.get(symbol='USD').pk, Currency.objects.get(symbol='BUP').pk
+        route = route_graph.find(usd, bup, hops=settings.EXCHANGE_ROUTE_MAX_HOPS)
+        self.assertIs(route_graph.find(usd, bup, hops=settings.EXCHANGE_ROUTE_MAX_HOPS), route)
+        loads = route_graph.loads
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'BUP'}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(route_graph.loads, loads)
+
+        deal = Exchange.objects.get(uid=response.data['hops'][1]['deal'])
+        deal.exchange_rate = 1000
+        with self.captureOnCommitCallbacks(execute=True):
+            deal.save()
+        response = self.client.get(url_with_params(url, {'from': 'USD', 'to': 'BUP'}), **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual([(i['from'], i['to']) for i in response.data['hops']], [('USD', 'BUP')])
+        self.assertIsNot(route_graph.find(usd, bup, hops=settings.EXCHANGE_ROUTE_MAX_HOPS), route)
+        self.assertEqual(route_graph.loads, loads)
+
+    @skipUnless(connection.vendor == 'sqlite', 'Reads SQLite query plans')
+    def test_list_queries_use_indexes(self):
+        """
+        Every deal and transaction query made by the list, filter, matching
+        and routing endpoints must be answered from an index, EXPLAIN QUERY
+        PLAN must not show a plain table scan
+        """
+        user = self.get_user()
+        buyer = User.objects.create_user(
+            email='sketcherslodge@gmail.com',
+            first_name='john',
+            last_name='doe',
+            password='newrandopass'
+            )
+        deal = Exchange.objects.first()
+        ExchangeTransaction.objects.create(user=buyer, exchange=deal, amount=300, status='pending')
+        order_book.reset()
+        route_graph.reset()
+
+        requests = [
+            ('exchange:lc_exchange', {}),
+            ('exchange:lc_exchange', {'fund_account_currency': 'BUP'}),
+            ('exchange:lc_exchange', {'exchange_currency': 'NGN'}),
+            ('exchange:lc_exchange', {'fund_account_currency': 'BUP', 'exchange_currency': 'NGN'}),
+            ('exchange:lc_exchange', {'fund_account_currency': 'BUP', 'exchange_currency': 'USD', 'min_amount': 100, 'max_amount': 100000}),
+            ('exchange:lc_exchange', {'min_amount': 100}),
+            ('exchange:lc_exchange', {'cursor': '', 'count': 'true'}),
+            ('exchange:lc_transaction', {}),
+            ('exchange:lc_transaction', {'cursor': ''}),
+            ('exchange:best_exchange', {'fund_account_currency': 'BUP', 'exchange_currency': 'USD', 'amount': 100}),
+            ('exchange:exchange_route', {'from': 'USD', 'to': 'BUP'}),
+        ]
+        tables = re.compile(r'"exchange_exchange(transaction)?"')
+        for name, params in requests:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url_with_params(reverse(name), params), format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK, name)
+
+            for query in queries:
+                sql = query['sql']
+                if not sql.startswith('SELECT') or not tables.search(sql):
+                    continue
+                with connection.cursor() as cursor:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                    plan = [row[-1] for row in cursor.fetchall()]
+                scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+                self.assertEqual(scans, [], f'{name} {params}: {sql}')
+
+        # Transactions by buyer and by deal
+        for queryset in [
+            ExchangeTransaction.objects.filter(user=buyer, status='pending'),
+            ExchangeTransaction.objects.filter(exchange=deal, status='pending'),
+            Exchange.objects.filter(active=True, user=user),
+        ]:
+            self.assertIn('USING INDEX', queryset.explain())
+
+    @override_settings(PROFILING_HEADERS=True)
+    def test_profiling_headers_and_budgets(self):
+        """
+        Test the query count and timing headers and the view query budgets
+        """
+        url = reverse('exchange:lc_exchange')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Query-Count'], str(len(queries)))
+        timings = [i.split(';')[0] for i in response['Server-Timing'].split(', ')]
+        self.assertEqual(timings, ['db', 'serializer', 'render', 'total'])
+        durations = dict(i.split(';')[:2] for i in response['Server-Timing'].split(', '))
+        self.assertGreater(float(durations['serializer'][len('dur='):]), 0)
+
+        # Over budget requests fail the tests
+        with mock.patch.object(views.ListCreateExchange, 'query_budget', {'GET': 1}):
+            with self.assertRaises(BudgetExceeded):
+                self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        with override_settings(PROFILING_ENFORCE_BUDGETS=False), mock.patch.object(views.ListCreateExchange, 'time_budget', 0, create=True):
+            with self.assertLogs('xcrowmeapi.profiling', 'WARNING'):
+                response = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_metrics(self):
+        """
+        Test the /metrics counters and their aggregation across workers
+        """
+        def sample(text, line):
+            found = [i for i in text.splitlines() if i.startswith(line + ' ')]
+            return float(found[0].split()[-1]) if found else 0.0
+
+        route = 'api/exchange/deals/'
+        requests = f'http_requests_total{{route="{route}",method="GET",status="200"}}'
+        # Staff keys and admins only
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_401_UNAUTHORIZED)
+        text = self.client.get('/metrics', **{'HTTP_BEARER_API_KEY':self.user_key}).content.decode()
+        before = sample(text, requests), sample(text, 'xcrowme_deals_created_total')
+
+        url = reverse('exchange:lc_exchange')
+        self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        data = {
+            "fund_account_currency": "USD",
+            "exchange_currency": "NGN",
+            "fund_account_name": "My New Account",
+            "fund_account_bank": "UBA",
+            "amount": 60000,
+            "exchange_rate": 456.0,
+            "user": self.get_user().id,
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get('/metrics', **{'HTTP_BEARER_API_KEY':self.user_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertEqual(sample(text, requests), before[0] + 1)
+        self.assertEqual(sample(text, 'xcrowme_deals_created_total'), before[1] + 1)
+        self.assertGreater(sample(text, f'http_request_duration_seconds_count{{route="{route}",method="GET"}}'), 0)
+        self.assertGreater(sample(text, f'http_request_db_queries_total{{route="{route}",method="GET"}}'), 0)
+        self.assertIn('cache_requests_total{cache="api_key",result="hit"}', text)
+
+        # Made up methods share one series
+        for method in ['FOO', 'BAR']:
+            self.client.generic(method, url, **{'HTTP_BEARER_API_KEY':self.user_key})
+        text = self.client.get('/metrics', **{'HTTP_BEARER_API_KEY':self.user_key}).content.decode()
+        self.assertNotIn('method="FOO"', text)
+        self.assertEqual(sample(text, f'http_request_duration_seconds_count{{route="{route}",method="other"}}'), 2)
+
+        # Workers add up through their files
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            with open(os.path.join(directory, '1-other.json'), 'w') as f:
+                json.dump({'http_requests_total': {
+                    'type': 'counter', 'help': '', 'labels': ['route', 'method', 'status'], 'buckets': [],
+                    'samples': [[[route, 'GET', '200'], 5]],
+                }}, f)
+            text = self.client.get('/metrics', **{'HTTP_BEARER_API_KEY':self.user_key}).content.decode()
+            self.assertEqual(sample(text, requests), before[0] + 1 + 5)
+
+        # A forked worker starts from zero, counting its first request
+        with mock.patch('xcrowmeapi.metrics.os.getpid', return_value=os.getpid() + 1):
+            self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            text = self.client.get('/metrics', **{'HTTP_BEARER_API_KEY':self.user_key}).content.decode()
+        self.assertEqual(sample(text, requests), 1)
+
+    def test_async_views(self):
+        """
+        Test the async views answer like the DRF views, from memory with a
+        cached api key or JWT claims and through the DRF checks otherwise
+        """
+        user = self.get_user()
+        deal = user.exchange_set.first()
+        buyer = User.objects.create_user(
+            email='sketcherslodge@gmail.com', first_name='john', last_name='doe', password='newrandopass')
+        test_transaction = ExchangeTransaction.objects.create(user=buyer, exchange=deal, amount=456, status='pending')
+        naira = Currency.objects.get(symbol='NGN')
+
+        endpoints = [
+            (async_views.CurrencyList, reverse('exchange:list_currency') + '?name=naira', {}),
+            (async_views.CurrencyView, reverse('exchange:get_currency', kwargs={'id': naira.pk}), {'id': naira.pk}),
+            (async_views.ListCreateExchange, reverse('exchange:lc_exchange') + '?exchange_currency=NGN', {}),
+            (async_views.RUDExchange, reverse('exchange:rud_exchange', kwargs={'uid': deal.uid}), {'uid': deal.uid}),
+            (async_views.RUDExchangeTransaction, reverse(
+                'exchange:rud_exchangetransaction', kwargs={'uid': test_transaction.uid}), {'uid': test_transaction.uid}),
+            (auth_async_views.UserAPIView, reverse('auth:user_data', kwargs={'id': user.pk}), {'id': user.pk}),
+        ]
+        factory = AsyncRequestFactory()
+        for view_class, url, kwargs in endpoints:
+            view = view_class.as_async_view()
+            expected = self.client.get(url, format='json', **{'HTTP_BEARER_API_KEY':self.user_key})
+            self.assertEqual(expected.status_code, status.HTTP_200_OK)
+
+            # The key is cached by the request above
+            response = async_to_sync(view)(factory.get(url, **{'bearer-api-key': self.user_key}), **kwargs)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+            self.assertEqual(json.loads(response.content), expected.json(), url)
+
+            key_cache.clear()
+            response = async_to_sync(view)(factory.get(url, **{'bearer-api-key': self.user_key}), **kwargs)
+            self.assertEqual(json.loads(response.content), expected.json(), url)
+
+            response = async_to_sync(view)(factory.get(url), **kwargs)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED, url)
+
+        # Currencies don't touch the database once the registry is loaded
+        view = async_views.CurrencyList.as_async_view()
+        request = factory.get(reverse('exchange:list_currency'), **{'bearer-api-key': self.user_key})
+        with self.assertNumQueries(0):
+            response = async_to_sync(view)(request)
+        self.assertEqual(len(json.loads(response.content)['results']), 4)
+
+        # Admins are let in from their token claims
+        user.staff = True
+        user.save()
+        access = get_tokens_for_user(user)['access']
+        request = factory.get(reverse('exchange:list_currency'), authorization=f'Bearer {access}')
+        with self.assertNumQueries(0):
+            response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Other methods are handled by the DRF view
+        view = async_views.RUDExchangeTransaction.as_async_view()
+        request = factory.delete(
+            reverse('exchange:rud_exchangetransaction', kwargs={'uid': test_transaction.uid}),
+            **{'bearer-api-key': self.user_key})
+        response = async_to_sync(view)(request, uid=test_transaction.uid)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(ExchangeTransaction.objects.filter(pk=test_transaction.pk).exists())
+
+    def reload_urls(self):
+        # The views of the urlconf are picked by ASYNC_VIEWS when it is imported
+        for module in [urls, auth_urls, root_urls]:
+            importlib.reload(module)
+        clear_url_caches()
+
+    def test_async_urls(self):
+        """
+        Test the urlconf serves the async views when ASYNC_VIEWS is set, and a
+        registry invalidated during an in memory request is not reloaded in
+        the event loop
+        """
+        async def get(url, **headers):
+            return await AsyncClient().get(url, **headers)
+
+        url = reverse('exchange:list_currency')
+        self.assertFalse(asyncio.iscoroutinefunction(resolve(url).func))
+        self.addCleanup(self.reload_urls)
+        with override_settings(ASYNC_VIEWS=True):
+            self.reload_urls()
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(url).func))
+            response = async_to_sync(get)(url, **{'bearer-api-key': self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.json()['results']), 4)
+
+            refresh = currency_registry.refresh
+
+            async def refresh_then_invalidate():
+                state = await refresh()
+                # A currency saved by another thread meanwhile
+                currency_registry._state = None
+                return state
+
+            with mock.patch.object(currency_registry, 'refresh', refresh_then_invalidate):
+                response = async_to_sync(get)(url, **{'bearer-api-key': self.user_key})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.json()['results']), 4)
+
+    def test_profiling_under_asgi(self):
+        """
+        Test the queries run in threads by ASGI requests are counted
+        """
+        async def get(url):
+            return await AsyncClient().get(url, **{'bearer-api-key': self.user_key})
+
+        url = reverse('exchange:lc_exchange')
+        with CaptureQueriesContext(connection) as queries:
+            response = async_to_sync(get)(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(len(queries), 0)
+        self.assertEqual(response['X-Query-Count'], str(len(queries)))
+
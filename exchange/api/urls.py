@@ -1,14 +1,19 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 
 app_name = 'exchange'
 urlpatterns = [
-	path('deals/', views.ListCreateExchange.as_view(), name='lc_exchange'),
-	path('deals/<str:uid>/', views.RUDExchange.as_view(), name='rud_exchange'),
+	path('deals/', async_views.ListCreateExchange.as_view(), name='lc_exchange'),
+	path('deals/bulk/', views.BulkCreateExchange.as_view(), name='bulk_exchange'),
+	path('deals/best/', views.BestExchange.as_view(), name='best_exchange'),
+	path('deals/route/', views.ExchangeRoute.as_view(), name='exchange_route'),
+	path('deals/<str:uid>/', async_views.RUDExchange.as_view(), name='rud_exchange'),
 	path('transactions/', views.ListCreateExchangeTransaction.as_view(), name='lc_transaction'),
-	path('transactions/<str:uid>/', views.RUDExchangeTransaction.as_view(), name='rud_exchangetransaction'),
+	path('transactions/<str:uid>/', async_views.RUDExchangeTransaction.as_view(), name='rud_exchangetransaction'),
 
     # Currency paths
-	path('currency/list/', views.CurrencyList.as_view(), name='list_currency'),
-	path('currency/get/<int:id>/', views.CurrencyView.as_view(), name='get_currency'),
+	path('currency/list/', async_views.CurrencyList.as_view(), name='list_currency'),
+	path('currency/get/<int:id>/', async_views.CurrencyView.as_view(), name='get_currency'),
+	path('currency/rates/', views.CurrencyRates.as_view(), name='currency_rates'),
+	path('currency/convert/', views.ConvertCurrency.as_view(), name='convert_currency'),
 ]
\ No newline at end of file
@@ -1,3 +1,8 @@
+import math
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from rest_framework import status
 from rest_framework.exceptions import ParseError, NotFound
 from rest_framework.permissions import IsAuthenticated
@@ -8,43 +13,108 @@ from rest_framework.response import Response
 
 from project_api_key.permissions import HasStaffProjectAPIKey
 
+from authentication.models import User
 from authentication.permissions import IsAuthenticatedAdmin
 
-from exchange.models import Exchange, ExchangeTransaction, Currency
+from exchange.models import Exchange, ExchangeTransaction, Currency, DealCounter, update_deal_indexes
+from exchange.orderbook import order_book
+from exchange.routing import route_graph
+from exchange.rates import cross_rates
+from exchange.registry import currency_registry
+from xcrowmeapi.metrics import deals_created
+from xcrowmeapi.fieldsets import SparseFieldsViewMixin
+from xcrowmeapi.profiling import ProfiledViewMixin
 
 from . import serializers
 
 
-class CurrencyList(generics.ListAPIView):
+class CurrencyList(ProfiledViewMixin, generics.ListAPIView):
     serializer_class = serializers.CurrencySerializer
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 2}
 
     def get_queryset(self):
-        queryset = Currency.objects.all()
-        
-        # Check for filtering queries
+        # Currencies are served from the registry, ordered by name
         query = self.request.query_params
         name = query.get('name', '')
         symbol = query.get('symbol', '')
-        if symbol:
-            queryset = queryset.filter(symbol__icontains=symbol)
-        if name:
-            queryset = queryset.filter(name__icontains=name)
-        
-        return queryset.order_by('name')
 
-class CurrencyView(generics.RetrieveAPIView):
+        return currency_registry.search(name=name, symbol=symbol)
+
+class CurrencyView(ProfiledViewMixin, generics.RetrieveAPIView):
     lookup_field = 'id'
     serializer_class = serializers.CurrencySerializer
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 2}
 
     def get_queryset(self):
         return Currency.objects.all()
 
+    def get_object(self):
+        obj = currency_registry.get(self.kwargs.get('id'))
+        if obj is None:
+            raise NotFound(detail='Currency does not exist')
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+
+class CurrencyRates(APIView):
+    """
+    Cross rate matrix of all currencies (or of ?symbols=USD,NGN), rates[a][b]
+    is how many <b> for one <a>
+    """
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 2}
+
+    def get(self, request, format=None):
+        matrix = cross_rates.get()
+
+        symbols = [i for i in request.query_params.get('symbols', '').split(',') if i] or None
+        if symbols:
+            unknown = matrix.unknown(symbols)
+            if unknown:
+                raise NotFound(detail=f'Currencies do not exist: {", ".join(unknown)}')
+
+        symbols, rates = matrix.to_list(symbols)
+        return Response({
+            'symbols': symbols,
+            'rates': rates
+        }, status=status.HTTP_200_OK)
+
+
+class ConvertCurrency(APIView):
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    serializer_class = serializers.CurrencyConversionSerializer
+
+    def post(self, request, format=None):
+        # Validate and convert against the same matrix
+        matrix = cross_rates.get()
+        serializer = self.serializer_class(data=request.data, context={'matrix': matrix})
+        if serializer.is_valid():
+            sources, targets, amounts = serializer.validated_data['conversions']
+            converted = matrix.convert(sources, targets, amounts)
+            # Huge amounts overflow, they can't be sent as JSON
+            overflows = [index for index, value in enumerate(converted) if value is not None and not math.isfinite(value)]
+            if overflows:
+                return Response({
+                    'conversions': [f'Conversion {index} is out of range' for index in overflows]
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            return Response({
+                'results': [
+                    {'from': i, 'to': j, 'amount': amount, 'converted': value}
+                    for i, j, amount, value in zip(sources, targets, amounts, converted)
+                ]
+            }, status=status.HTTP_200_OK)
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
         
-class ListCreateExchange(generics.ListCreateAPIView):
+class ListCreateExchange(SparseFieldsViewMixin, ProfiledViewMixin, generics.ListCreateAPIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 4}
     serializer_class = serializers.ExchangeSerializer
+    keyset_ordering = ('created', 'id')
 
     def get_queryset(self):
         # We return only active exchange deals
@@ -56,10 +126,13 @@ class ListCreateExchange(generics.ListCreateAPIView):
         c2 = query.get('exchange_currency', '')
         min_amount = query.get('min_amount', '')
         max_amount = query.get('max_amount', '')
-        if c1:
-            queryset = queryset.filter(fund_account_currency__symbol__iexact=c1)
-        if c2:
-            queryset = queryset.filter(exchange_currency__symbol__iexact=c2)
+        # Currencies are resolved from the registry, no join is needed
+        for field, symbol in [('fund_account_currency', c1), ('exchange_currency', c2)]:
+            if symbol:
+                currency = currency_registry.get_by_symbol(symbol)
+                if currency is None:
+                    return queryset.none()
+                queryset = queryset.filter(**{f'{field}_id': currency.pk})
         if max_amount:
             queryset = queryset.filter(amount__lte=max_amount)
         if min_amount:
@@ -68,27 +141,237 @@ class ListCreateExchange(generics.ListCreateAPIView):
         return queryset
 
 
-class RUDExchange(generics.RetrieveUpdateDestroyAPIView):
+class BulkCreateExchange(APIView):
+    """
+    Creates a list of deals in one call. Users, currencies and the deal
+    counters are fetched once for the whole batch, <EXCHANGE_DEALS_LIMIT> is
+    enforced across the batch and the valid deals are inserted together.
+    Invalid deals are reported by their index in the list.
+    """
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    serializer_class = serializers.ExchangeSerializer
+
+    def post(self, request, format=None):
+        data = request.data
+        limit = settings.EXCHANGE_BULK_LIMIT
+        if not isinstance(data, list) or not data:
+            raise ParseError(detail='Expected a list of deals')
+        if len(data) > limit:
+            raise ParseError(detail=f'You can only create {limit} deals at a time')
+
+        user_ids = set()
+        for item in data:
+            try:
+                user_ids.add(int(item.get('user')))
+            except (AttributeError, TypeError, ValueError):
+                pass
+        users = User.objects.in_bulk(user_ids)
+
+        with transaction.atomic():
+            # Lock the deal counters of the batch users, then validate every
+            # deal against them
+            DealCounter.objects.bulk_create([DealCounter(user_id=i) for i in users], ignore_conflicts=True)
+            counters = list(DealCounter.objects.select_for_update().filter(user_id__in=users))
+            active_counts = {counter.user_id: counter.active for counter in counters}
+
+            context = self.get_serializer_context()
+            context.update({'users': users, 'active_counts': active_counts})
+
+            deals, errors = [], []
+            for index, item in enumerate(data):
+                serializer = self.serializer_class(data=item, context=context)
+                if serializer.is_valid():
+                    deal = Exchange(**serializer.validated_data)
+                    # Later deals of the batch see the ones before them
+                    if deal.active:
+                        active_counts[deal.user_id] += 1
+                    deals.append(deal)
+                else:
+                    errors.append({'index': index, 'errors': serializer.errors})
+
+            if not deals:
+                return Response({'created': [], 'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+            Exchange.objects.bulk_create(deals)
+            # bulk_create sends no signals, reload the deal indexes of the batch pairs
+            pairs = {(deal.fund_account_currency_id, deal.exchange_currency_id) for deal in deals}
+            update_deal_indexes('reset', pairs)
+            transaction.on_commit(lambda: deals_created.inc(len(deals)))
+            for counter in counters:
+                counter.active = active_counts[counter.user_id]
+            DealCounter.objects.bulk_update(counters, ['active'])
+
+        return Response({
+            'created': self.serializer_class(deals, many=True).data,
+            'errors': errors
+        }, status=status.HTTP_201_CREATED)
+
+    def get_serializer_context(self):
+        return {'request': self.request, 'format': self.format_kwarg, 'view': self}
+
+
+class BestExchange(APIView):
+    """
+    Best price deals of a currency pair from the order book. GET returns the
+    cheapest deals that can cover ?amount= on their own and how the amount
+    would be filled across several deals, POST fills it by creating a pending
+    transaction on every deal used
+    """
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 3}
+    # Tries before giving up when the book was behind the database
+    fill_attempts = 3
+
+    def get(self, request, format=None):
+        serializer = serializers.OrderBookSerializer(data=request.query_params)
+        if serializer.is_valid():
+            data = serializer.validated_data
+            pair = self.get_pair(data)
+            deals = order_book.best(pair, data['amount'], data['limit'], data.get('max_rate'))
+            fill = order_book.fill(pair, data['amount'], data.get('max_rate')) if data['amount'] else None
+
+            return Response({
+                'deals': [self.deal_data(deal) for deal in deals],
+                'fill': self.fill_data(fill) if fill else None
+            }, status=status.HTTP_200_OK)
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def post(self, request, format=None):
+        serializer = serializers.OrderFillSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        pair, user = self.get_pair(data), data['user']
+        for _ in range(self.fill_attempts):
+            fill = order_book.fill(pair, data['amount'], data.get('max_rate'), exclude_user=user.pk)
+            if not fill.legs or (fill.remaining and not data['partial']):
+                return Response({
+                    'amount': [f'Only {fill.filled} {data["fund_account_currency"]} is available']
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                transactions = self.perform_fill(user, fill)
+            except ValidationError:
+                # The book was behind, reload the pair and plan again
+                order_book.reset([pair])
+                continue
+
+            return Response({
+                'fill': self.fill_data(fill),
+                'transactions': serializers.ExchangeTransactionSerializer(transactions, many=True).data
+            }, status=status.HTTP_201_CREATED)
+
+        return Response({'detail': 'The deals changed while filling, try again'}, status=status.HTTP_409_CONFLICT)
+
+    def perform_fill(self, user, fill):
+        with transaction.atomic():
+            deals = Exchange.objects.in_bulk([leg.deal.pk for leg in fill.legs])
+            transactions = []
+            for leg in fill.legs:
+                deal = deals.get(leg.deal.pk)
+                if deal is None or not deal.active or deal.exchange_rate != leg.deal.exchange_rate:
+                    raise ValidationError('Deal changed')
+                # Saving reserves the leg, it fails if someone took it first
+                obj = ExchangeTransaction(user=user, exchange=deal, amount=leg.cost, status='pending')
+                obj.save()
+                transactions.append(obj)
+        return transactions
+
+    def get_pair(self, data):
+        return (data['fund_account_currency'].pk, data['exchange_currency'].pk)
+
+    def deal_data(self, deal):
+        return {
+            'uid': deal.uid,
+            'user': deal.user_id,
+            'exchange_rate': deal.exchange_rate,
+            'available': deal.available
+        }
+
+    def fill_data(self, fill):
+        return {
+            'legs': [
+                {'deal': leg.deal.uid, 'exchange_rate': leg.deal.exchange_rate, 'amount': leg.amount, 'cost': leg.cost}
+                for leg in fill.legs
+            ],
+            'filled': fill.filled,
+            'remaining': fill.remaining,
+            'cost': fill.cost,
+            'average_rate': (fill.cost / fill.filled) if fill.filled else None
+        }
+
+
+class ExchangeRoute(APIView):
+    """
+    Best chain of deals from one currency to another (?from=YEN&to=USD),
+    with ?amount= only deals with enough liquidity are used. Routes have at
+    most ?hops= deals (<EXCHANGE_ROUTE_MAX_HOPS> by default)
+    """
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 3}
+
+    def get(self, request, format=None):
+        serializer = serializers.RouteSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        source, target = data['from'], data['to']
+        hops = data.get('hops', settings.EXCHANGE_ROUTE_MAX_HOPS)
+        route = route_graph.find(source.pk, target.pk, data.get('amount'), hops)
+        if route is None:
+            raise NotFound(detail=f'No route from {source} to {target}')
+
+        return Response({
+            'from': source.symbol,
+            'to': target.symbol,
+            'amount': route.amount,
+            'received': route.received,
+            'rate': route.amount / route.received,
+            'hops': [
+                {
+                    'deal': hop.deal[1],
+                    'from': self.symbol(hop.source),
+                    'to': self.symbol(hop.target),
+                    'exchange_rate': hop.exchange_rate,
+                    'amount': hop.amount,
+                    'received': hop.received
+                } for hop in route.hops
+            ]
+        }, status=status.HTTP_200_OK)
+
+    def symbol(self, pk):
+        currency = currency_registry.get(pk)
+        return currency.symbol if currency else None
+
+
+class RUDExchange(SparseFieldsViewMixin, ProfiledViewMixin, generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'uid'
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 3}
     serializer_class = serializers.ExchangeSerializer
 
     def get_queryset(self):
         return Exchange.objects.all()
 
 
-class ListCreateExchangeTransaction(generics.ListCreateAPIView):
+class ListCreateExchangeTransaction(SparseFieldsViewMixin, ProfiledViewMixin, generics.ListCreateAPIView):
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 4}
     serializer_class = serializers.ExchangeTransactionSerializer
+    keyset_ordering = ('created', 'id')
 
     def get_queryset(self):
-        return ExchangeTransaction.objects.all()
+        return ExchangeTransaction.objects.select_related('exchange')
 
 
-class RUDExchangeTransaction(generics.RetrieveUpdateDestroyAPIView):
+class RUDExchangeTransaction(SparseFieldsViewMixin, ProfiledViewMixin, generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'uid'
     permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+    query_budget = {'GET': 3}
     serializer_class = serializers.ExchangeTransactionSerializer
 
     def get_queryset(self):
-        return ExchangeTransaction.objects.all()
\ No newline at end of file
+        return ExchangeTransaction.objects.select_related('exchange')
\ No newline at end of file
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from exchange.models import DealCounter
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the active deal counters of the users from their deals'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Only report the wrong counters, fails if there are any',
+        )
+
+    def handle(self, *args, **options):
+        verify = options['verify']
+        wrong = DealCounter.objects.rebuild(fix=not verify)
+
+        for user_id, (counter, actual) in sorted(wrong.items()):
+            self.stdout.write(f'User {user_id}: counter {counter}, active deals {actual}')
+
+        if verify and wrong:
+            raise CommandError(f'{len(wrong)} deal counters are wrong')
+        if verify:
+            self.stdout.write(self.style.SUCCESS('All deal counters are correct'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(wrong)} deal counters'))
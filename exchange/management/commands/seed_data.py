@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from exchange.seeding import PASSWORD, Seeder
+
+
+class Command(BaseCommand):
+    help = 'Seeds users, profiles, currencies, deals and transactions in bulk for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--deals', type=int, default=100000)
+        parser.add_argument('--transactions', type=int, default=1000000)
+        parser.add_argument('--days', type=int, default=365, help='Age of the oldest rows')
+        parser.add_argument('--seed', type=int, help='Random seed, runs with the same seed make the same data')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--password', default=PASSWORD, help='Password of every seeded user')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2 and (options['deals'] or options['transactions']):
+            raise CommandError('Deals and transactions need at least 2 users')
+        if options['deals'] < 1 and options['transactions']:
+            raise CommandError('Transactions need at least 1 deal')
+
+        start = time.perf_counter()
+        Seeder(
+            options['users'], options['deals'], options['transactions'], days=options['days'],
+            seed=options['seed'], batch_size=options['batch_size'], password=options['password'],
+            log=self.stdout.write,
+        ).run()
+        self.stdout.write(self.style.SUCCESS(f'Seeded in {time.perf_counter() - start:.1f} s'))
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:00
+
+from django.db import migrations, models
+import exchange.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0009_alter_exchangetransaction_options'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exchange',
+            name='uid',
+            field=models.CharField(blank=True, default=exchange.utils.new_uid, max_length=16, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='exchangetransaction',
+            name='uid',
+            field=models.CharField(blank=True, default=exchange.utils.new_uid, max_length=16, unique=True),
+        ),
+    ]
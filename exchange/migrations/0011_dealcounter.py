@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_active_deals(apps, schema_editor):
+    Exchange = apps.get_model('exchange', 'Exchange')
+    DealCounter = apps.get_model('exchange', 'DealCounter')
+
+    counts = (
+        Exchange.objects.filter(active=True).order_by()
+        .values_list('user').annotate(count=models.Count('id'))
+    )
+    DealCounter.objects.bulk_create([DealCounter(user_id=user_id, active=count) for user_id, count in counts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0004_auto_20210618_2144'),
+        ('exchange', '0010_auto_20261017_2000'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DealCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='deal_counter', serialize=False, to='authentication.user')),
+                ('active', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_active_deals, migrations.RunPython.noop),
+    ]
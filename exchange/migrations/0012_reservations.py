@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0011_dealcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='reserved',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='exchangetransaction',
+            name='reserved',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='exchangetransaction',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], max_length=20),
+        ),
+    ]
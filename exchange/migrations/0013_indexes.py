@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0012_reservations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='exchange',
+            index=models.Index(condition=models.Q(('active', True)), fields=['fund_account_currency', 'exchange_currency', 'amount'], name='exchange_active_pair_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchange',
+            index=models.Index(condition=models.Q(('active', True)), fields=['created', 'id'], name='exchange_active_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchange',
+            index=models.Index(condition=models.Q(('active', True)), fields=['user'], name='exchange_active_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangetransaction',
+            index=models.Index(fields=['created', 'id'], name='transaction_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangetransaction',
+            index=models.Index(fields=['user', 'status'], name='transaction_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangetransaction',
+            index=models.Index(fields=['exchange', 'status'], name='transaction_deal_status_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def normalize_symbols(apps, schema_editor):
+    Currency = apps.get_model('exchange', 'Currency')
+
+    currencies = list(Currency.objects.all())
+    symbols = {}
+    for currency in currencies:
+        symbols.setdefault(currency.symbol.strip().upper(), []).append(currency.symbol)
+    duplicates = [names for names in symbols.values() if len(names) > 1]
+    if duplicates:
+        raise ValueError(f'Currency symbols only differing by case must be merged first: {duplicates}')
+
+    changed = []
+    for currency in currencies:
+        symbol = currency.symbol.strip().upper()
+        if symbol != currency.symbol:
+            currency.symbol = symbol
+            changed.append(currency)
+    Currency.objects.bulk_update(changed, ['symbol'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0013_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_symbols, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,51 @@
+from functools import partial
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import pre_save, post_save
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 from authentication.models import User
 from authentication.validators import validate_special_char
+from xcrowmeapi.metrics import deals_created, transactions_completed
+
+from .orderbook import order_book
+from .registry import currency_registry
+from .routing import route_graph
+from .utils import validate_exchange_amount, get_usable_uid, new_uid, normalize_symbol, uid_generator
+
+
+# Indexes of the active deals, they follow the deals once changes are committed
+DEAL_INDEXES = (order_book, route_graph)
+
+
+def update_deal_indexes(method, *args, **kwargs):
+    def update():
+        for index in DEAL_INDEXES:
+            getattr(index, method)(*args, **kwargs)
+    transaction.on_commit(update)
+
 
-from .utils import validate_exchange_amount, get_usable_uid
+def insert_with_unique_uid(instances, insert, attempts=3):
+    """
+    Runs <insert> for new <instances>, the uids of those already taken (two
+    workers on the same random node, see <UIDGenerator>) are replaced and
+    the insert is tried again
+    """
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return insert()
+        except IntegrityError:
+            model = type(instances[0])
+            taken = set(model._default_manager.filter(uid__in=[i.uid for i in instances]).values_list('uid', flat=True))
+            if not taken or attempt == attempts - 1:
+                raise
+            instances = [i for i in instances if i.uid in taken]
+            for instance, uid in zip(instances, uid_generator.many(len(instances))):
+                instance.uid = uid
 
 
 class Currency(models.Model):
@@ -19,9 +57,120 @@ class Currency(models.Model):
     def __str__(self):
         return self.symbol
 
+    def clean(self):
+        # Normalized before the unique check of model forms
+        self.symbol = normalize_symbol(self.symbol)
+
+    def save(self, *args, **kwargs):
+        # Symbols are stored upper case so lookups are plain equality
+        self.symbol = normalize_symbol(self.symbol)
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name_plural = 'Currencies'
 
+class DealCounterManager(models.Manager):
+    def get_count(self, user_id):
+        return self.filter(user_id=user_id).values_list('active', flat=True).first() or 0
+
+    def reserve(self, user_id, limit, count=1):
+        """
+        Adds <count> active deals to the user counter in one conditional
+        update, returns False when it would go over <limit>
+        """
+        deals = self.filter(user_id=user_id, active__lte=limit - count)
+        updated = deals.update(active=F('active') + count)
+        if not updated and not self.filter(user_id=user_id).exists():
+            # First deal of the user
+            self.bulk_create([self.model(user_id=user_id)], ignore_conflicts=True)
+            updated = deals.update(active=F('active') + count)
+        return bool(updated)
+
+    def release(self, user_id, count=1):
+        self.filter(user_id=user_id, active__gte=count).update(active=F('active') - count)
+
+    def rebuild(self, fix=True):
+        """
+        Compares every counter with the active deals of its user, returns the
+        wrong ones as {user id: (counter, actual)} and fixes them when <fix>
+        """
+        actual = dict(
+            Exchange.objects.filter(active=True).order_by()
+            .values_list('user').annotate(count=Count('id'))
+        )
+        counters = dict(self.values_list('user_id', 'active'))
+
+        wrong = {}
+        for user_id in set(actual) | set(counters):
+            if counters.get(user_id, 0) != actual.get(user_id, 0):
+                wrong[user_id] = (counters.get(user_id), actual.get(user_id, 0))
+
+        if fix and wrong:
+            with transaction.atomic():
+                self.bulk_create([self.model(user_id=i) for i in wrong if wrong[i][0] is None])
+                objs = [self.model(user_id=i, active=wrong[i][1]) for i in wrong]
+                self.bulk_update(objs, ['active'])
+        return wrong
+
+
+class DealCounter(models.Model):
+    """
+    Number of active deals of a user, kept up to date by Exchange so the
+    <EXCHANGE_DEALS_LIMIT> checks don't count the user's deals
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='deal_counter')
+    active = models.PositiveIntegerField(default=0)
+
+    objects = DealCounterManager()
+
+    def __str__(self):
+        return str(self.user_id)
+
+
+class ExchangeManager(models.Manager):
+    """
+    Liquidity of the deals is moved with conditional updates on the deal row
+    so concurrent transactions on the same deal can't oversubscribe it, the
+    deal indexes follow once the changes are committed
+    """
+    def reserve(self, pk, amount):
+        # Holds <amount> of an active deal, False if it is not available
+        updated = self.filter(pk=pk, active=True, amount__gte=F('reserved') + amount).update(reserved=F('reserved') + amount)
+        if updated:
+            update_deal_indexes('liquidity_changed', pk, reserved=amount)
+        return bool(updated)
+
+    def release(self, pk, amount):
+        updated = self.filter(pk=pk, reserved__gte=amount).update(reserved=F('reserved') - amount)
+        if updated:
+            update_deal_indexes('liquidity_changed', pk, reserved=-amount)
+        return bool(updated)
+
+    def commit(self, pk, amount):
+        # Takes a held amount out of the deal
+        updated = self.filter(pk=pk, reserved__gte=amount).update(amount=F('amount') - amount, reserved=F('reserved') - amount)
+        if updated:
+            update_deal_indexes('liquidity_changed', pk, amount=-amount, reserved=-amount)
+        return bool(updated)
+
+    def adjust(self, pk, amount):
+        # Adds <amount> (negative to take) to a deal, False if it would go under what is held
+        updated = self.filter(pk=pk, amount__gte=F('reserved') - amount).update(amount=F('amount') + amount)
+        if updated:
+            update_deal_indexes('liquidity_changed', pk, amount=amount)
+        return bool(updated)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        if not objs:
+            return objs
+        insert_with_unique_uid(objs, lambda: super(ExchangeManager, self).bulk_create(objs, *args, **kwargs))
+        # Stored like a save would, later saves and deletes move the deal counters
+        for obj in objs:
+            obj._active_in_db, obj._user_in_db, obj._amount_in_db = obj.active, obj.user_id, obj.amount
+        return objs
+
+
 class Exchange(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     fund_account_name = models.CharField(max_length=25, validators=[validate_special_char])
@@ -29,6 +178,8 @@ class Exchange(models.Model):
     fund_account_currency = models.ForeignKey(Currency, on_delete=models.PROTECT, related_name='fund_currency')
     # This is the amount of currency in account
     amount = models.FloatField()
+    # Part of the amount held by pending transactions
+    reserved = models.FloatField(default=0, editable=False)
     exchange_currency = models.ForeignKey(Currency, on_delete=models.PROTECT)
     """
     Exchange rate works in a simple way, it reads like
@@ -48,34 +199,83 @@ class Exchange(models.Model):
     active = models.BooleanField(default=True)
 
     # Basic unique identifier for most models
-    uid = models.CharField(max_length=16, unique=True, blank=True)
+    uid = models.CharField(max_length=16, unique=True, blank=True, default=new_uid)
+
+    objects = ExchangeManager()
     
+    # Values stored in the database, used to move the user deal counters
+    _active_in_db = False
+    _user_in_db = None
+    _amount_in_db = None
+
     def __str__(self):
         return str(self.user)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._active_in_db = instance.__dict__.get('active', False)
+        instance._user_in_db = instance.__dict__.get('user_id')
+        instance._amount_in_db = instance.__dict__.get('amount')
+        return instance
+
     # Override save method to validate amount
     def save(self, *args, **kwargs):
         # Validate the exchange amount condition
-        currency = self.fund_account_currency
+        currency = currency_registry.get(self.fund_account_currency_id) or self.fund_account_currency
         res, needed = validate_exchange_amount(amount=self.amount, value=currency.value)
         if not res:
             raise ValidationError(f'Exchange amount is too small, should not be less than {needed} {currency.symbol}')
         
-        # Validate for deals limit condition
-        if self.user.exchange_set.filter(active=True).exclude(uid=self.uid).count() >= settings.EXCHANGE_DEALS_LIMIT:
-            raise ValidationError(f'You can only have {settings.EXCHANGE_DEALS_LIMIT} active deals at a time')
-        
-        # Save the instance
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            # Move the deal counters, the reservation fails over the deals limit
+            was_counted = self._active_in_db and not self._state.adding
+            counted_user = self._user_in_db if was_counted else None
+            new_user = self.user_id if self.active else None
+            if counted_user != new_user:
+                if new_user is not None and not DealCounter.objects.reserve(new_user, settings.EXCHANGE_DEALS_LIMIT):
+                    raise ValidationError(f'You can only have {settings.EXCHANGE_DEALS_LIMIT} active deals at a time')
+                if counted_user is not None:
+                    DealCounter.objects.release(counted_user)
+
+            # Liquidity is only moved by the conditional updates, transactions
+            # may have taken from the deal since this instance was loaded so
+            # the owner's change of the amount is added to the stored one
+            if not self._state.adding and kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in ('amount', 'reserved')
+                ]
+                change = self.amount - self._amount_in_db if self._amount_in_db is not None else 0
+                if change:
+                    if not Exchange.objects.adjust(self.pk, change):
+                        raise ValidationError('Part of this amount is held by pending transactions')
+                    self.amount = Exchange.objects.filter(pk=self.pk).values_list('amount', flat=True).get()
+
+            # Save the instance
+            if self._state.adding:
+                insert_with_unique_uid([self], partial(super().save, *args, **kwargs))
+            else:
+                super().save(*args, **kwargs)
+        self._active_in_db, self._user_in_db, self._amount_in_db = self.active, self.user_id, self.amount
     
     class Meta:
         ordering = ['created']
+        # Only active deals are listed, matched and counted
+        indexes = [
+            models.Index(
+                fields=['fund_account_currency', 'exchange_currency', 'amount'],
+                condition=models.Q(active=True), name='exchange_active_pair_idx'),
+            models.Index(fields=['created', 'id'], condition=models.Q(active=True), name='exchange_active_created_idx'),
+            models.Index(fields=['user'], condition=models.Q(active=True), name='exchange_active_user_idx'),
+        ]
 
 
 class ExchangeTransaction(models.Model):
     STATUS = [
         ('pending', 'Pending',),
-        ('completed', 'Completed',)
+        ('completed', 'Completed',),
+        ('cancelled', 'Cancelled',),
     ]
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     exchange = models.ForeignKey(Exchange, on_delete=models.CASCADE)
@@ -84,9 +284,15 @@ class ExchangeTransaction(models.Model):
     status = models.CharField(choices=STATUS, max_length=20)
     thumbs_up = models.BooleanField(null=True)
     created = models.DateTimeField(auto_now_add=True)
+    # Amount of the deal currency held for this transaction while pending
+    reserved = models.FloatField(default=0, editable=False)
     
     # Basic unique identifier for most models
-    uid = models.CharField(max_length=16, unique=True, blank=True)
+    uid = models.CharField(max_length=16, unique=True, blank=True, default=new_uid)
+
+    # Values stored in the database, used to move the deal liquidity
+    _status_in_db = None
+    _exchange_in_db = None
 
     @property
     def get_exchange_currency(self):
@@ -100,15 +306,96 @@ class ExchangeTransaction(models.Model):
     
     def __str__(self):
         return self.user.fullname
-    
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._status_in_db = instance.__dict__.get('status')
+        instance._exchange_in_db = instance.__dict__.get('exchange_id')
+        return instance
+
+    def get_needed(self):
+        # Amount of the deal currency this transaction buys
+        return self.amount / self.exchange.exchange_rate
+
     def save(self, *args, **kwargs):
         # If the user owns the exchange, throw an error(User can't buy from himself)
-        if self.user == self.exchange.user:
+        if self.user_id == self.exchange.user_id:
             raise ValidationError('You can\'t buy from your deal')
-        return super().save(*args, **kwargs)
+
+        previous = None if self._state.adding else self._status_in_db
+        if previous in ('completed', 'cancelled') and self.status != previous:
+            raise ValidationError(f'A {previous} transaction can\'t be changed')
+
+        original = self.reserved
+        held = original if previous == 'pending' else 0
+        needed = self.get_needed() if self.status in ('pending', 'completed') else 0
+        same_hold = previous == 'pending' and self._exchange_in_db == self.exchange_id and held == needed
+        try:
+            with transaction.atomic():
+                if same_hold and self.status == 'completed':
+                    # Take what is already held, even if the deal was deactivated since
+                    if not Exchange.objects.commit(self.exchange_id, held):
+                        raise ValidationError('The amount held for this transaction is no longer on the deal')
+                    self.reserved = 0
+                    transaction.on_commit(transactions_completed.inc)
+                elif not (same_hold and self.status == 'pending'):
+                    # Give back what the transaction held, then hold or take what it needs now
+                    if held and not Exchange.objects.release(self._exchange_in_db, held):
+                        raise ValidationError('The amount held for this transaction is no longer on the deal')
+                    self.reserved = 0
+                    if needed:
+                        if not Exchange.objects.reserve(self.exchange_id, needed):
+                            raise ValidationError(f'Exchanger doesn\'t have up to {self.amount} available')
+                        if self.status == 'completed':
+                            if not Exchange.objects.commit(self.exchange_id, needed):
+                                raise ValidationError(f'Exchanger doesn\'t have up to {self.amount} available')
+                            transaction.on_commit(transactions_completed.inc)
+                        else:
+                            self.reserved = needed
+
+                if self._state.adding:
+                    insert_with_unique_uid([self], partial(super().save, *args, **kwargs))
+                else:
+                    super().save(*args, **kwargs)
+        except Exception:
+            self.reserved = original
+            raise
+        self._status_in_db, self._exchange_in_db = self.status, self.exchange_id
     
     class Meta:
         ordering = ['created']
+        indexes = [
+            models.Index(fields=['created', 'id'], name='transaction_created_idx'),
+            models.Index(fields=['user', 'status'], name='transaction_user_status_idx'),
+            models.Index(fields=['exchange', 'status'], name='transaction_deal_status_idx'),
+        ]
+
+@receiver([post_save, post_delete], sender=Currency)
+def reload_currency_registry(sender, instance, **kwargs):
+    # Reload now for this process and again once the change is committed
+    currency_registry.invalidate()
+    transaction.on_commit(currency_registry.invalidate)
+
+@receiver(post_delete, sender=Exchange)
+def release_deal_counter(sender, instance, **kwargs):
+    if instance._active_in_db:
+        DealCounter.objects.release(instance._user_in_db)
+
+@receiver(post_save, sender=Exchange)
+def update_deal_index(sender, instance, created, **kwargs):
+    update_deal_indexes('deal_saved', instance)
+    if created:
+        transaction.on_commit(deals_created.inc)
+
+@receiver(post_delete, sender=Exchange)
+def remove_from_deal_index(sender, instance, **kwargs):
+    update_deal_indexes('deal_deleted', instance.pk)
+
+@receiver(post_delete, sender=ExchangeTransaction)
+def release_transaction_reservation(sender, instance, **kwargs):
+    if instance._status_in_db == 'pending' and instance.reserved:
+        Exchange.objects.release(instance._exchange_in_db, instance.reserved)
 
 @receiver(pre_save, sender=Exchange)
 def gen_exchange_uid(sender, instance, **kwargs):
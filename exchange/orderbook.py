@@ -0,0 +1,304 @@
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# A deal as returned by the book, <available> is in the fund account currency
+Deal = namedtuple('Deal', ['pk', 'uid', 'user_id', 'exchange_rate', 'available'])
+# <amount> of the deal fund account currency bought for <cost> exchange currency
+Leg = namedtuple('Leg', ['deal', 'amount', 'cost'])
+Fill = namedtuple('Fill', ['legs', 'filled', 'remaining', 'cost'])
+
+
+def leg_cost(amount, rate):
+    # Exchange currency paid for <amount>, never reserving more than <amount>
+    cost = amount * rate
+    while cost / rate > amount:
+        cost = math.nextafter(cost, 0)
+    return cost
+
+
+class Entry:
+    __slots__ = ('pk', 'uid', 'user_id', 'rate', 'created', 'amount', 'reserved')
+
+    def __init__(self, pk, uid, user_id, rate, created, amount, reserved):
+        self.pk, self.uid, self.user_id = pk, uid, user_id
+        self.rate, self.created = rate, created
+        self.amount, self.reserved = amount, reserved
+
+    @property
+    def key(self):
+        # Best price first, older deals first on the same price
+        return (self.rate, self.created, self.pk)
+
+    @property
+    def available(self):
+        return self.amount - self.reserved
+
+    def to_deal(self):
+        return Deal(self.pk, self.uid, self.user_id, self.rate, self.available)
+
+
+class PairBook:
+    """
+    Active deals of one currency pair sorted by exchange rate. The sorted keys
+    are split in blocks that remember the largest available amount they hold,
+    so a search for deals of some amount skips whole blocks instead of
+    looking at every deal
+    """
+    block_size = 256
+
+    def __init__(self, entries=()):
+        self.entries = {entry.pk: entry for entry in entries}
+        keys = sorted(entry.key for entry in self.entries.values())
+        self._blocks = [keys[i:i + self.block_size] for i in range(0, len(keys), self.block_size)]
+        self._lasts = [block[-1] for block in self._blocks]
+        self._maxes = [self._block_max(block) for block in self._blocks]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        self.discard(entry.pk)
+        self.entries[entry.pk] = entry
+        key = entry.key
+        if not self._blocks:
+            self._blocks.append([key])
+            self._lasts.append(key)
+            self._maxes.append(entry.available)
+            return
+
+        i = min(bisect_left(self._lasts, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        insort(block, key)
+        if len(block) > 2 * self.block_size:
+            half = len(block) // 2
+            self._blocks[i:i + 1] = [block[:half], block[half:]]
+            self._lasts[i:i + 1] = [block[half - 1], block[-1]]
+            self._maxes[i:i + 1] = [self._block_max(block[:half]), self._block_max(block[half:])]
+        else:
+            self._lasts[i] = block[-1]
+            self._maxes[i] = max(self._maxes[i], entry.available)
+
+    def discard(self, pk):
+        entry = self.entries.pop(pk, None)
+        if entry is None:
+            return None
+
+        key = entry.key
+        i = bisect_left(self._lasts, key)
+        block = self._blocks[i]
+        del block[bisect_left(block, key)]
+        if block:
+            self._lasts[i] = block[-1]
+            self._maxes[i] = self._block_max(block)
+        else:
+            del self._blocks[i], self._lasts[i], self._maxes[i]
+        return entry
+
+    def adjust(self, pk, amount=0, reserved=0):
+        # Moves the liquidity of a deal, the price order doesn't change
+        entry = self.entries.get(pk)
+        if entry is None:
+            return
+        entry.amount += amount
+        entry.reserved += reserved
+        i = bisect_left(self._lasts, entry.key)
+        self._maxes[i] = self._block_max(self._blocks[i])
+
+    def best(self, amount=0, limit=10, max_rate=None, exclude_user=None):
+        """
+        Cheapest deals with at least <amount> available, up to <limit> of them
+        """
+        found = []
+        for block, largest in zip(self._blocks, self._maxes):
+            if max_rate is not None and block[0][0] > max_rate:
+                break
+            if largest <= 0 or largest < amount:
+                continue
+            for rate, _, pk in block:
+                if max_rate is not None and rate > max_rate:
+                    return found
+                entry = self.entries[pk]
+                available = entry.available
+                if available > 0 and available >= amount and entry.user_id != exclude_user:
+                    found.append(entry.to_deal())
+                    if len(found) >= limit:
+                        return found
+        return found
+
+    def fill(self, amount, max_rate=None, exclude_user=None):
+        """
+        Takes <amount> from the cheapest deals, the last deal may be partially
+        used. <remaining> is what the book couldn't fill
+        """
+        legs, remaining, total = [], amount, 0.0
+        for block, largest in zip(self._blocks, self._maxes):
+            if remaining <= 0 or (max_rate is not None and block[0][0] > max_rate):
+                break
+            if largest <= 0:
+                continue
+            for rate, _, pk in block:
+                if remaining <= 0 or (max_rate is not None and rate > max_rate):
+                    break
+                entry = self.entries[pk]
+                available = entry.available
+                if available <= 0 or entry.user_id == exclude_user:
+                    continue
+                part = min(available, remaining)
+                cost = leg_cost(part, rate)
+                legs.append(Leg(entry.to_deal(), part, cost))
+                remaining -= part
+                total += cost
+        return Fill(legs, amount - max(remaining, 0), max(remaining, 0), total)
+
+    def _block_max(self, block):
+        return max(self.entries[pk].available for _, _, pk in block)
+
+
+class DealIndex:
+    """
+    Base of the process wide indexes of the active deals. They are kept
+    current by the Exchange signals and the liquidity updates of
+    ExchangeManager once their transaction commits. Changes made by other
+    workers are noticed through a counter kept in the <ORDER_BOOK_CACHE>
+    cache (checked every <ORDER_BOOK_CHECK_INTERVAL> seconds) and drop what
+    the index loaded. Indexes are only used to find deals, the deals are
+    still reserved with conditional updates when they are bought
+    """
+    version_key = None
+
+    def __init__(self):
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'ORDER_BOOK_CACHE', 'default')]
+
+    def deal_saved(self, instance):
+        raise NotImplementedError
+
+    def deal_deleted(self, pk):
+        raise NotImplementedError
+
+    def liquidity_changed(self, pk, amount=0, reserved=0):
+        raise NotImplementedError
+
+    def _check_version(self):
+        interval = getattr(settings, 'ORDER_BOOK_CHECK_INTERVAL', 1)
+        if (time.monotonic() - self._checked_at) >= interval:
+            version = self.shared.get(self.version_key, 0)
+            if version != self._version:
+                self._clear()
+                self._version = version
+            self._checked_at = time.monotonic()
+
+    def _changed(self):
+        # Count the change for the other workers, if the counter moved more
+        # than once they changed deals too and the local index is stale
+        try:
+            version = self.shared.incr(self.version_key)
+        except ValueError:
+            self.shared.add(self.version_key, 0, None)
+            version = self.shared.incr(self.version_key)
+        if self._version is None or version != self._version + 1:
+            self._clear()
+        self._version = version
+
+    def _clear(self):
+        raise NotImplementedError
+
+
+class OrderBook(DealIndex):
+    """
+    Books of the active deals per (fund account currency, exchange currency)
+    pair, a pair is loaded from the database the first time it is asked for
+    """
+    version_key = 'exchange:order_book_version'
+
+    def __init__(self):
+        super().__init__()
+        self._books = {}
+        # Deal pk -> pair of the loaded books
+        self._pairs = {}
+        self.loads = 0
+
+    def best(self, pair, amount=0, limit=10, max_rate=None, exclude_user=None):
+        with self._lock:
+            return self._get_book(pair).best(amount, limit, max_rate, exclude_user)
+
+    def fill(self, pair, amount, max_rate=None, exclude_user=None):
+        with self._lock:
+            return self._get_book(pair).fill(amount, max_rate, exclude_user)
+
+    def deal_saved(self, instance):
+        pair = (instance.fund_account_currency_id, instance.exchange_currency_id)
+        with self._lock:
+            # Saving a deal doesn't write its reserved amount, keep the known one
+            old = self._pop(instance.pk)
+            book = self._books.get(pair)
+            if book is not None and instance.active:
+                reserved = old.reserved if old is not None else instance.reserved
+                book.add(Entry(
+                    instance.pk, instance.uid, instance.user_id, instance.exchange_rate,
+                    instance.created, instance.amount, reserved))
+                self._pairs[instance.pk] = pair
+            self._changed()
+
+    def deal_deleted(self, pk):
+        with self._lock:
+            self._pop(pk)
+            self._changed()
+
+    def liquidity_changed(self, pk, amount=0, reserved=0):
+        with self._lock:
+            pair = self._pairs.get(pk)
+            if pair is not None:
+                self._books[pair].adjust(pk, amount, reserved)
+            self._changed()
+
+    def reset(self, pairs=None):
+        # Drops the books of <pairs> (all of them by default), they reload when needed
+        with self._lock:
+            for pair in (list(self._books) if pairs is None else pairs):
+                book = self._books.pop(pair, None)
+                if book is not None:
+                    for pk in book.entries:
+                        self._pairs.pop(pk, None)
+            self._changed()
+
+    def load(self, pair):
+        from .models import Exchange
+
+        rows = (
+            Exchange.objects.filter(active=True, fund_account_currency_id=pair[0], exchange_currency_id=pair[1])
+            .order_by().values_list('pk', 'uid', 'user_id', 'exchange_rate', 'created', 'amount', 'reserved')
+        )
+        book = PairBook(Entry(*row) for row in rows)
+        self._books[pair] = book
+        self._pairs.update((pk, pair) for pk in book.entries)
+        self.loads += 1
+        return book
+
+    def _get_book(self, pair):
+        self._check_version()
+        book = self._books.get(pair)
+        return book if book is not None else self.load(pair)
+
+    def _pop(self, pk):
+        pair = self._pairs.pop(pk, None)
+        return self._books[pair].discard(pk) if pair is not None else None
+
+    def _clear(self):
+        self._books.clear()
+        self._pairs.clear()
+
+
+order_book = OrderBook()
@@ -0,0 +1,86 @@
+import math
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from .registry import currency_registry
+from .utils import normalize_symbol
+
+
+class CrossRateMatrix:
+    """
+    N x N cross rates of every currency in the registry, rates[a][b] is how
+    many <b> for one <a> (value_b / value_a since values are per dollar).
+    The matrix is computed in one pass and kept until the registry reloads,
+    which happens whenever a Currency is saved or deleted.
+    """
+    def __init__(self, currencies):
+        self.symbols = [currency.symbol for currency in currencies]
+        self.index = {normalize_symbol(symbol): i for i, symbol in enumerate(self.symbols)}
+        values = [currency.value for currency in currencies]
+
+        if np is not None:
+            values = np.asarray(values, dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rates = values[np.newaxis, :] / values[:, np.newaxis]
+            # Currencies without a value have no rate
+            rates[~np.isfinite(rates)] = np.nan
+            self.rates = rates
+        else:
+            self.rates = [[(b / a) if a else math.nan for b in values] for a in values]
+
+    def to_list(self, symbols=None):
+        """Returns (symbols, rates) with None for missing rates"""
+        if symbols is None:
+            indexes = list(range(len(self.symbols)))
+        else:
+            indexes = [self.index[normalize_symbol(symbol)] for symbol in symbols]
+
+        if np is not None:
+            rates = self.rates[np.ix_(indexes, indexes)]
+            rows = np.where(np.isnan(rates), None, rates).tolist()
+        else:
+            rows = [[self.rates[a][b] for b in indexes] for a in indexes]
+            rows = [[None if math.isnan(rate) else rate for rate in row] for row in rows]
+        return [self.symbols[i] for i in indexes], rows
+
+    def convert(self, sources, targets, amounts):
+        """
+        Converts amounts[i] of sources[i] to targets[i], all symbols must be
+        known. Missing rates convert to None
+        """
+        source = [self.index[normalize_symbol(symbol)] for symbol in sources]
+        target = [self.index[normalize_symbol(symbol)] for symbol in targets]
+
+        if np is not None:
+            # Huge amounts overflow to inf, rejected by the view
+            with np.errstate(over='ignore'):
+                converted = np.asarray(amounts, dtype=float) * self.rates[source, target]
+            return np.where(np.isnan(converted), None, converted).tolist()
+
+        converted = [amount * self.rates[a][b] for amount, a, b in zip(amounts, source, target)]
+        return [None if math.isnan(value) else value for value in converted]
+
+    def unknown(self, symbols):
+        return sorted({symbol for symbol in symbols if normalize_symbol(symbol) not in self.index})
+
+
+class CrossRates:
+    # Keeps the matrix of the currently loaded registry
+    def __init__(self):
+        self._matrix = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        token, currencies = currency_registry.snapshot()
+        with self._lock:
+            if self._matrix is None or token is not self._token:
+                self._matrix, self._token = CrossRateMatrix(currencies), token
+            return self._matrix
+
+
+cross_rates = CrossRates()
@@ -0,0 +1,171 @@
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .utils import normalize_symbol
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    """
+    Trigrams of the case folded currency names, a name search of 3 chars or
+    more only compares the currencies having every trigram of the term
+    """
+    def __init__(self, currencies):
+        self.names = {currency.pk: currency.name.casefold() for currency in currencies}
+        self.trigrams = {}
+        for pk, name in self.names.items():
+            for gram in trigrams(name):
+                self.trigrams.setdefault(gram, set()).add(pk)
+
+    def matches(self, term):
+        # pks of the names containing <term>
+        term = term.casefold()
+        grams = trigrams(term)
+        if not grams:
+            return {pk for pk, name in self.names.items() if term in name}
+
+        candidates = sorted((self.trigrams.get(gram, set()) for gram in grams), key=len)
+        return {pk for pk in set.intersection(*candidates) if term in self.names[pk]}
+
+
+class CurrencyRegistry:
+    """
+    Process wide view of the Currency table indexed by id and by case folded
+    symbol. It is loaded once and reloaded after Currency saves/deletes, other
+    workers notice those changes through a version stamp kept in the
+    <CURRENCY_REGISTRY_CACHE> cache (checked every
+    <CURRENCY_REGISTRY_CHECK_INTERVAL> seconds). Symbols are upper case and
+    names are searched through a trigram index. The currencies it returns are
+    shared between requests and must not be modified.
+    """
+    version_key = 'exchange:currency_registry_version'
+
+    def __init__(self):
+        # (by id, by symbol, ordered by name, name index), swapped as a whole on reload
+        self._state = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # State given to <using>, lookups in that context are served from it
+        self._pinned = contextvars.ContextVar('currency_registry_state', default=None)
+        self.hits = 0
+        self.loads = 0
+
+    @property
+    def shared(self):
+        return caches[getattr(settings, 'CURRENCY_REGISTRY_CACHE', 'default')]
+
+    @property
+    def version(self):
+        self._get_state()
+        return self._version
+
+    def get(self, pk):
+        return self._get_state()[0].get(pk)
+
+    def get_by_symbol(self, symbol):
+        return self._get_state()[1].get(normalize_symbol(symbol))
+
+    def all(self):
+        # Currencies ordered by name
+        return list(self._get_state()[2])
+
+    def snapshot(self):
+        """
+        Returns (token, currencies), the token is a new object on every reload
+        so caches derived from the currencies can check they are current
+        """
+        state = self._get_state()
+        return state, list(state[2])
+
+    def search(self, name='', symbol=''):
+        # Same results as name__icontains/symbol__icontains
+        state = self._get_state()
+        currencies = state[2]
+        if name:
+            matches = state[3].matches(name)
+            currencies = [currency for currency in currencies if currency.pk in matches]
+        if symbol:
+            symbol = symbol.upper()
+            currencies = [currency for currency in currencies if symbol in currency.symbol]
+        return list(currencies)
+
+    def load(self, version=None):
+        from .models import Currency
+
+        currencies = list(Currency.objects.order_by('name'))
+        state = (
+            {currency.pk: currency for currency in currencies},
+            {normalize_symbol(currency.symbol): currency for currency in currencies},
+            currencies,
+            NameIndex(currencies),
+        )
+        with self._lock:
+            self._state = state
+            self._version = version
+            self._checked_at = time.monotonic()
+            self.loads += 1
+        return state
+
+    def invalidate(self):
+        # Drop the local copy and tell the other workers to reload theirs
+        self.shared.set(self.version_key, uuid.uuid4().hex, None)
+        self._state = None
+
+    async def refresh(self):
+        """
+        For async views, returns the current state to serve a request from
+        with <using>. The version check and the reload run in a thread, only
+        when they are due
+        """
+        state = self._fresh_state()
+        if state is None:
+            state = await sync_to_async(self._get_state)()
+        return state
+
+    @contextmanager
+    def using(self, state):
+        """
+        Serves the lookups made in this context (this task or thread) from
+        <state>, without version checks nor reloads, even if the registry is
+        invalidated meanwhile
+        """
+        token = self._pinned.set(state)
+        try:
+            yield
+        finally:
+            self._pinned.reset(token)
+
+    def _fresh_state(self):
+        state = self._state
+        interval = getattr(settings, 'CURRENCY_REGISTRY_CHECK_INTERVAL', 1)
+        if state is not None and (time.monotonic() - self._checked_at) < interval:
+            return state
+        return None
+
+    def _get_state(self):
+        state = self._pinned.get() or self._fresh_state()
+        if state is not None:
+            self.hits += 1
+            return state
+
+        state = self._state
+        version = self.shared.get(self.version_key)
+        if state is None or version != self._version:
+            return self.load(version)
+        self._checked_at = time.monotonic()
+        self.hits += 1
+        return state
+
+
+currency_registry = CurrencyRegistry()
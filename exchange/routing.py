@@ -0,0 +1,215 @@
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.conf import settings
+
+from authentication.cache import LRUCache
+
+from .orderbook import DealIndex
+
+
+# <amount> of the source currency paid to <deal> for <received> of the target
+Hop = namedtuple('Hop', ['deal', 'source', 'target', 'exchange_rate', 'amount', 'received'])
+Route = namedtuple('Route', ['hops', 'amount', 'received'])
+
+
+class PairDeals:
+    """
+    Deals selling one currency for another. Only the deals that are cheaper
+    than every deal with more capacity are worth using, those are kept by
+    increasing rate and capacity so the cheapest deal able to take an amount
+    is a bisect away
+    """
+    def __init__(self):
+        # pk -> [uid, rate, amount, reserved]
+        self.deals = {}
+        self.capacities = []
+        self.frontier = []
+
+    def refresh(self):
+        capacities, frontier = [], []
+        for pk, (uid, rate, amount, reserved) in sorted(self.deals.items(), key=lambda i: (i[1][1], i[0])):
+            # Capacity is in the currency paid to the deal
+            capacity = (amount - reserved) * rate
+            if capacity > 0 and (not capacities or capacity > capacities[-1]):
+                capacities.append(capacity)
+                frontier.append((pk, uid, rate))
+        self.capacities, self.frontier = capacities, frontier
+
+    def best(self, amount=None):
+        # Cheapest deal able to take <amount>, any deal with liquidity without one
+        i = bisect_left(self.capacities, amount) if amount is not None else 0
+        return self.frontier[i] if i < len(self.frontier) else None
+
+
+class RouteGraph(DealIndex):
+    """
+    Active deals as a graph of currencies, a deal is an edge from its
+    exchange currency to its fund account currency. Routes are the paths with
+    the most received for an amount (the shortest paths on -log(rate)),
+    found with a Bellman-Ford limited to <hops> rounds. Found routes are
+    cached until a deal on them changes, saved deals drop all of them since
+    they may open better routes
+    """
+    version_key = 'exchange:route_graph_version'
+
+    def __init__(self):
+        super().__init__()
+        self._graph = None
+        # Deal pk -> (source, target) of the loaded graph
+        self._edges = {}
+        self._routes = LRUCache(maxsize=getattr(settings, 'EXCHANGE_ROUTE_CACHE_SIZE', 1024))
+        # Deal pk -> keys of the cached routes using it
+        self._route_keys = {}
+        self.loads = 0
+
+    def find(self, source, target, amount=None, hops=3):
+        """
+        Best route from the <source> to the <target> currency id, paying
+        <amount> of the source currency. Without an amount only the rates
+        count and the deal liquidity is ignored. None when there is no route
+        """
+        key = (source, target, amount, hops)
+        with self._lock:
+            self._check_version()
+            route = self._routes.get(key)
+            if route is not None:
+                return route
+
+            route = self._search(self._get_graph(), source, target, amount, hops)
+            if route is not None:
+                self._routes.set(key, route)
+                for hop in route.hops:
+                    self._route_keys.setdefault(hop.deal[0], set()).add(key)
+            return route
+
+    def deal_saved(self, instance):
+        with self._lock:
+            # Saving a deal doesn't write its reserved amount, keep the known one
+            old = self._remove(instance.pk)
+            if self._graph is not None and instance.active:
+                reserved = old[3] if old is not None else instance.reserved
+                edge = (instance.exchange_currency_id, instance.fund_account_currency_id)
+                pair = self._graph.setdefault(edge[0], {}).setdefault(edge[1], PairDeals())
+                pair.deals[instance.pk] = [instance.uid, instance.exchange_rate, instance.amount, reserved]
+                pair.refresh()
+                self._edges[instance.pk] = edge
+            self._routes.clear()
+            self._route_keys.clear()
+            self._changed()
+
+    def deal_deleted(self, pk):
+        with self._lock:
+            self._remove(pk)
+            self._drop_routes(pk)
+            self._changed()
+
+    def liquidity_changed(self, pk, amount=0, reserved=0):
+        with self._lock:
+            edge = self._edges.get(pk)
+            if edge is not None:
+                pair = self._graph[edge[0]][edge[1]]
+                pair.deals[pk][2] += amount
+                pair.deals[pk][3] += reserved
+                pair.refresh()
+            self._drop_routes(pk)
+            self._changed()
+
+    def reset(self, pairs=None):
+        # Drops the graph, <pairs> is accepted like OrderBook.reset
+        with self._lock:
+            self._clear()
+            self._changed()
+
+    def load(self):
+        from .models import Exchange
+
+        rows = (
+            Exchange.objects.filter(active=True).order_by()
+            .values_list('pk', 'uid', 'exchange_currency_id', 'fund_account_currency_id', 'exchange_rate', 'amount', 'reserved')
+        )
+        graph, edges = {}, {}
+        for pk, uid, source, target, rate, amount, reserved in rows:
+            graph.setdefault(source, {}).setdefault(target, PairDeals()).deals[pk] = [uid, rate, amount, reserved]
+            edges[pk] = (source, target)
+        for pairs in graph.values():
+            for pair in pairs.values():
+                pair.refresh()
+
+        self._graph, self._edges = graph, edges
+        self.loads += 1
+        return graph
+
+    def _search(self, graph, source, target, amount, hops):
+        """
+        Paths are (received, currencies on the path, hops), the paths of a
+        round are extended in the next one. Without an amount only the best
+        path to a currency is worth extending. With one a bigger amount can
+        be more than the next deals can take, so every path is extended and
+        through every deal able to take its amount (the pricier ones leave
+        less for the next hops). Routes are at most a few hops so that stays
+        small, paths reaching the target go no further
+        """
+        start = (amount if amount is not None else 1.0, (source,), ())
+        best = {source: start}
+        paths = [start]
+        for i in range(hops):
+            extended = {} if amount is None else []
+            last = i == hops - 1
+            for value, nodes, path in paths:
+                node = nodes[-1]
+                for neighbour, pair in graph.get(node, {}).items():
+                    # Same as pair.best(), inlined as it runs for every edge
+                    frontier_deals = pair.frontier
+                    if not frontier_deals or neighbour in nodes or (last and neighbour != target):
+                        continue
+                    if amount is None:
+                        deals = frontier_deals[:1]
+                    else:
+                        deals = frontier_deals[bisect_left(pair.capacities, value):]
+                    for deal in deals:
+                        received = value / deal[2]
+                        if amount is None and received <= best.get(neighbour, (0,))[0]:
+                            continue
+                        found = (received, nodes + (neighbour,), path + (Hop(deal[:2], node, neighbour, deal[2], value, received),))
+                        if received > best.get(neighbour, (0,))[0]:
+                            best[neighbour] = found
+                        if neighbour == target:
+                            continue
+                        if amount is None:
+                            extended[neighbour] = found
+                        else:
+                            extended.append(found)
+            paths = list(extended.values()) if amount is None else extended
+            if not paths:
+                break
+
+        if target == source or target not in best:
+            return None
+        received, _, path = best[target]
+        return Route(path, path[0].amount, received)
+
+    def _get_graph(self):
+        return self._graph if self._graph is not None else self.load()
+
+    def _remove(self, pk):
+        edge = self._edges.pop(pk, None)
+        if edge is not None:
+            pair = self._graph[edge[0]][edge[1]]
+            deal = pair.deals.pop(pk)
+            pair.refresh()
+            return deal
+        return None
+
+    def _drop_routes(self, pk):
+        for key in self._route_keys.pop(pk, ()):
+            self._routes.pop(key)
+
+    def _clear(self):
+        self._graph = None
+        self._edges = {}
+        self._routes.clear()
+        self._route_keys.clear()
+
+
+route_graph = RouteGraph()
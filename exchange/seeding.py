@@ -0,0 +1,286 @@
+"""
+Synthetic data at production volumes for local benchmarks and profiling.
+
+Rows are written with plain batched INSERTs of prepared values, no model
+instances are made and no signals are sent, so what the signals and save
+methods keep up (profiles, uids, deal counters, reservations, the deal
+indexes and the currency registry) is written or reset here instead.
+"""
+import math
+import random
+import time
+from bisect import bisect
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.utils import timezone
+
+from authentication.models import Profile, User
+
+from .models import Currency, DealCounter, Exchange, ExchangeTransaction, update_deal_indexes
+from .registry import currency_registry
+from .utils import uid_generator
+
+EMAIL_DOMAIN = 'seed.xcrowme.com'
+PASSWORD = 'Seed-pass-2021'
+
+# symbol, name, value per dollar, share of the deals
+CURRENCIES = [
+    ('USD', 'US Dollar', 1.0, 30),
+    ('NGN', 'Nigerian Naira', 411.0, 25),
+    ('EUR', 'Euro', 0.85, 10),
+    ('GBP', 'British Pound', 0.73, 8),
+    ('GHS', 'Ghanaian Cedi', 5.9, 5),
+    ('KES', 'Kenyan Shilling', 108.0, 4),
+    ('ZAR', 'South African Rand', 14.6, 4),
+    ('CAD', 'Canadian Dollar', 1.26, 3),
+    ('XOF', 'West African CFA Franc', 557.0, 3),
+    ('EGP', 'Egyptian Pound', 15.7, 2),
+    ('INR', 'Indian Rupee', 74.3, 2),
+    ('CNY', 'Chinese Yuan', 6.46, 2),
+    ('JPY', 'Japanese Yen', 110.0, 1),
+    ('AED', 'UAE Dirham', 3.67, 1),
+]
+
+# share of the transactions per status
+STATUSES = (('completed', 80), ('cancelled', 15), ('pending', 5))
+# share of the completed transactions per rating
+RATINGS = ((True, 60), (False, 15), (None, 25))
+
+
+def insert_rows(model, fields, rows, batch_size=10000):
+    """
+    Inserts the tuples of <rows> (values of <fields>, ready for the
+    database) in batches of one executemany each
+    """
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(name).column) for name in fields)
+    sql = f'INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({", ".join(["%s"] * len(fields))})'
+    count = 0
+    with connection.cursor() as cursor:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                cursor.executemany(sql, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+            count += len(batch)
+    return count
+
+
+@contextmanager
+def deferred_indexes(model):
+    """
+    Drops the plain indexes of <model> while rows are inserted and builds
+    them once at the end, a lot faster than updating them for every row.
+    Unique indexes are kept. Use it inside a transaction
+    """
+    editor = connection.schema_editor()
+    table = model._meta.db_table
+    statements = [(index.create_sql(model, editor), index.remove_sql(model, editor)) for index in model._meta.indexes]
+    for field in model._meta.local_fields:
+        if field.db_index and not field.unique:
+            name = editor._create_index_name(table, [field.column])
+            statements.append((editor._create_index_sql(model, fields=[field]), editor._delete_index_sql(model, name)))
+
+    for _, remove in statements:
+        editor.execute(remove)
+    yield
+    for create, _ in statements:
+        editor.execute(create)
+
+
+def new_pks(model, last):
+    # Pks of the rows inserted after <last>, in insertion order
+    return list(model.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True))
+
+
+def last_pk(model):
+    return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def weighted_choice(rng, items, weights):
+    # Picks items by weight, cheaper than rng.choices for one item at a time
+    cum_weights = list(accumulate(weights))
+    total, last, random_ = cum_weights[-1], len(cum_weights) - 1, rng.random
+    return lambda: items[bisect(cum_weights, random_() * total, 0, last)]
+
+
+def pareto_weights(rng, count, alpha=1.2):
+    # A few rows get most of the activity
+    return [rng.paretovariate(alpha) for _ in range(count)]
+
+
+class Seeder:
+    """
+    Seeds <users> users (with their profiles), the <CURRENCIES>, <deals>
+    deals and <transactions> transactions. Activity follows a Pareto law over
+    the users and deals, deal amounts and transaction values are log-normal
+    and creation times lean towards the last <days> days
+    """
+    def __init__(self, users, deals, transactions, days=365, seed=None, batch_size=10000, password=PASSWORD, log=None):
+        self.users = users
+        self.deals = deals
+        self.transactions = transactions
+        self.days = days
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.password = password
+        self.log = log or (lambda message: None)
+        self.now = timezone.now()
+        self.adapt = connection.ops.adapt_datetimefield_value
+
+    def run(self):
+        with transaction.atomic():
+            user_ids = self.timed('users', self.seed_users)
+            currencies = self.timed('currencies', self.seed_currencies)
+            deals = self.timed('deals', self.seed_deals, user_ids, currencies)
+            self.timed('transactions', self.seed_transactions, user_ids, deals)
+            # Caches of what was written behind the signals
+            update_deal_indexes('reset')
+            transaction.on_commit(currency_registry.invalidate)
+
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        count = len(result) if isinstance(result, (list, dict)) else result
+        self.log(f'{name}: {count} rows in {time.perf_counter() - start:.1f} s')
+        return result
+
+    def created(self, start=None):
+        # Recent times are more likely, never before <start>
+        span = self.days * 86400
+        if start is not None:
+            span = min(span, max((self.now - start).total_seconds(), 0))
+        return self.now - timedelta(seconds=span * self.rng.random() ** 2)
+
+    def uids(self):
+        while True:
+            yield from uid_generator.many(self.batch_size)
+
+    def seed_users(self):
+        rng, last = self.rng, last_pk(User)
+        # Hashing once keeps seeding fast, every user has the same password
+        password = make_password(self.password)
+        rows = (
+            (
+                f'user{last + i + 1}@{EMAIL_DOMAIN}', f'first{rng.randrange(10 ** 6)}', f'last{rng.randrange(10 ** 6)}',
+                password, True, False, False, '1', self.adapt(self.created()),
+                False, False, False, rng.random() < 0.9,
+            ) for i in range(self.users)
+        )
+        insert_rows(User, (
+            'email', 'first_name', 'last_name', 'password', 'active', 'staff', 'admin', 'level', 'start_date',
+            'confirmed_phoneno', 'confirmed_id', 'confirmed_address', 'confirmed_email',
+        ), rows, self.batch_size)
+
+        user_ids = new_pks(User, last)
+        # Usernames made by the create_profile signal start with "user"
+        insert_rows(Profile, (
+            'username', 'gender', 'user', 'image', 'id_photo', 'photo', 'address', 'bank_statement', 'country', 'state',
+        ), ((f'seed{pk}', '0', pk, '', '', '', '', '', '', '') for pk in user_ids), self.batch_size)
+        return user_ids
+
+    def seed_currencies(self):
+        existing = set(Currency.objects.values_list('symbol', flat=True))
+        insert_rows(Currency, ('symbol', 'name', 'value'), (
+            (symbol, name, value) for symbol, name, value, _ in CURRENCIES if symbol not in existing
+        ))
+        stored = {
+            symbol: (pk, value) for symbol, pk, value in
+            Currency.objects.filter(symbol__in=[i[0] for i in CURRENCIES]).values_list('symbol', 'pk', 'value')
+        }
+        # id -> (value, share), existing currencies keep their value
+        return {stored[symbol][0]: (stored[symbol][1], share) for symbol, _, _, share in CURRENCIES}
+
+    def seed_deals(self, user_ids, currencies):
+        rng, last = self.rng, last_pk(Exchange)
+        seller = weighted_choice(rng, user_ids, pareto_weights(rng, len(user_ids)))
+        currency_ids = list(currencies)
+        currency = weighted_choice(rng, currency_ids, [currencies[pk][1] for pk in currency_ids])
+        minimum, limit = settings.EXCHANGE_MINIMUM, settings.EXCHANGE_DEALS_LIMIT
+
+        deals, counts = [], {}
+        for _ in range(self.deals):
+            fund, exchange = currency(), currency()
+            while exchange == fund:
+                exchange = currency()
+            fund_value, exchange_value = currencies[fund][0], currencies[exchange][0]
+            # Amount in dollars above the minimum, rates around the cross rate
+            amount = minimum * (1 + rng.lognormvariate(0, 1)) * fund_value
+            rate = exchange_value / fund_value * rng.normalvariate(1.02, 0.02)
+            user = seller()
+            # Busy sellers keep their older deals inactive
+            active = rng.random() < 0.8 and counts.get(user, 0) < limit
+            if active:
+                counts[user] = counts.get(user, 0) + 1
+            deals.append([user, fund, exchange, amount, rate, self.created(), active, fund_value])
+
+        with deferred_indexes(Exchange):
+            insert_rows(Exchange, (
+                'user', 'fund_account_name', 'fund_account_bank', 'fund_account_currency', 'exchange_currency',
+                'amount', 'reserved', 'exchange_rate', 'exchange_address', 'created', 'active', 'uid',
+            ), (
+                (user, 'Seed Account', 'Seed Bank', fund, exchange, amount, 0, rate, '', self.adapt(created), active, uid)
+                for (user, fund, exchange, amount, rate, created, active, _), uid in zip(deals, self.uids())
+            ), self.batch_size)
+
+        # Seeded users have no counters yet
+        insert_rows(DealCounter, ('user', 'active'), counts.items(), self.batch_size)
+
+        for pk, deal in zip(new_pks(Exchange, last), deals):
+            deal.insert(0, pk)
+        # [pk, user, fund, exchange, amount, rate, created, active, fund value]
+        return deals
+
+    def seed_transactions(self, user_ids, deals):
+        rng, uids = self.rng, self.uids()
+        deal = weighted_choice(rng, deals, pareto_weights(rng, len(deals)))
+        buyer_ids = weighted_choice(rng, user_ids, pareto_weights(rng, len(user_ids)))
+        status_choice = weighted_choice(rng, *zip(*STATUSES))
+        rating = weighted_choice(rng, *zip(*RATINGS))
+        reserved = {}
+
+        def rows():
+            for _ in range(self.transactions):
+                pk, seller, _, _, amount, rate, created, active, fund_value = deal()
+                buyer = buyer_ids()
+                while buyer == seller:
+                    buyer = buyer_ids()
+                status = status_choice()
+                # Deal currency bought, worth a few hundred dollars
+                needed = fund_value * rng.lognormvariate(math.log(300), 1)
+                held = 0
+                if status == 'pending':
+                    total = reserved.get(pk, 0) + needed
+                    if active and total <= amount:
+                        reserved[pk], held = total, needed
+                    else:
+                        # The deal can't hold it, it was cancelled
+                        status = 'cancelled'
+                thumbs_up = rating() if status == 'completed' else None
+                yield (
+                    buyer, pk, needed * rate, status, thumbs_up,
+                    self.adapt(self.created(created)), held, next(uids),
+                )
+
+        with deferred_indexes(ExchangeTransaction):
+            count = insert_rows(ExchangeTransaction, (
+                'user', 'exchange', 'amount', 'status', 'thumbs_up', 'created', 'reserved', 'uid',
+            ), rows(), self.batch_size)
+
+        # Liquidity held by the pending transactions
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'UPDATE {quote(Exchange._meta.db_table)} SET {quote("reserved")} = %s WHERE {quote("id")} = %s',
+                [(held, pk) for pk, held in reserved.items()],
+            )
+        return count
@@ -1,3 +1,490 @@
-from django.test import TestCase
+from io import StringIO
+from random import Random
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import F, Sum
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework import serializers
+
+from authentication.models import Profile, User
+
+from .api.serializers import ExchangeTransactionSerializer
+from .models import Currency, DealCounter, Exchange, ExchangeTransaction
+from .orderbook import Entry, PairBook
+from .registry import currency_registry
+from .routing import PairDeals, RouteGraph
+from .seeding import PASSWORD
+from .utils import UIDGenerator
+
+
+class CurrencyRegistryTests(TestCase):
+    def setUp(self):
+        self.naira = Currency.objects.create(name='Nigerian Naira', symbol='NGN', value=455)
+        self.dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+
+    def test_lookups(self):
+        self.assertEqual(currency_registry.get(self.naira.pk).symbol, 'NGN')
+        self.assertEqual(currency_registry.get_by_symbol('usd').pk, self.dollar.pk)
+        self.assertIsNone(currency_registry.get_by_symbol('YEN'))
+        self.assertEqual([i.symbol for i in currency_registry.search(name='dollar')], ['USD'])
+
+        # Loaded lookups do not query the database
+        with self.assertNumQueries(0):
+            currency_registry.get_by_symbol('NGN')
+            currency_registry.all()
+
+    def test_reload_on_save_and_delete(self):
+        currency_registry.all()
+        self.dollar.value = 2
+        self.dollar.save()
+        self.assertEqual(currency_registry.get(self.dollar.pk).value, 2)
+
+        Currency.objects.create(name='Chinese Yen', symbol='YEN', value=126.56)
+        self.assertIsNotNone(currency_registry.get_by_symbol('yen'))
+
+        self.naira.delete()
+        self.assertIsNone(currency_registry.get_by_symbol('NGN'))
+
+    def test_symbols_are_upper_case(self):
+        yen = Currency.objects.create(name='Chinese Yen', symbol='yen', value=126.56)
+        self.assertEqual(Currency.objects.get(pk=yen.pk).symbol, 'YEN')
+        self.assertEqual(currency_registry.get_by_symbol(' Yen').pk, yen.pk)
+
+        # The unique check of forms sees the normalized symbol
+        with self.assertRaises(ValidationError):
+            Currency(name='US Dollar', symbol='usd', value=1).full_clean()
+
+    def test_search(self):
+        Currency.objects.create(name='Chinese Yen', symbol='YEN', value=126.56)
+        Currency.objects.create(name='Naira (old)', symbol='NGO', value=455)
+        currencies = Currency.objects.order_by('name')
+        for name, symbol in [('', ''), ('naira', ''), ('NAI', ''), ('ir', ''), ('a (', ''), ('xyz', ''), ('', 'n'), ('e', 'ng')]:
+            expected = [i.pk for i in currencies.filter(name__icontains=name, symbol__icontains=symbol)]
+            self.assertEqual([i.pk for i in currency_registry.search(name=name, symbol=symbol)], expected, (name, symbol))
+
+    @override_settings(CURRENCY_REGISTRY_CHECK_INTERVAL=0)
+    def test_reload_on_version_change(self):
+        currency_registry.all()
+
+        # Another worker changed a currency and bumped the version stamp
+        Currency.objects.filter(pk=self.dollar.pk).update(value=3)
+        self.assertEqual(currency_registry.get(self.dollar.pk).value, 1)
+        currency_registry.shared.set(currency_registry.version_key, 'other-worker', None)
+        self.assertEqual(currency_registry.get(self.dollar.pk).value, 3)
+
+
+class UIDGeneratorTests(TestCase):
+    def test_unique_and_ordered(self):
+        generator = UIDGenerator()
+        uids = [generator() for _ in range(10000)] + generator.many(10000)
+        self.assertEqual(len(set(uids)), len(uids))
+        self.assertEqual(uids, sorted(uids))
+        self.assertTrue(all(len(uid) == 16 for uid in uids))
+
+    def test_nodes_do_not_collide(self):
+        with override_settings(UID_NODE_ID=1):
+            first = UIDGenerator()
+            first_uids = {first() for _ in range(1000)}
+        with override_settings(UID_NODE_ID=2):
+            second = UIDGenerator()
+            second_uids = {second() for _ in range(1000)}
+        self.assertFalse(first_uids & second_uids)
+
+    @mock.patch('exchange.utils.PROCESS_LOCAL_CACHES', ())
+    def test_workers_lease_their_own_node(self):
+        generator = UIDGenerator()
+        cache = generator.cache
+        cache.set(generator.counter_key, 41, None)
+        # Node 43 is still held by a worker started long ago
+        cache.set(generator.lease_key.format(43), 'old-worker', None)
+
+        nodes = []
+        for pid in (1001, 1002):
+            # A forked worker
+            with mock.patch('exchange.utils.os.getpid', return_value=pid):
+                generator()
+            nodes.append(generator._node)
+        self.assertEqual(nodes, [42, 44])
+
+        # The lease is renewed, or replaced once another worker took it
+        key = generator.lease_key.format(44)
+        generator._lease = generator._lease[:2] + (0,)
+        with mock.patch('exchange.utils.os.getpid', return_value=1002):
+            generator()
+            self.assertEqual(generator._node, 44)
+            cache.set(key, 'other-worker', None)
+            generator._lease = generator._lease[:2] + (0,)
+            generator()
+        self.assertEqual(generator._node, 45)
+
+        # A node given by the process manager wins
+        with mock.patch.dict('exchange.utils.os.environ', {'UID_NODE_ID': '7'}), mock.patch('exchange.utils.os.getpid', return_value=1003):
+            generator()
+        self.assertEqual((generator._node, generator._lease), (7, None))
+
+    def test_random_node_without_a_shared_cache(self):
+        generator = UIDGenerator()
+        with mock.patch('exchange.utils.secrets.randbelow', return_value=9), mock.patch('exchange.utils.os.getpid', return_value=1001):
+            generator()
+        self.assertEqual((generator._node, generator._lease), (9, None))
+        self.assertIsNone(generator.cache.get(generator.counter_key))
+
+    def test_taken_uids_are_replaced(self):
+        # Two workers on the same random node
+        user = User.objects.create_user(email='netrobeweb@gmail.com', first_name='netro', last_name='webby', password='randopass')
+        dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+        fields = dict(
+            user=user, fund_account_currency=dollar, exchange_currency=dollar,
+            fund_account_name='netro', fund_account_bank='bank', amount=100000, exchange_rate=1, active=False,
+        )
+        taken = Exchange.objects.create(**fields).uid
+        deal = Exchange(uid=taken, **fields)
+        deal.save()
+        self.assertNotEqual(deal.uid, taken)
+        deals = Exchange.objects.bulk_create([Exchange(uid=taken, **fields), Exchange(**fields)])
+        self.assertNotEqual(deals[0].uid, taken)
+        self.assertEqual(Exchange.objects.values('uid').distinct().count(), 4)
+
+    def test_sequence_overflow_and_clock_going_back(self):
+        generator = UIDGenerator()
+        generator()
+        generator._last += 10
+        generator._sequence = (1 << generator.sequence_bits) - 1
+        uids = [generator() for _ in range(3)]
+        self.assertEqual(uids, sorted(uids))
+        self.assertEqual(len(set(uids)), 3)
+
+    def test_bulk_create_gets_uids(self):
+        user = User.objects.create_user(email='netrobeweb@gmail.com', first_name='netro', last_name='webby', password='randopass')
+        dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+        Exchange.objects.bulk_create([
+            Exchange(
+                user=user, fund_account_currency=dollar, exchange_currency=dollar,
+                fund_account_name='My New Account', fund_account_bank='UBA',
+                amount=60000.0, exchange_rate=1.0)
+            for _ in range(50)
+        ])
+        uids = list(Exchange.objects.values_list('uid', flat=True))
+        self.assertEqual(len(set(uids)), 50)
+        self.assertNotIn('', uids)
+
+
+class DealCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='netrobeweb@gmail.com', first_name='netro', last_name='webby', password='randopass')
+        self.user2 = User.objects.create_user(email='sketcherslodge@gmail.com', first_name='john', last_name='doe', password='newrandopass')
+        self.dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+
+    def create_deal(self, user, **kwargs):
+        return Exchange.objects.create(
+            user=user, fund_account_currency=self.dollar, exchange_currency=self.dollar,
+            fund_account_name='My New Account', fund_account_bank='UBA',
+            amount=60000.0, exchange_rate=1.0, **kwargs)
+
+    def count(self, user):
+        return DealCounter.objects.get_count(user.pk)
+
+    def test_counter_follows_deals(self):
+        deal = self.create_deal(self.user)
+        self.create_deal(self.user, active=False)
+        self.assertEqual(self.count(self.user), 1)
+
+        # Deactivate and activate again, from a fresh instance
+        deal = Exchange.objects.get(pk=deal.pk)
+        deal.active = False
+        deal.save()
+        self.assertEqual(self.count(self.user), 0)
+        deal.active = True
+        deal.save()
+        self.assertEqual(self.count(self.user), 1)
+
+        # Saving without changes keeps the counter
+        deal.save()
+        self.assertEqual(self.count(self.user), 1)
+
+        # Moving the deal to another user
+        deal.user = self.user2
+        deal.save()
+        self.assertEqual((self.count(self.user), self.count(self.user2)), (0, 1))
+
+        Exchange.objects.get(pk=deal.pk).delete()
+        self.assertEqual(self.count(self.user2), 0)
+
+    def test_counter_follows_bulk_created_deals(self):
+        # Counted by the bulk create endpoint
+        self.assertTrue(DealCounter.objects.reserve(self.user.pk, settings.EXCHANGE_DEALS_LIMIT))
+        deal, = Exchange.objects.bulk_create([Exchange(
+            user=self.user, fund_account_currency=self.dollar, exchange_currency=self.dollar,
+            fund_account_name='My New Account', fund_account_bank='UBA',
+            amount=60000.0, exchange_rate=1.0)])
+        if deal.pk is None:
+            # Databases that don't return the ids of bulk inserts (SQLite)
+            deal.pk, deal._state.adding = Exchange.objects.get(uid=deal.uid).pk, False
+        deal.active = False
+        deal.save()
+        self.assertEqual(self.count(self.user), 0)
+        deal.active = True
+        deal.save()
+        deal.delete()
+        self.assertEqual(self.count(self.user), 0)
+
+    def test_limit(self):
+        for _ in range(settings.EXCHANGE_DEALS_LIMIT):
+            self.create_deal(self.user)
+        with self.assertRaises(ValidationError):
+            self.create_deal(self.user)
+        self.assertEqual(self.count(self.user), settings.EXCHANGE_DEALS_LIMIT)
+        self.assertEqual(self.user.exchange_set.count(), settings.EXCHANGE_DEALS_LIMIT)
+
+        # Inactive deals do not count
+        self.create_deal(self.user, active=False)
+
+    def test_rebuild_command(self):
+        self.create_deal(self.user)
+        self.create_deal(self.user)
+        DealCounter.objects.filter(user=self.user).update(active=7)
+        Exchange.objects.filter(user=self.user).update(user=self.user2)
+        out = StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_deal_counters', verify=True, stdout=out)
+
+        call_command('rebuild_deal_counters', stdout=out)
+        self.assertEqual((self.count(self.user), self.count(self.user2)), (0, 2))
+        call_command('rebuild_deal_counters', verify=True, stdout=out)
+
+
+class SeedDataTests(TestCase):
+    def test_seed_data(self):
+        table = ExchangeTransaction._meta.db_table
+        with connection.cursor() as cursor:
+            indexes = set(connection.introspection.get_constraints(cursor, table))
+
+        call_command('seed_data', users=20, deals=300, transactions=3000, seed=1, stdout=StringIO())
+        self.assertEqual(User.objects.count(), 20)
+        self.assertEqual(Profile.objects.filter(user__in=User.objects.all()).count(), 20)
+        self.assertEqual(Exchange.objects.count(), 300)
+        self.assertEqual(ExchangeTransaction.objects.count(), 3000)
+        self.assertEqual(ExchangeTransaction.objects.values('uid').distinct().count(), 3000)
+        self.assertTrue(User.objects.first().check_password(PASSWORD))
+
+        # What the signals and save methods keep up is written too
+        call_command('rebuild_deal_counters', verify=True, stdout=StringIO())
+        self.assertLessEqual(max(DealCounter.objects.values_list('active', flat=True)), settings.EXCHANGE_DEALS_LIMIT)
+        held = dict(
+            ExchangeTransaction.objects.filter(status='pending').order_by()
+            .values_list('exchange').annotate(Sum('reserved'))
+        )
+        for pk, amount, reserved in Exchange.objects.values_list('pk', 'amount', 'reserved'):
+            self.assertAlmostEqual(reserved, held.get(pk, 0))
+            self.assertLessEqual(reserved, amount)
+        self.assertFalse(ExchangeTransaction.objects.filter(user=F('exchange__user')).exists())
+
+        # Dropped indexes are built again
+        with connection.cursor() as cursor:
+            self.assertEqual(set(connection.introspection.get_constraints(cursor, table)), indexes)
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(email='netrobeweb@gmail.com', first_name='netro', last_name='webby', password='randopass')
+        self.buyer = User.objects.create_user(email='sketcherslodge@gmail.com', first_name='john', last_name='doe', password='newrandopass')
+        dollar = Currency.objects.create(name='US Dollar', symbol='USD', value=1)
+        naira = Currency.objects.create(name='Nigerian Naira', symbol='NGN', value=455)
+        # 60000 USD at 400 NGN / USD
+        self.deal = Exchange.objects.create(
+            user=self.seller, fund_account_currency=dollar, exchange_currency=naira,
+            fund_account_name='My New Account', fund_account_bank='UBA',
+            amount=60000.0, exchange_rate=400.0)
+
+    def buy(self, amount, status='pending'):
+        return ExchangeTransaction.objects.create(user=self.buyer, exchange=self.deal, amount=amount, status=status)
+
+    def liquidity(self):
+        deal = Exchange.objects.get(pk=self.deal.pk)
+        return deal.amount, deal.reserved
+
+    def test_reserve_cancel_complete(self):
+        # 4,000,000 NGN buys 10,000 USD
+        first = self.buy(4000000)
+        second = self.buy(4000000)
+        self.assertEqual(self.liquidity(), (60000, 20000))
+
+        second.status = 'cancelled'
+        second.save()
+        self.assertEqual(self.liquidity(), (60000, 10000))
+
+        first.status = 'completed'
+        first.save()
+        self.assertEqual(self.liquidity(), (50000, 0))
+
+        # Finished transactions can't move again
+        first.status = 'pending'
+        with self.assertRaises(ValidationError):
+            first.save()
+
+        # Deleting a pending transaction releases it
+        self.buy(8000000).delete()
+        self.assertEqual(self.liquidity(), (50000, 0))
+
+    def test_complete_after_the_deal_is_deactivated(self):
+        first, second = self.buy(4000000), self.buy(4000000)
+        Exchange.objects.filter(pk=self.deal.pk).update(active=False)
+        first.status = 'completed'
+        first.save()
+        self.assertEqual(self.liquidity(), (50000, 10000))
+
+        # Through the api serializer too, new transactions are still refused
+        data = {'exchange': self.deal.uid, 'amount': 4000000, 'status': 'completed', 'user': self.buyer.pk}
+        serializer = ExchangeTransactionSerializer(ExchangeTransaction.objects.get(pk=second.pk), data=data)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save()
+        self.assertEqual(self.liquidity(), (40000, 0))
+        self.assertFalse(ExchangeTransactionSerializer(data=dict(data, status='pending')).is_valid())
+
+    def test_lost_holds_are_not_ignored(self):
+        pending = self.buy(4000000)
+        # The hold disappeared from the deal (changed outside of the transactions)
+        Exchange.objects.filter(pk=self.deal.pk).update(reserved=0)
+        pending.status = 'completed'
+        with self.assertRaises(ValidationError):
+            pending.save()
+        pending.status = 'cancelled'
+        with self.assertRaises(ValidationError):
+            pending.save()
+        self.assertEqual(self.liquidity(), (60000, 0))
+
+    def test_no_oversubscription(self):
+        self.buy(16000000)
+        with self.assertRaises(ValidationError):
+            self.buy(10000000)
+        self.assertEqual(self.liquidity(), (60000, 40000))
+
+        # Changing the amount of a pending transaction moves its reservation
+        pending = ExchangeTransaction.objects.get()
+        pending.amount = 24000000
+        pending.save()
+        self.assertEqual(self.liquidity(), (60000, 60000))
+        pending.amount = 28000000
+        with self.assertRaises(ValidationError):
+            pending.save()
+        self.assertEqual(self.liquidity(), (60000, 60000))
+
+    def test_concurrent_buyers_on_stale_reads(self):
+        # Both buyers validate against the same state before either one saves
+        data = {'exchange': self.deal.uid, 'amount': 16000000, 'status': 'pending', 'user': self.buyer.pk}
+        first = ExchangeTransactionSerializer(data=data)
+        second = ExchangeTransactionSerializer(data=data)
+        self.assertTrue(first.is_valid())
+        self.assertTrue(second.is_valid())
+
+        first.save()
+        with self.assertRaises(serializers.ValidationError):
+            second.save()
+        self.assertEqual(self.liquidity(), (60000, 40000))
+
+    def test_owner_updates_keep_reservations(self):
+        self.buy(4000000)
+        self.deal.exchange_address = 'New address'
+        self.deal.save()
+        self.assertEqual(self.liquidity(), (60000, 10000))
+
+    def test_owner_updates_on_a_stale_deal(self):
+        # The owner loads the deal, then a transaction completes
+        deal = Exchange.objects.get(pk=self.deal.pk)
+        self.buy(4000000, status='completed')
+        deal.exchange_address = 'New address'
+        deal.save()
+        self.assertEqual(self.liquidity(), (50000, 0))
+
+        # A new amount is the owner's change, on top of what was taken
+        self.buy(4000000)
+        deal.amount = 55000
+        deal.save()
+        self.assertEqual(deal.amount, 45000)
+        self.assertEqual(self.liquidity(), (45000, 10000))
+
+        # The held part can't be taken back
+        self.assertFalse(Exchange.objects.adjust(deal.pk, -40000))
+        self.assertEqual(self.liquidity(), (45000, 10000))
+
+
+class PairBookTests(TestCase):
+    def test_matches_a_sorted_scan(self):
+        random = Random(7)
+        created = timezone.now()
+
+        def entry(pk):
+            return Entry(pk, str(pk), pk % 5, float(random.randint(400, 460)), created, float(random.randint(1, 100)), 0.0)
+
+        book = PairBook(entry(pk) for pk in range(300))
+        book.block_size = 8
+        for pk in range(300, 600):
+            book.add(entry(pk))
+        for pk in random.sample(range(600), 200):
+            book.discard(pk)
+        for pk in random.sample(sorted(book.entries), 100):
+            book.adjust(pk, reserved=book.entries[pk].available)
+        for pk in random.sample(sorted(book.entries), 50):
+            book.adjust(pk, amount=-1, reserved=-book.entries[pk].reserved)
+
+        ordered = sorted(book.entries.values(), key=lambda i: i.key)
+        for amount, max_rate in [(0, None), (50, None), (90, 430.0), (150, None)]:
+            expected = [
+                i.pk for i in ordered
+                if i.available > 0 and i.available >= amount and (max_rate is None or i.rate <= max_rate)
+            ][:20]
+            self.assertEqual([i.pk for i in book.best(amount, 20, max_rate)], expected)
+
+        fill = book.fill(1000, exclude_user=3)
+        remaining, legs = 1000, []
+        for i in ordered:
+            if remaining > 0 and i.available > 0 and i.user_id != 3:
+                legs.append((i.pk, min(i.available, remaining)))
+                remaining -= legs[-1][1]
+        self.assertEqual([(leg.deal.pk, leg.amount) for leg in fill.legs], legs)
+        self.assertEqual(fill.filled, 1000)
+        for leg in fill.legs:
+            self.assertLessEqual(leg.cost / leg.deal.exchange_rate, leg.amount)
+
+
+class RouteSearchTests(TestCase):
+    def graph(self, deals):
+        # (source, target) -> [(rate, amount)]
+        graph, pk = {}, 0
+        for (source, target), pair_deals in deals.items():
+            pair = graph.setdefault(source, {}).setdefault(target, PairDeals())
+            for rate, amount in pair_deals:
+                pk += 1
+                pair.deals[pk] = [f'deal{pk}', rate, amount, 0]
+            pair.refresh()
+        return graph
+
+    def test_amount_too_big_for_the_next_deal(self):
+        # A -> B pays the most B, but the B -> T deal only takes 60 B
+        graph = self.graph({
+            ('A', 'B'): [(1, 1000)],
+            ('A', 'C'): [(1, 1000)],
+            ('C', 'B'): [(2, 1000)],
+            ('B', 'T'): [(1, 60)],
+        })
+        search = RouteGraph()._search
+        route = search(graph, 'A', 'T', 100, 3)
+        self.assertEqual([(hop.source, hop.target) for hop in route.hops], [('A', 'C'), ('C', 'B'), ('B', 'T')])
+        self.assertEqual(route.received, 50)
+        self.assertIsNone(search(graph, 'A', 'T', 100, 2))
+        # Rates only
+        route = search(graph, 'A', 'T', None, 3)
+        self.assertEqual([(hop.source, hop.target) for hop in route.hops], [('A', 'B'), ('B', 'T')])
+
+        # Or a pricier deal of the same pair
+        graph = self.graph({('A', 'B'): [(1, 1000), (2, 1000)], ('B', 'T'): [(1, 60)]})
+        route = search(graph, 'A', 'T', 100, 3)
+        self.assertEqual([hop.deal[1] for hop in route.hops], ['deal2', 'deal3'])
+        self.assertEqual(route.received, 50)
@@ -1,6 +1,18 @@
+import os
+import secrets
+import socket
+import threading
+import time
+import uuid
+
 from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
 
-from authentication.utils import random_text
+# Caches seen by one process only, no use for leasing uid nodes
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
 
 
 def validate_exchange_amount(amount, value):
@@ -16,12 +28,136 @@ def validate_exchange_amount(amount, value):
         return (False, min_in_fund_currency,)
     return (True, 0,)
 
-def get_usable_uid(instance, uid=None):
-	if not uid:
-		uid = random_text(10)
+def normalize_symbol(symbol):
+    # Currency symbols are stored and looked up upper case
+    return str(symbol).strip().upper()
+
+class UIDGenerator:
+    """
+    Time ordered unique ids that fit the 16 char <uid> columns, made of 80
+    bits written in Crockford base32:
+
+        42 bits milliseconds since <epoch> | 14 bits node | 24 bits sequence
+
+    Ids are unique as long as every process has its own node. The node is
+    the UID_NODE_ID environment variable (0 - 16383) when the process manager
+    gives one to each worker, then the <UID_NODE_ID> setting for single
+    process deployments, otherwise every process leases a free node in the
+    <UID_NODE_CACHE> cache (shared by the workers) for <UID_NODE_LEASE>
+    seconds and renews it while it generates ids. When that cache is local
+    to the process (locmem, dummy) nothing can be leased and the node is
+    random instead, rows are then saved with a retry on a taken uid. No
+    existence check is needed so ids can be given to rows before a
+    bulk_create.
+    """
+    alphabet = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+    epoch = 1609459200000  # 2021-01-01 in milliseconds
+    node_bits = 14
+    sequence_bits = 24
+    counter_key = 'exchange:uid_node_counter'
+    lease_key = 'exchange:uid_node:{}'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._node = None
+        # (cache key, token, renew after) of the leased node
+        self._lease = None
+        self._last = -1
+        self._sequence = 0
+        # Every 10 bit value as its two chars, ids are 8 of them
+        self._pairs = [first + second for first in self.alphabet for second in self.alphabet]
+
+    def get_node(self):
+        node = os.environ.get('UID_NODE_ID')
+        if node is None:
+            node = getattr(settings, 'UID_NODE_ID', None)
+        if node is None:
+            return self.lease_node()
+        self._lease = None
+        node = int(node)
+        if not 0 <= node < 1 << self.node_bits:
+            raise ImproperlyConfigured(f'UID_NODE_ID must be between 0 and {(1 << self.node_bits) - 1}')
+        return node
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'UID_NODE_CACHE', 'default')]
+
+    def lease_node(self):
+        """
+        Takes the next free node, the nodes are handed out in turn from a
+        counter and a node is free when no live process holds its lease.
+        A process local cache would give every worker the same node, a
+        random one is taken instead
+        """
+        if isinstance(self.cache, PROCESS_LOCAL_CACHES):
+            self._lease = None
+            return secrets.randbelow(1 << self.node_bits)
+        ttl = getattr(settings, 'UID_NODE_LEASE', 3600)
+        token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        self.cache.add(self.counter_key, 0, None)
+        for _ in range(1 << self.node_bits):
+            node = self.cache.incr(self.counter_key) % (1 << self.node_bits)
+            key = self.lease_key.format(node)
+            if self.cache.add(key, token, ttl):
+                self._lease = (key, token, time.monotonic() + ttl / 2)
+                return node
+        raise ImproperlyConfigured('Every uid node is leased, give the workers a UID_NODE_ID')
+
+    def renew_lease(self):
+        # Called every half lease, a lost lease (expired and taken) means a new node
+        key, token, _ = self._lease
+        ttl = getattr(settings, 'UID_NODE_LEASE', 3600)
+        if self.cache.get(key) == token and self.cache.touch(key, ttl):
+            self._lease = (key, token, time.monotonic() + ttl / 2)
+        else:
+            self._node = self.lease_node()
+
+    def __call__(self):
+        with self._lock:
+            value = self._next_value()
+        return self.encode(value)
+
+    def many(self, count):
+        # <count> ids in order, for rows made in bulk
+        with self._lock:
+            values = [self._next_value() for _ in range(count)]
+        return [self.encode(value) for value in values]
+
+    def encode(self, value):
+        pairs = self._pairs
+        return (
+            pairs[value >> 70 & 1023] + pairs[value >> 60 & 1023] + pairs[value >> 50 & 1023]
+            + pairs[value >> 40 & 1023] + pairs[value >> 30 & 1023] + pairs[value >> 20 & 1023]
+            + pairs[value >> 10 & 1023] + pairs[value & 1023]
+        )
+
+    def _next_value(self):
+        # Forked workers get their own node
+        if self._pid != os.getpid():
+            self._pid, self._node = os.getpid(), self.get_node()
+            self._last, self._sequence = -1, 0
+        elif self._lease is not None and time.monotonic() > self._lease[2]:
+            self.renew_lease()
+
+        now = int(time.time() * 1000) - self.epoch
+        if now > self._last:
+            self._last, self._sequence = now, 0
+        else:
+            # Same millisecond or clock moved back, keep counting from the last one
+            self._sequence += 1
+            if self._sequence >> self.sequence_bits:
+                self._last, self._sequence = self._last + 1, 0
+
+        return (((self._last << self.node_bits) | self._node) << self.sequence_bits) | self._sequence
+
+
+uid_generator = UIDGenerator()
+
+def new_uid():
+    return uid_generator()
 
-    # Check if the uid exists in the model table
-	exists = instance.__class__.objects.filter(uid=uid).exists()
-	if exists:
-		return get_usable_uid(instance, random_text(10))
-	return uid
\ No newline at end of file
+def get_usable_uid(instance=None, uid=None):
+    # Generated ids are unique by construction, no lookup is needed
+    return uid or new_uid()
\ No newline at end of file
@@ -0,0 +1,117 @@
+import hashlib
+import hmac
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+# Verified key entries, the digest is a fast sha256 of the full key so a
+# cached prefix can only be reused by a client presenting the same secret
+VerifiedKey = namedtuple('VerifiedKey', [
+    'digest', 'project', 'active', 'staff', 'admin', 'revoked', 'expiry', 'cached_at',
+])
+
+
+def key_digest(key):
+    return hashlib.sha256(key.encode()).digest()
+
+
+class VerifiedKeyCache:
+    """
+    Cache of verified api keys by prefix, kept in process and optionally in a
+    shared django cache (<API_KEY_CACHE_ALIAS>) so workers can reuse each
+    other's verifications. Entries live for <API_KEY_CACHE_TTL> seconds and
+    are dropped by the ProjectUserAPIKey/ProjectUser signals.
+    """
+    key_format = 'project_api_key:{}'
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'API_KEY_CACHE_TTL', 300)
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'API_KEY_CACHE_ALIAS', None)
+        if alias:
+            return caches[alias]
+        return None
+
+    def get(self, key, shared=True):
+        # With <shared> False only the process entries are looked at
+        prefix, _, _ = key.partition('.')
+        entry = self._entries.get(prefix)
+        if entry is None or self._is_stale(entry):
+            entry = self._get_shared(prefix) if shared else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[prefix] = entry
+
+        # Same prefix with a different secret is never served from cache
+        if not hmac.compare_digest(entry.digest, key_digest(key)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, key, api_key):
+        project = api_key.project
+        expiry = api_key.expiry_date.timestamp() if api_key.expiry_date else None
+        entry = VerifiedKey(
+            digest=key_digest(key),
+            project=project.pk,
+            active=project.active,
+            staff=project.staff,
+            admin=project.admin,
+            revoked=api_key.revoked,
+            expiry=expiry,
+            cached_at=time.monotonic(),
+        )
+        self._entries[api_key.prefix] = entry
+        if self.shared is not None:
+            self.shared.set(self.key_format.format(api_key.prefix), tuple(entry), self.ttl)
+        return entry
+
+    def invalidate(self, *prefixes):
+        for prefix in prefixes:
+            self._entries.pop(prefix, None)
+        if self.shared is not None and prefixes:
+            self.shared.delete_many([self.key_format.format(prefix) for prefix in prefixes])
+
+    def invalidate_project(self, project_id, prefixes=()):
+        # Local entries are found by project, shared ones need the key prefixes
+        local = [prefix for prefix, entry in list(self._entries.items()) if entry.project == project_id]
+        self.invalidate(*set(local).union(prefixes))
+
+    def clear(self):
+        self.invalidate(*list(self._entries))
+
+    def _is_stale(self, entry):
+        return (time.monotonic() - entry.cached_at) > self.ttl
+
+    def _get_shared(self, prefix):
+        if self.shared is None:
+            return None
+        value = self.shared.get(self.key_format.format(prefix))
+        if value is None:
+            return None
+        # The shared backend handles the ttl, restart the local clock
+        return VerifiedKey(*value)._replace(cached_at=time.monotonic())
+
+
+def is_usable(entry):
+    if entry.revoked or not entry.active:
+        return False
+    if entry.expiry is not None and entry.expiry < timezone.now().timestamp():
+        return False
+    return True
+
+
+key_cache = VerifiedKeyCache()
@@ -1,10 +1,15 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from rest_framework_api_key.models import AbstractAPIKey, BaseAPIKeyManager
 
+from .cache import key_cache
+
 
 class ProjectUserAPIKeyManager(BaseAPIKeyManager):
     def get_usable_keys(self):
-        return super().get_usable_keys().filter(project__active=True)
+        # The project is always needed by the permissions, fetch it with the key
+        return super().get_usable_keys().filter(project__active=True).select_related('project')
 
 class ProjectUser(models.Model):
     name = models.CharField(max_length=128, unique=True)
@@ -33,4 +38,15 @@ class ProjectUserAPIKey(AbstractAPIKey):
 
     class Meta(AbstractAPIKey.Meta):
         verbose_name = "Project-User API key"
-        verbose_name_plural = "Project-User API keys"
\ No newline at end of file
+        verbose_name_plural = "Project-User API keys"
+
+@receiver([post_save, post_delete], sender=ProjectUserAPIKey)
+def invalidate_api_key(sender, instance, **kwargs):
+    key_cache.invalidate(instance.prefix)
+
+@receiver([post_save, post_delete], sender=ProjectUser)
+def invalidate_project_keys(sender, instance, **kwargs):
+    prefixes = []
+    if key_cache.shared is not None:
+        prefixes = list(ProjectUserAPIKey.objects.filter(project_id=instance.pk).values_list('prefix', flat=True))
+    key_cache.invalidate_project(instance.pk, prefixes)
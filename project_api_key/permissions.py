@@ -1,17 +1,47 @@
 from rest_framework_api_key.permissions import BaseHasAPIKey
+from .cache import key_cache, is_usable
 from .models import ProjectUserAPIKey
 
 class HasProjectAPIKey(BaseHasAPIKey):
-    model = ProjectUserAPIKey 
+    model = ProjectUserAPIKey
+
+    def get_verified_key(self, request):
+        """
+        Returns the cached verification of the request key, the key is only
+        hashed and looked up (with its project) when it is not in the cache
+        """
+        key = self.get_key(request)
+        if not key:
+            return None
+
+        entry = key_cache.get(key)
+        if entry is None:
+            try:
+                api_key = self.model.objects.get_from_key(key)
+            except self.model.DoesNotExist:
+                return None
+            entry = key_cache.store(key, api_key)
+        return entry
+
+    def has_permission(self, request, view):
+        entry = self.get_verified_key(request)
+        return entry is not None and is_usable(entry)
 
-class HasStaffProjectAPIKey(BaseHasAPIKey):
+class HasStaffProjectAPIKey(HasProjectAPIKey):
     model = ProjectUserAPIKey
 
     def has_permission(self, request, view):
-        val = super().has_permission(request, view)
-        if val:
-            key = self.get_key(request)
-            api_key = self.model.objects.get_from_key(key)
+        entry = self.get_verified_key(request)
+        if entry is not None and is_usable(entry):
+            return (entry.staff or entry.admin)
+        return False
 
-            return (api_key.project.staff or api_key.project.admin)
-        return False
\ No newline at end of file
+    def has_cached_permission(self, request):
+        """
+        True when the request key is verified in the process cache and grants
+        access, checked without the database or the shared cache (for async
+        views). False means unknown, not denied
+        """
+        key = self.get_key(request)
+        entry = key_cache.get(key, shared=False) if key else None
+        return entry is not None and is_usable(entry) and (entry.staff or entry.admin)
@@ -1,3 +1,72 @@
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from rest_framework.test import APIRequestFactory
 
-# Create your tests here.
+from .cache import key_cache
+from .models import ProjectUser, ProjectUserAPIKey
+from .permissions import HasProjectAPIKey, HasStaffProjectAPIKey
+
+
+class VerifiedKeyCacheTests(TestCase):
+    def setUp(self):
+        key_cache.clear()
+        self.factory = APIRequestFactory()
+
+        # Generate staff api key
+        self.project_user = ProjectUser.objects.create(name='Test Staff User', staff=True)
+        self.api_key, self.key = ProjectUserAPIKey.objects.create_key(
+            name=self.project_user.name,
+            project=self.project_user)
+
+    def request(self, key):
+        return self.factory.get('/', **{'HTTP_BEARER_API_KEY': key})
+
+    def test_cached_check_runs_no_queries(self):
+        permission = HasStaffProjectAPIKey()
+
+        # First check verifies the key and fetches the project in one query
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(permission.has_permission(self.request(self.key), None))
+        self.assertEqual(len(queries), 1)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(permission.has_permission(self.request(self.key), None))
+
+    def test_wrong_secret_with_cached_prefix(self):
+        permission = HasProjectAPIKey()
+        self.assertTrue(permission.has_permission(self.request(self.key), None))
+
+        prefix, _, _ = self.key.partition('.')
+        self.assertFalse(permission.has_permission(self.request(prefix + '.wrongsecret'), None))
+        self.assertFalse(permission.has_permission(self.request(''), None))
+
+    def test_revoked_key_is_invalidated(self):
+        permission = HasProjectAPIKey()
+        self.assertTrue(permission.has_permission(self.request(self.key), None))
+
+        self.api_key.revoked = True
+        self.api_key.save()
+        self.assertFalse(permission.has_permission(self.request(self.key), None))
+
+    def test_project_changes_are_invalidated(self):
+        permission = HasStaffProjectAPIKey()
+        self.assertTrue(permission.has_permission(self.request(self.key), None))
+
+        # Removing staff access takes effect on the next request
+        self.project_user.staff = False
+        self.project_user.save()
+        self.assertFalse(permission.has_permission(self.request(self.key), None))
+
+        # Deactivated projects lose every key
+        self.project_user.staff = True
+        self.project_user.active = False
+        self.project_user.save()
+        self.assertFalse(HasProjectAPIKey().has_permission(self.request(self.key), None))
+
+    def test_deleted_key_is_invalidated(self):
+        permission = HasProjectAPIKey()
+        self.assertTrue(permission.has_permission(self.request(self.key), None))
+
+        self.api_key.delete()
+        self.assertFalse(permission.has_permission(self.request(self.key), None))
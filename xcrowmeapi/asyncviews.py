@@ -0,0 +1,106 @@
+"""
+Async views for the read endpoints, served under ASGI.
+
+An <AsyncReadView> wraps a DRF view: GET requests are answered by a
+coroutine and the other methods are passed on to the DRF view. Django 3.2
+has no async ORM, so the database work of a request (queries and
+serialization, with the DRF permission checks when they need the database)
+runs in a single hop to the database thread through <sync_to_async>. A
+request waiting on a slow client or on that hop holds a coroutine, not a
+thread. Requests whose permission is granted from memory (a cached staff
+api key, or the claims of a JWT access token) skip the DRF authentication,
+and views that need no queries (<in_memory_context>) run in the event loop.
+
+Under WSGI every async view would need an event loop of its own, <as_view>
+returns the DRF view unless <ASYNC_VIEWS> is set (the ASYNC_VIEWS
+environment variable, which asgi.py sets).
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.permissions import OR, OperandHolder
+
+
+def grants_from_cache(permission_class, request):
+    # Only alternatives (a | b) can be granted by one of their sides
+    if isinstance(permission_class, OperandHolder):
+        if permission_class.operator_class is not OR:
+            return False
+        return (
+            grants_from_cache(permission_class.op1_class, request)
+            or grants_from_cache(permission_class.op2_class, request)
+        )
+    check = getattr(permission_class, 'has_cached_permission', None)
+    return check is not None and check(permission_class(), request)
+
+
+def rendered(response):
+    """
+    Renders a DRF response into a plain HttpResponse, the handler would
+    otherwise render it in a thread
+    """
+    if not hasattr(response, 'render'):
+        return response
+    response.render()
+    plain = HttpResponse(response.content, status=response.status_code)
+    for header, value in response.items():
+        plain[header] = value
+    return plain
+
+
+class AsyncReadView:
+    """
+    Serves the GET requests of the DRF view <view_class> from a coroutine.
+    Subclasses return a context manager from <in_memory_context> when the
+    view can answer without queries in it, the view runs in a thread
+    otherwise
+    """
+    view_class = None
+
+    def __init__(self):
+        view_class = self.view_class
+        # Checks permissions as usual
+        self.checked_view = view_class.as_view()
+        # Permission already granted, DRF skips authentication too
+        self.granted_view = view_class.as_view(permission_classes=(), authentication_classes=())
+
+    @classmethod
+    def as_view(cls):
+        if not getattr(settings, 'ASYNC_VIEWS', False):
+            return cls.view_class.as_view()
+        return cls.as_async_view()
+
+    @classmethod
+    def as_async_view(cls):
+        self = cls()
+
+        async def view(request, *args, **kwargs):
+            return await self.dispatch(request, *args, **kwargs)
+
+        # Budgets are read from the DRF view, which checks CSRF itself
+        view.cls = cls.view_class
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await self.in_thread(self.checked_view, request, *args, **kwargs)
+
+        if not self.has_cached_permission(request):
+            return await self.in_thread(self.checked_view, request, *args, **kwargs)
+        context = await self.in_memory_context(request, *args, **kwargs)
+        if context is not None:
+            with context:
+                return rendered(self.granted_view(request, *args, **kwargs))
+        return await self.in_thread(self.granted_view, request, *args, **kwargs)
+
+    def has_cached_permission(self, request):
+        return any(grants_from_cache(permission, request) for permission in self.view_class.permission_classes)
+
+    async def in_memory_context(self, request, *args, **kwargs):
+        return None
+
+    @staticmethod
+    async def in_thread(view, request, *args, **kwargs):
+        # Queries, serialization and rendering in one hop
+        return await sync_to_async(lambda: rendered(view(request, *args, **kwargs)))()
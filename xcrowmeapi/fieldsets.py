@@ -0,0 +1,161 @@
+"""
+Sparse fieldsets and field expansion for the read endpoints.
+
+<?fields=email,profile.username> keeps the listed fields only, dotted names
+select the fields of nested serializers. <?expand=user,exchange.user>
+replaces the related fields listed in the serializer's
+<Meta.expandable_fields> with the nested serializer given there. Unknown
+names are ignored, and so are both params outside of GET/HEAD requests so
+writes always see every field.
+
+<SparseFieldsViewMixin> gives the view's queryset the matching
+<select_related()> for nested and expanded relations and, with ?fields=,
+the matching <only()>, so lean listings load fewer columns and build fewer
+objects.
+"""
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+@lru_cache(maxsize=256)
+def parse_tree(value):
+    # 'a,b.c,b.d' -> {'a': {}, 'b': {'c': {}, 'd': {}}}, the result is shared
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def joined_paths(tree, only, prefix=''):
+    """
+    <only()> paths of the relations of a <query.select_related> tree, they
+    can't be deferred. Relations under a related model are only added when
+    that model is loaded with some fields only, otherwise it is loaded whole
+    """
+    paths = []
+    for name, nested in tree.items():
+        path = prefix + name
+        paths.append(path)
+        if nested and any(i.startswith(path + '__') for i in only):
+            paths += joined_paths(nested, only, path + '__')
+    return paths
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin, the root serializer reads ?fields= and ?expand= from
+    the request of its context and passes the nested parts of them to its
+    nested serializers. <fields> and <expand> can also be given as trees
+    made by <parse_tree>
+    """
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sparse = None if fields is None and expand is None else (fields or None, expand or {})
+
+    def get_sparse(self):
+        """Returns (fields tree or None for all the fields, expand tree)"""
+        if self._sparse is None:
+            self._sparse = (None, {})
+            root = self.parent if isinstance(self.parent, serializers.ListSerializer) else self
+            request = self.context.get('request')
+            if root.parent is None and request is not None and request.method in SAFE_METHODS:
+                params = request.query_params
+                self._sparse = (
+                    parse_tree(params['fields']) if params.get('fields') else None,
+                    parse_tree(params.get('expand', '')),
+                )
+        return self._sparse
+
+    def get_fields(self):
+        fields = super().get_fields()
+        only, expand = self.get_sparse()
+
+        expandable = getattr(self.Meta, 'expandable_fields', {})
+        for name in expand:
+            if name in expandable and (only is None or name in only):
+                kwargs = {'read_only': True}
+                source = fields[name].source if name in fields else None
+                if source and source != name:
+                    kwargs['source'] = source
+                fields[name] = expandable[name](**kwargs)
+
+        if only is not None:
+            fields = {name: field for name, field in fields.items() if name in only}
+
+        # What is left of the trees goes to the nested serializers
+        for name, field in fields.items():
+            nested = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(nested, SparseFieldsMixin):
+                nested._sparse = ((only or {}).get(name) or None, expand.get(name, {}))
+        return fields
+
+    def get_field_paths(self, prefix=''):
+        """
+        Returns the <only()> paths of the fields, None when one of them isn't
+        a model field, and the <select_related()> paths of the nested ones
+        """
+        opts = self.Meta.model._meta
+        only, related = [], []
+        for field in self.fields.values():
+            if field.write_only:
+                continue
+            try:
+                model_field = opts.get_field(field.source_attrs[0]) if field.source_attrs else None
+            except FieldDoesNotExist:
+                model_field = None
+            if model_field is None or model_field.many_to_many or model_field.one_to_many:
+                only = None
+                continue
+
+            name = prefix + model_field.name
+            if isinstance(field, SparseFieldsMixin) and model_field.is_relation:
+                related.append(name)
+                nested_only, nested_related = field.get_field_paths(name + '__')
+                related += nested_related
+                # With no path under it the related model is loaded whole
+                if only is not None and nested_only is not None:
+                    only += nested_only
+            if only is not None and model_field.concrete:
+                only.append(name)
+        return only, related
+
+    def sparse_queryset(self, queryset, required=()):
+        """
+        <queryset> with the related objects and, for sparse fieldsets, only
+        the columns these fields need plus the <required> ones
+        """
+        only, related = self.get_field_paths()
+        if related:
+            queryset = queryset.select_related(*related)
+        if only is not None and self.get_sparse()[0] is not None:
+            joined = queryset.query.select_related
+            if joined is True:
+                # Every relation is joined, none can be deferred
+                return queryset
+            queryset = queryset.only(*only, *required, *joined_paths(joined or {}, only))
+        return queryset
+
+
+class SparseFieldsViewMixin:
+    """
+    Applies the sparse fieldset and expansions of the request to the
+    queryset of a generic view using a <SparseFieldsMixin> serializer
+    """
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method in SAFE_METHODS:
+            queryset = self.get_serializer().sparse_queryset(queryset, self.get_required_fields())
+        return queryset
+
+    def get_required_fields(self):
+        # Read by the view itself, the lookup and the pagination cursors
+        required = ['pk', self.lookup_field]
+        required += getattr(self, 'keyset_ordering', ())
+        return required
@@ -0,0 +1,357 @@
+"""
+Prometheus metrics of the api served as text on /metrics (staff keys and
+admins only).
+
+Metrics are kept in memory by every worker, children of a metric are bound
+once per label values and reused so recording a request is a few additions.
+With <METRICS_DIR> set every worker writes its values to its own file in
+that directory (at most every <METRICS_FLUSH_INTERVAL> seconds), and
+/metrics adds up the files of all the workers. Files of stopped workers are
+kept so counters don't go back, clear the directory when deploying.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self, lock):
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+    def reset(self):
+        self.value = 0.0
+
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, lock, buckets):
+        self.buckets = buckets
+        # Per bucket counts, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def sample(self):
+        return [list(self.counts), self.sum]
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Child of the metric for the label values, bind it once and keep it
+        instead of calling this for every event
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        return [[list(values), child.sample()] for values, child in list(self._children.items())]
+
+    def reset(self):
+        # Bound children stay valid
+        for child in list(self._children.values()):
+            child.reset()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_child(self):
+        return CounterChild(self._lock)
+
+    def inc(self, amount=1):
+        # For metrics without labels
+        self.labels().inc(amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return HistogramChild(self._lock, self.buckets)
+
+
+class CallbackCounter(Metric):
+    """
+    Counter read from <callback> when collecting, the callback returns
+    {label values: value} (for the hit/miss counters kept by the caches)
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames, callback):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        return [[list(values), value] for values, value in self.callback().items()]
+
+    def reset(self):
+        pass
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self._pid = os.getpid()
+        self._file = None
+        self._flushed_at = 0.0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback_counter(self, name, documentation, labelnames, callback):
+        return self.register(CallbackCounter(name, documentation, labelnames, callback))
+
+    @property
+    def directory(self):
+        return getattr(settings, 'METRICS_DIR', None)
+
+    def snapshot(self):
+        return {
+            name: {
+                'type': metric.type,
+                'help': metric.documentation,
+                'labels': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': metric.samples(),
+            } for name, metric in self.metrics.items()
+        }
+
+    def check_fork(self):
+        # Called before every request, a forked worker starts from zero in its own file
+        if self._pid != os.getpid():
+            for metric in self.metrics.values():
+                metric.reset()
+            self._pid, self._file = os.getpid(), None
+
+    def maybe_flush(self):
+        # Called after every request, writes the worker file now and then
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+        if self.directory and (time.monotonic() - self._flushed_at) >= interval:
+            self.flush()
+
+    def flush(self):
+        directory = self.directory
+        if not directory:
+            return
+        if self._file is None:
+            os.makedirs(directory, exist_ok=True)
+            self._file = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+
+        # Replace the file at once so readers never see half of it
+        temp = f'{self._file}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp, self._file)
+        self._flushed_at = time.monotonic()
+
+    def collect(self):
+        """
+        Snapshots of all the workers (this one included), read from
+        <METRICS_DIR> when it is set
+        """
+        directory = self.directory
+        if not directory:
+            return [self.snapshot()]
+
+        self.flush()
+        snapshots = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or being replaced
+                continue
+        return snapshots
+
+    def render(self):
+        totals = {}
+        for snapshot in self.collect():
+            for name, family in snapshot.items():
+                merged = totals.setdefault(name, dict(family, samples={}))
+                for values, sample in family['samples']:
+                    key = tuple(values)
+                    if family['type'] == 'histogram':
+                        counts, total = merged['samples'].get(key, ([0] * len(sample[0]), 0.0))
+                        merged['samples'][key] = ([a + b for a, b in zip(counts, sample[0])], total + sample[1])
+                    else:
+                        merged['samples'][key] = merged['samples'].get(key, 0) + sample
+
+        lines = []
+        for name, family in totals.items():
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family["type"]}')
+            for key, sample in sorted(family['samples'].items()):
+                labels = list(zip(family['labels'], key))
+                if family['type'] == 'histogram':
+                    counts, total = sample
+                    cumulative = 0
+                    for bound, count in zip(family['buckets'] + ['+Inf'], counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels + [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {sample}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter(
+    'http_requests_total', 'Requests by route, method and status', ('route', 'method', 'status'))
+http_duration = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route and method', ('route', 'method'))
+http_queries = registry.counter(
+    'http_request_db_queries_total', 'SQL queries run by requests by route and method', ('route', 'method'))
+deals_created = registry.counter('xcrowme_deals_created_total', 'Exchange deals created')
+transactions_completed = registry.counter('xcrowme_transactions_completed_total', 'Exchange transactions completed')
+
+
+def cache_stats():
+    # Hits and misses of the process caches, imported when collecting
+    from authentication.cache import access_claims_cache
+    from exchange.registry import currency_registry
+    from exchange.routing import route_graph
+    from project_api_key.cache import key_cache
+
+    stats = {
+        'api_key': (key_cache.hits, key_cache.misses),
+        'access_claims': (access_claims_cache.hits, access_claims_cache.misses),
+        'currency_registry': (currency_registry.hits, currency_registry.loads),
+        'routes': (route_graph._routes.hits, route_graph._routes.misses),
+    }
+    samples = {}
+    for name, (hits, misses) in stats.items():
+        samples[(name, 'hit')] = hits
+        samples[(name, 'miss')] = misses
+    return samples
+
+
+registry.callback_counter('cache_requests_total', 'Lookups of the process caches', ('cache', 'result'), cache_stats)
+
+
+HTTP_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'TRACE', 'CONNECT'))
+
+
+class MetricsMiddleware:
+    """
+    Records every request against its url route (the pattern, not the path).
+    Place it after ProfilingMiddleware to count the queries of the requests
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # (route, method) -> (duration, queries, {status: requests})
+        self._bound = {}
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        registry.check_fork()
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        registry.check_fork()
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, duration):
+        from .profiling import get_profile
+
+        match = request.resolver_match
+        # Clients choose the method, any other one would be a new series
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        key = (match.route if match is not None else '', method)
+        bound = self._bound.get(key)
+        if bound is None:
+            bound = self._bound[key] = (http_duration.labels(*key), http_queries.labels(*key), {})
+        requests = bound[2].get(response.status_code)
+        if requests is None:
+            requests = bound[2][response.status_code] = http_requests.labels(key[0], key[1], str(response.status_code))
+
+        requests.inc()
+        bound[0].observe(duration)
+        profile = get_profile()
+        if profile is not None:
+            bound[1].inc(profile.queries)
+        registry.maybe_flush()
+
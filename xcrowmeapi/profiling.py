@@ -0,0 +1,223 @@
+"""
+Per request cost of the api: number of SQL queries, database time,
+serializer time and render time.
+
+<ProfilingMiddleware> measures every request and, when <PROFILING_HEADERS>
+is set (DEBUG by default), adds them to the response as <X-Query-Count> and
+<Server-Timing> headers. Views declare budgets as class attributes:
+
+    class ListCreateExchange(ProfiledViewMixin, generics.ListCreateAPIView):
+        query_budget = {'GET': 3}
+        time_budget = 200  # milliseconds, for every method
+
+a request over budget is logged, or raises <BudgetExceeded> when
+<PROFILING_ENFORCE_BUDGETS> is set, which <BudgetTestRunner> does so the
+tests fail on regressions. <ProfiledViewMixin> adds the serializer time of
+the serializers made by <get_serializer>.
+
+Queries are counted by an execute wrapper installed once on every database
+connection, it finds the profile of the request through a context variable
+so the queries of an ASGI request run in <sync_to_async> threads count too.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_profile', default=None)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        # Seconds
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.render_time = 0.0
+        self.total_time = 0.0
+        self.view_class = None
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, name, getattr(self, name) + time.perf_counter() - start)
+
+    def execute(self, execute, sql, params, many, context):
+        # Database execute wrapper, counts and times every query
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+    def headers(self):
+        timings = [
+            ('db', self.db_time, f'{self.queries} queries'),
+            ('serializer', self.serializer_time, None),
+            ('render', self.render_time, None),
+            ('total', self.total_time, None),
+        ]
+        return {
+            'X-Query-Count': str(self.queries),
+            'Server-Timing': ', '.join(
+                f'{name};dur={value * 1000:.2f}' + (f';desc="{desc}"' if desc else '')
+                for name, value, desc in timings
+            ),
+        }
+
+
+def get_profile():
+    # Profile of the current request, None outside of requests
+    return _current.get()
+
+
+def profile_execute(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    return profile.execute(execute, sql, params, many, context)
+
+
+def install_execute_wrapper(connection, **kwargs):
+    if profile_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(profile_execute)
+
+
+connection_created.connect(install_execute_wrapper)
+
+
+def get_budget(budget, method):
+    if isinstance(budget, dict):
+        return budget.get(method)
+    return budget
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Connections opened before the signal was connected
+        for connection in connections.all():
+            install_execute_wrapper(connection)
+        if iscoroutinefunction(get_response):
+            # Served by ASGI, keep the render hook in the event loop
+            markcoroutinefunction(self)
+            self.process_template_response = self.aprocess_template_response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, profile, response)
+
+    async def __acall__(self, request):
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, profile, response)
+
+    def finish(self, request, profile, response):
+        profile.total_time = time.perf_counter() - profile.start
+        # DRF views keep their class on the view function
+        match = request.resolver_match
+        if match is not None:
+            profile.view_class = getattr(match.func, 'cls', getattr(match.func, 'view_class', None))
+
+        self.check_budgets(request, profile)
+        if getattr(settings, 'PROFILING_HEADERS', settings.DEBUG):
+            for header, value in profile.headers().items():
+                response[header] = value
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook
+        profile = get_profile()
+        if profile is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                profile.render_time += time.perf_counter() - start
+            response.add_post_render_callback(rendered)
+        return response
+
+    async def aprocess_template_response(self, request, response):
+        return ProfilingMiddleware.process_template_response(self, request, response)
+
+    def check_budgets(self, request, profile):
+        view = profile.view_class
+        if view is None:
+            return
+
+        errors = []
+        queries = get_budget(getattr(view, 'query_budget', None), request.method)
+        if queries is not None and profile.queries > queries:
+            errors.append(f'{profile.queries} queries (budget {queries})')
+        duration = get_budget(getattr(view, 'time_budget', None), request.method)
+        if duration is not None and profile.total_time * 1000 > duration:
+            errors.append(f'{profile.total_time * 1000:.1f} ms (budget {duration} ms)')
+
+        if errors:
+            message = f'{request.method} {request.path} ({view.__name__}) took {", ".join(errors)}'
+            if getattr(settings, 'PROFILING_ENFORCE_BUDGETS', False):
+                raise BudgetExceeded(message)
+            logger.warning(message)
+
+
+class ProfiledViewMixin:
+    """
+    Adds the time spent in <serializer.data> (including the queries it runs)
+    to the request profile for serializers made by <get_serializer>
+    """
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        profile = get_profile()
+        if profile is not None:
+            # <data> is the <to_representation> of the root serializer
+            to_representation = serializer.to_representation
+
+            def timed(instance):
+                with profile.timer('serializer_time'):
+                    return to_representation(instance)
+            serializer.to_representation = timed
+        return serializer
+
+
+class BudgetTestRunner(DiscoverRunner):
+    # Requests over their view budgets fail the tests
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._enforce_budgets = override_settings(PROFILING_ENFORCE_BUDGETS=True)
+        self._enforce_budgets.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._enforce_budgets.disable()
+        super().teardown_test_environment(**kwargs)
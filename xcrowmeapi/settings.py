@@ -55,11 +55,22 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS': 'authentication.pagination.CustomPagination',
+    # Token buckets of xcrowmeapi.throttling (login, otp and email tokens)
+    'DEFAULT_THROTTLE_RATES': {
+        'project': '6000/min',
+        'ip': '120/min',
+        'target': '10/min',
+    },
+    # Proxies in front of the app, the 'ip' throttle only trusts that many
+    # X-Forwarded-For entries (none by default, the client address is used)
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
 }
 
 API_KEY_CUSTOM_HEADER = "HTTP_BEARER_API_KEY"
 
 MIDDLEWARE = [
+    'xcrowmeapi.profiling.ProfilingMiddleware',
+    'xcrowmeapi.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,6 +81,8 @@ MIDDLEWARE = [
 ]
 
 ROOT_URLCONF = 'xcrowmeapi.urls'
+# Fails the tests on requests over their view query/time budgets
+TEST_RUNNER = 'xcrowmeapi.profiling.BudgetTestRunner'
 AUTH_USER_MODEL = 'authentication.User'
 
 TEMPLATES = [
@@ -151,4 +164,86 @@ MEDIA_URL='/media/'
 # CUSTOM PROJECT KEYS
 # This value is in dollars ($50,000)
 EXCHANGE_MINIMUM = 50000
-EXCHANGE_DEALS_LIMIT = 5
\ No newline at end of file
+EXCHANGE_DEALS_LIMIT = 5
+# Max number of deals in one bulk creation request
+EXCHANGE_BULK_LIMIT = 500
+# Max number of users in one batch lookup
+USER_BATCH_LIMIT = 500
+
+# Verified api keys are cached by prefix for this many seconds, set
+# API_KEY_CACHE_ALIAS to a shared cache (CACHES) to share them across workers
+API_KEY_CACHE_TTL = 300
+API_KEY_CACHE_ALIAS = None
+
+# IsAuthenticatedAdmin trusts the staff/admin/active token claims, set this
+# to a number of seconds to revalidate them from the database per user
+ACCESS_CLAIMS_REVALIDATE_SECONDS = None
+ACCESS_CLAIMS_CACHE_SIZE = 1024
+
+# Currencies are served from an in process registry, workers compare a
+# version stamp in this cache every CURRENCY_REGISTRY_CHECK_INTERVAL seconds
+# to pick up changes made by other workers (use a shared cache in production)
+CURRENCY_REGISTRY_CACHE = 'default'
+CURRENCY_REGISTRY_CHECK_INTERVAL = 1
+
+# Deals are matched from in process order books, workers count their changes
+# in this cache and reload their books when another worker changed deals
+ORDER_BOOK_CACHE = 'default'
+ORDER_BOOK_CHECK_INTERVAL = 1
+# Longest chain of deals returned by the route endpoint and how many routes
+# are cached per worker
+EXCHANGE_ROUTE_MAX_HOPS = 3
+EXCHANGE_ROUTE_CACHE_SIZE = 1024
+
+# Node of this process in generated uids (0 - 16383). A UID_NODE_ID
+# environment variable per worker comes first, then this setting (for a
+# single process), otherwise every worker leases a free node in
+# UID_NODE_CACHE for UID_NODE_LEASE seconds and renews it (use a shared
+# cache in production, with a locmem cache every worker takes a random
+# node and a taken uid is only caught by a retry when rows are saved)
+UID_NODE_ID = None
+UID_NODE_CACHE = 'default'
+UID_NODE_LEASE = 3600
+
+# Query count and timings of every request are sent as X-Query-Count and
+# Server-Timing headers when PROFILING_HEADERS is set, views over their
+# query_budget/time_budget are logged (or fail with PROFILING_ENFORCE_BUDGETS,
+# which the test runner sets)
+PROFILING_HEADERS = DEBUG
+PROFILING_ENFORCE_BUDGETS = False
+
+# Workers write their metrics to their own file in METRICS_DIR (at most every
+# METRICS_FLUSH_INTERVAL seconds) and /metrics adds them up, without it
+# /metrics only shows the worker answering
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+
+# The read endpoints (currencies, deals, transaction and user details) are
+# served by async views when the ASYNC_VIEWS environment variable is 1, which
+# asgi.py sets by default. Keep it off under WSGI, every async view would run
+# in an event loop of its own
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS') == '1'
+
+# Emails to users are queued in an outbox and sent by the deliver_emails
+# worker, a failed email is tried again after EMAIL_OUTBOX_RETRY_DELAY
+# seconds (doubled on every attempt) up to EMAIL_OUTBOX_MAX_ATTEMPTS times.
+# A worker holds its batch for EMAIL_OUTBOX_LEASE seconds
+EMAIL_OUTBOX_RETRY_DELAY = 30
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_LEASE = 300
+
+# Throttle buckets are kept in process, set THROTTLE_CACHE to a shared cache
+# alias (CACHES) to share them across workers
+THROTTLE_CACHE = None
+
+
+# Otps generated with a key are kept in process for OTP_TTL seconds and
+# OTP_MAX_ATTEMPTS wrong guesses, up to OTP_STORE_MAX_SIZE of them (expired
+# ones are swept every OTP_SWEEP_INTERVAL seconds). Set OTP_CACHE to a shared
+# cache alias (CACHES) when several workers verify them
+OTP_DIGITS = 6
+OTP_TTL = 300
+OTP_MAX_ATTEMPTS = 5
+OTP_STORE_MAX_SIZE = 1000000
+OTP_SWEEP_INTERVAL = 60
+OTP_CACHE = None
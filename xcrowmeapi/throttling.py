@@ -0,0 +1,199 @@
+"""
+Token bucket throttles by api key project, client address and target
+(the email or user a request is about), for the endpoints where a burst of
+requests is expensive (password hashing) or abusable (tokens and otps).
+
+Rates are DRF rates ('10/min') in <DEFAULT_THROTTLE_RATES> under the
+'project', 'ip' and 'target' scopes, a bucket holds up to the number of
+requests of the rate and refills continuously. Buckets are kept in process
+without locks, a race between threads can let an extra request through but
+never blocks one. With <THROTTLE_CACHE> set to a cache alias the buckets
+are kept in that cache instead so every worker shares them.
+
+<ThrottleFirstMixin> checks the project and ip throttles before
+authentication and the permissions, so rejected requests cost no query and
+no hashing. The target throttle is only checked once the permissions pass,
+requests without a valid key or token can't use up the bucket of an email.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from project_api_key.cache import key_cache
+
+
+class TokenBuckets:
+    """
+    Buckets by key, each is a (tokens, updated, full at) tuple replaced as a
+    whole. Full buckets are dropped once there are more than <max_size>
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._buckets = {}
+
+    def consume(self, key, rate, capacity):
+        """
+        Takes a token from the bucket of <key>, refilled at <rate> tokens
+        per second up to <capacity>. Returns 0 when a token was taken, the
+        seconds until the next token otherwise
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+        if bucket is None and len(self._buckets) > self.max_size:
+            self.prune(now)
+        return wait
+
+    def prune(self, now):
+        for key, bucket in list(self._buckets.items()):
+            if bucket[2] <= now:
+                self._buckets.pop(key, None)
+
+    def clear(self):
+        self._buckets = {}
+
+
+class SharedTokenBuckets:
+    """
+    Buckets kept in a django cache for all the workers, by a digest of
+    their key (emails can hold chars memcached keys can't). Reads and writes
+    are not atomic, concurrent requests of one key can get an extra token
+    """
+    key_format = 'throttle:{}'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def consume(self, key, rate, capacity):
+        # Wall clock, shared between workers
+        now = time.time()
+        cache_key = self.key_format.format(hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
+        bucket = self.cache.get(cache_key)
+        tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        # Expires once it would be full again
+        self.cache.set(cache_key, (tokens, now), int((capacity - tokens) / rate) + 1)
+        return wait
+
+
+local_buckets = TokenBuckets()
+
+
+def get_buckets():
+    alias = getattr(settings, 'THROTTLE_CACHE', None)
+    if alias:
+        return SharedTokenBuckets(caches[alias])
+    return local_buckets
+
+
+_parsed_rates = {}
+
+
+def parse_rate(rate):
+    # '10/min' -> (tokens per second, capacity)
+    parsed = _parsed_rates.get(rate)
+    if parsed is None:
+        count, period = rate.split('/')
+        seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+        parsed = _parsed_rates[rate] = (int(count) / seconds, int(count))
+    return parsed
+
+
+class BucketThrottle(BaseThrottle):
+    scope = None
+    # Checked before authentication by <ThrottleFirstMixin>
+    checked_first = True
+
+    def get_ident_key(self, request, view):
+        """Key of the bucket of the request, None to not throttle it"""
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        if rate is None:
+            return True
+        key = self.get_ident_key(request, view)
+        if key is None:
+            return True
+
+        self.delay = get_buckets().consume(f'{self.scope}:{key}', *parse_rate(rate))
+        return self.delay == 0
+
+    def wait(self):
+        return self.delay
+
+
+class ProjectThrottle(BucketThrottle):
+    """
+    By api key project, found in the key cache. Keys that aren't cached yet
+    are counted by their prefix
+    """
+    scope = 'project'
+
+    def get_ident_key(self, request, view):
+        key = request.META.get(settings.API_KEY_CUSTOM_HEADER)
+        if not key:
+            return None
+        entry = key_cache.get(key, shared=False)
+        if entry is not None:
+            return f'project:{entry.project}'
+        return f'prefix:{key.partition(".")[0]}'
+
+
+class IPThrottle(BucketThrottle):
+    scope = 'ip'
+
+    def get_ident_key(self, request, view):
+        return self.get_ident(request)
+
+
+class TargetThrottle(BucketThrottle):
+    """
+    By the email or user the request is about, from the view's
+    <get_throttle_target>, once the request is allowed
+    """
+    scope = 'target'
+    checked_first = False
+
+    def get_ident_key(self, request, view):
+        target = view.get_throttle_target(request)
+        if not target:
+            return None
+        return str(target).strip().lower()
+
+
+class ThrottleFirstMixin:
+    """
+    Checks the throttles before authentication and the permissions, which
+    can query the database, apart from the ones that are only for allowed
+    requests
+    """
+    throttle_classes = (ProjectThrottle, IPThrottle, TargetThrottle)
+    _throttles_checked = False
+
+    def initial(self, request, *args, **kwargs):
+        self.check_throttles(request)
+        self._throttles_checked = True
+        super().initial(request, *args, **kwargs)
+
+    def get_throttles(self):
+        # The first ones before authentication, the others after the permissions
+        first = not self._throttles_checked
+        return [throttle for throttle in super().get_throttles() if getattr(throttle, 'checked_first', True) == first]
+
+    def get_throttle_target(self, request):
+        return None
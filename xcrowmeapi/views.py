@@ -0,0 +1,18 @@
+from django.http import HttpResponse
+from rest_framework.views import APIView
+
+from authentication.permissions import IsAuthenticatedAdmin
+from project_api_key.permissions import HasStaffProjectAPIKey
+
+from .metrics import registry
+
+
+class MetricsView(APIView):
+    """
+    Prometheus text of the metrics of every worker, for staff keys and
+    admins only (route, traffic and cache figures aren't public)
+    """
+    permission_classes = (HasStaffProjectAPIKey | IsAuthenticatedAdmin,)
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')